@@ -1,10 +1,20 @@
 from __future__ import annotations
 
 import json
+import threading
 import uuid
 from dataclasses import dataclass, asdict
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+
+from .storage import atomic_write_bytes
+
+
+FILTER_KEYS = ("collection", "entity_type", "start_date", "end_date", "type_label")
+
+
+def rule_filters(rule: Dict) -> Dict:
+    return {key: rule.get(key) for key in FILTER_KEYS}
 
 
 @dataclass
@@ -19,20 +29,40 @@ class AlbumStore:
         self.data_dir = data_dir
         self.path = self.data_dir / "albums.jsonl"
         self.albums: List[Album] = []
+        self._stamp: Optional[Tuple[int, int, int]] = None
         if self.path.exists():
             self._load()
 
+    def _file_stamp(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
     def _load(self) -> None:
-        self.albums.clear()
+        self._stamp = self._file_stamp()
+        albums = []
         with self.path.open("r", encoding="utf-8") as f:
             for line in f:
                 obj = json.loads(line)
-                self.albums.append(Album(**obj))
+                albums.append(Album(**obj))
+        self.albums = albums
+
+    def reload(self) -> None:
+        """Re-read albums.jsonl if another process (the writer) rewrote it."""
+        stamp = self._file_stamp()
+        if stamp != self._stamp:
+            if stamp is None:
+                self.albums, self._stamp = [], None
+            else:
+                self._load()
 
     def save(self) -> None:
-        with self.path.open("w", encoding="utf-8") as f:
-            for album in self.albums:
-                f.write(json.dumps(asdict(album), ensure_ascii=False) + "\n")
+        # Replaced atomically: replicas re-read the file while the writer edits it
+        data = "".join(json.dumps(asdict(album), ensure_ascii=False) + "\n" for album in self.albums)
+        atomic_write_bytes(self.path, data.encode("utf-8"))
+        self._stamp = self._file_stamp()
 
     def list(self) -> List[Album]:
         return list(self.albums)
@@ -57,6 +87,14 @@ class AlbumStore:
         self.save()
         return a
 
+    def update_rule(self, album_id: str, rule: Dict) -> Optional[Album]:
+        a = self.get(album_id)
+        if not a:
+            return None
+        a.rule = rule
+        self.save()
+        return a
+
     def delete(self, album_id: str) -> bool:
         before = len(self.albums)
         self.albums = [a for a in self.albums if a.id != album_id]
@@ -66,3 +104,131 @@ class AlbumStore:
         return False
 
 
+
+
+class AlbumResults:
+    """Materialized smart-album membership: the top `limit` (id, score) pairs per album.
+
+    Results are computed once per rule, persisted under album_results/, and kept current
+    by scoring each newly ingested screenshot against every album rule (O(albums) per item).
+    An entry records how many rows of each indexer part (shard) it has scored, in "through",
+    and the part's snapshot generation those row offsets belong to: compaction renumbers
+    rows, so results from another generation are recomputed.
+    """
+
+    def __init__(self, data_dir: Path, limit: int = 200) -> None:
+        self.dir = data_dir / "album_results"
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.limit = limit
+        self._lock = threading.RLock()
+        self._cache: Dict[str, Dict] = {}
+
+    def _path(self, album_id: str) -> Path:
+        return self.dir / f"{album_id}.json"
+
+    def _load(self, album: Album) -> Optional[Dict]:
+        entry = self._cache.get(album.id)
+        if entry is None and self._path(album.id).exists():
+            entry = json.loads(self._path(album.id).read_text(encoding="utf-8"))
+            if isinstance(entry["through"], int):
+                entry["through"] = {"": entry["through"]}  # written before shards
+            entry.setdefault("generations", {})
+            self._cache[album.id] = entry
+        # A result set computed for another rule is stale
+        if entry is not None and entry.get("rule") != album.rule:
+            self.invalidate(album.id)
+            return None
+        return entry
+
+    def _store(self, album_id: str, entry: Dict, indexer) -> None:
+        self._cache[album_id] = entry
+        # A replica keeps what it computed in memory; album_results/ belongs to the writer
+        if not indexer.readonly:
+            atomic_write_bytes(self._path(album_id), json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+
+    def invalidate(self, album_id: str) -> None:
+        with self._lock:
+            self._cache.pop(album_id, None)
+            self._path(album_id).unlink(missing_ok=True)
+
+    def forget(self, image_ids: List[str]) -> None:
+        """Drop materialized results that list any of image_ids (deleted screenshots)."""
+        ids = set(image_ids)
+        with self._lock:
+            for path in self.dir.glob("*.json"):
+                entry = self._cache.get(path.stem) or json.loads(path.read_text(encoding="utf-8"))
+                if any(image_id in ids for image_id, _ in entry["results"]):
+                    self.invalidate(path.stem)
+
+    def reload(self) -> None:
+        """Forget in-memory copies, so results another process rewrote are read again."""
+        with self._lock:
+            self._cache.clear()
+
+    def clear(self) -> None:
+        """Drop every album's results, e.g. after screenshots moved between collections."""
+        with self._lock:
+            for path in self.dir.glob("*.json"):
+                self.invalidate(path.stem)
+
+    @staticmethod
+    def _current(entry: Dict, part) -> bool:
+        # Offsets in "through" only mean something within the generation they were counted in
+        return entry["generations"].get(part.shard, 0) == part.snapshot["generation"] and entry["through"].get(part.shard, 0) <= len(part.metas)
+
+    def view(self, album: Album, indexer, k: int) -> Optional[List[Tuple[str, float]]]:
+        """Top-k (id, score) pairs for the album, or None when k exceeds what is materialized."""
+        if k > self.limit:
+            return None
+        parts = indexer.parts()
+        with self._lock:
+            entry = self._load(album)
+            if entry is not None and not all(self._current(entry, part) for part in parts):
+                if indexer.readonly:
+                    return None  # written by the writer for another snapshot than this replica's: search instead
+                self.invalidate(album.id)  # the index was compacted, rebuilt or truncated underneath us
+                entry = None
+            if entry is None:
+                matches = indexer.search(album.rule.get("q") or "", k=self.limit, mode="semantic", **rule_filters(album.rule))
+                entry = {
+                    "rule": album.rule,
+                    "through": {part.shard: len(part.metas) for part in parts},
+                    "generations": {part.shard: part.snapshot["generation"] for part in parts},
+                    "results": [[m["id"], m["score"]] for m in matches],
+                }
+                self._store(album.id, entry, indexer)
+            else:
+                for part in parts:
+                    done = entry["through"].get(part.shard, 0)
+                    if done < len(part.metas):
+                        # Screenshots indexed while this process was not listening
+                        offsets = list(range(done, len(part.metas)))
+                        vectors = part.index.reconstruct_n(offsets[0], len(offsets))
+                        self._add(album, entry, part, offsets, vectors)
+            return [(image_id, score) for image_id, score in entry["results"][:k]]
+
+    def on_ingest(self, albums: List[Album], indexer, offsets: List[int], vectors) -> None:
+        with self._lock:
+            for album in albums:
+                entry = self._load(album)
+                # Albums never viewed are materialized lazily on first view, and stale ones on their next
+                if entry is not None and self._current(entry, indexer) and entry["through"].get(indexer.shard, 0) == offsets[0]:
+                    self._add(album, entry, indexer, offsets, vectors)
+
+    def _add(self, album: Album, entry: Dict, indexer, offsets: List[int], vectors) -> None:
+        filters = rule_filters(album.rule)
+        scores = indexer.score_query(album.rule.get("q") or "", vectors)
+        results = entry["results"]
+        changed = False
+        for offset, score in zip(offsets, scores.tolist()):
+            if not indexer.matches_filters(offset, **filters):
+                continue
+            if len(results) >= self.limit and score <= results[-1][1]:
+                continue
+            results.append([indexer.metas[offset].id, float(score)])
+            changed = True
+        if changed:
+            results.sort(key=lambda r: -r[1])
+            del results[self.limit:]
+        entry["through"][indexer.shard] = offsets[-1] + 1
+        self._store(album.id, entry, indexer)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import math
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+
+@dataclass
+class AnnConfig:
+    """Which vector index backs search once the corpus is large enough, and its knobs."""
+
+    kind: str = "flat"
+    train_threshold: int = 50000  # exact search below this many vectors
+    checkpoint_every: int = 10000  # vectors added between index.faiss checkpoints
+    exact_subset_limit: int = 20000  # filtered queries over fewer rows are scored exactly
+    nlist: Optional[int] = None  # IVF lists; default ~4*sqrt(N)
+    nprobe: int = 16
+    hnsw_m: int = 32
+    ef_construction: int = 80
+    ef_search: int = 64
+    pq_m: int = 16  # PQ sub-quantizers; must divide the embedding dim
+    pq_nbits: int = 8
+
+    def __post_init__(self) -> None:
+        if self.kind not in INDEX_TYPES:
+            raise ValueError(f"unknown index type {self.kind!r}; expected one of {', '.join(INDEX_TYPES)}")
+
+    @classmethod
+    def from_env(cls) -> "AnnConfig":
+        env = os.environ
+        return cls(
+            kind=env.get("QUARRY_INDEX_TYPE", "flat"),
+            train_threshold=int(env.get("QUARRY_INDEX_TRAIN_THRESHOLD", "50000")),
+            nlist=int(env["QUARRY_IVF_NLIST"]) if env.get("QUARRY_IVF_NLIST") else None,
+            nprobe=int(env.get("QUARRY_IVF_NPROBE", "16")),
+            ef_search=int(env.get("QUARRY_HNSW_EF_SEARCH", "64")),
+        )
+
+
+def index_kind(index) -> str:
+    import faiss  # type: ignore
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    return "flat"
+
+
+def build_index(config: AnnConfig, vectors: np.ndarray):
+    """Create, train (IVF) and fill an index of config.kind over all vectors."""
+    import faiss  # type: ignore
+
+    n, d = vectors.shape
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    if config.kind == "hnsw":
+        index = faiss.IndexHNSWFlat(d, config.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = config.ef_construction
+    elif config.kind in ("ivf_flat", "ivf_pq"):
+        # ~39 training points per list keeps k-means from degenerating
+        nlist = config.nlist or int(4 * math.sqrt(n))
+        nlist = max(1, min(nlist, n // 39 or 1))
+        quantizer = faiss.IndexFlatIP(d)
+        if config.kind == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, config.pq_m, config.pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+    else:
+        index = faiss.IndexFlatIP(d)
+    index.add(vectors)
+    return index
+
+
+def search_params(config: AnnConfig, index, sel=None):
+    import faiss  # type: ignore
+
+    kind = index_kind(index)
+    if kind == "hnsw":
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=config.ef_search)
+    if kind in ("ivf_flat", "ivf_pq"):
+        return faiss.SearchParametersIVF(sel=sel, nprobe=config.nprobe)
+    return faiss.SearchParameters(sel=sel)
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    """64-bit difference hash: survives re-encoding and resizing, not crops or edits."""
+    small = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype="int16")
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value - (1 << 64) if value >= 1 << 63 else value  # SQLite integers are signed
+
+
+class ContentCache:
+    """Content-addressed cache of ingest work, keyed by the SHA-256 of the uploaded bytes.
+
+    Holds OCR output per content hash and embeddings per (hash, model), plus the image id the
+    content was first indexed under, so repeat imports skip Tesseract and the embedder.
+    """
+
+    def __init__(self, path: Path, model_name: str) -> None:
+        self.path = path
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS content (
+                    sha256 TEXT PRIMARY KEY,
+                    phash INTEGER,
+                    image_id TEXT,
+                    text TEXT NOT NULL,
+                    blocks TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS content_phash ON content (phash);
+                CREATE TABLE IF NOT EXISTS vectors (
+                    sha256 TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (sha256, model)
+                );
+                """
+            )
+        # Perceptual hashes of every stored content, loaded on first use and appended to by put()
+        self._phashes: Optional[np.ndarray] = None  # grown by doubling; the first _phash_count are used
+        self._phash_count = 0
+        self._phash_shas: List[str] = []
+        self._phash_seen: Set[str] = set()
+
+    def get(self, sha: str) -> Optional[Dict]:
+        """OCR result and first image id for content, or None if it was never processed."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM content WHERE sha256 = ?", (sha,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "text": row["text"],
+            "blocks": json.loads(row["blocks"]),
+            "width": row["width"],
+            "height": row["height"],
+            "image_id": row["image_id"],
+        }
+
+    def vectors(self, shas: List[str]) -> Dict[str, np.ndarray]:
+        if not shas:
+            return {}
+        marks = ",".join("?" * len(shas))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT sha256, vector FROM vectors WHERE model = ? AND sha256 IN ({marks})", (self.model_name, *shas)
+            ).fetchall()
+        return {r["sha256"]: np.frombuffer(r["vector"], dtype="float32") for r in rows}
+
+    def similar(self, phash: int, max_distance: int) -> List[str]:
+        """Hashes of previously seen content whose perceptual hash is within max_distance bits, nearest first."""
+        with self._lock:
+            if self._phashes is None:
+                self._phashes = np.zeros(0, dtype="int64")
+                rows = self._conn.execute("SELECT sha256, phash FROM content WHERE phash IS NOT NULL").fetchall()
+                self._add_phashes([(r["phash"], r["sha256"]) for r in rows])
+            # Appends past the count (or into a regrown array) never touch this view
+            values, shas = self._phashes[:self._phash_count], self._phash_shas
+        if not len(values):
+            return []
+        xor = (values ^ np.int64(phash)).view("uint8").reshape(-1, 8)
+        distance = np.unpackbits(xor, axis=1).sum(axis=1)
+        near = np.flatnonzero(distance <= max_distance)
+        return [shas[i] for i in near[np.argsort(distance[near], kind="stable")].tolist()]
+
+    def _add_phashes(self, pairs: List[Tuple[int, str]]) -> None:
+        pairs = [(phash, sha) for phash, sha in pairs if sha not in self._phash_seen]
+        if self._phashes is None or not pairs:
+            return
+        need = self._phash_count + len(pairs)
+        if need > len(self._phashes):
+            grown = np.zeros(max(need, 2 * len(self._phashes), 1024), dtype="int64")
+            grown[:self._phash_count] = self._phashes[:self._phash_count]
+            self._phashes = grown
+        self._phashes[self._phash_count:need] = [phash for phash, _ in pairs]
+        self._phash_shas.extend(sha for _, sha in pairs)
+        self._phash_seen.update(sha for _, sha in pairs)
+        self._phash_count = need
+
+    def put(self, entries: List[Dict]) -> None:
+        """Record processed content; each entry has sha256, text, blocks, width, height,
+        and optionally phash, image_id and vector."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO content (sha256, phash, image_id, text, blocks, width, height) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (sha256) DO UPDATE SET image_id = COALESCE(excluded.image_id, image_id), "
+                "phash = COALESCE(excluded.phash, phash)",
+                [
+                    (e["sha256"], e.get("phash"), e.get("image_id"), e["text"], json.dumps(e["blocks"], ensure_ascii=False), e["width"], e["height"])
+                    for e in entries
+                ],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (sha256, model, vector) VALUES (?, ?, ?)",
+                [
+                    (e["sha256"], self.model_name, np.ascontiguousarray(e["vector"], dtype="float32").tobytes())
+                    for e in entries if e.get("vector") is not None
+                ],
+            )
+            self._add_phashes([(e["phash"], e["sha256"]) for e in entries if e.get("phash") is not None])
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
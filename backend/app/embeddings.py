@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from typing import List
+
+import numpy as np
+
+
+EMBEDDING_BACKENDS = ("torch", "onnx", "int8")
+
+# Sentences the consistency check encodes with both the candidate and the reference model
+CHECK_SENTENCES = [
+    "Your booking reference is ABC123 and total $42.00",
+    "Meeting moved to 3pm tomorrow, see agenda slide 4",
+    "TypeError: cannot read property 'length' of undefined",
+    "Flight BA 117 departs London Heathrow at 09:40 from gate 22",
+    "Invoice #2024-118 subtotal 89.90 EUR VAT 17.08",
+    "lunch?",
+]
+
+
+class Encoder:
+    """Sentence embedding model behind one of EMBEDDING_BACKENDS; encode() returns
+    L2-normalized float32 rows."""
+
+    def __init__(self, model_name: str, backend: str = "torch") -> None:
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"unknown embedding backend {backend!r}; expected one of {', '.join(EMBEDDING_BACKENDS)}")
+        # Imported here: sentence-transformers pulls in torch, which takes seconds
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self.backend = backend
+        if backend == "onnx":
+            try:
+                self.model = SentenceTransformer(model_name, backend="onnx")
+            except (TypeError, ImportError) as e:
+                raise RuntimeError("the onnx backend needs sentence-transformers>=3.2 with onnxruntime (pip install 'sentence-transformers[onnx]')") from e
+        else:
+            self.model = SentenceTransformer(model_name, device="cpu" if backend == "int8" else None)
+            if backend == "int8":
+                import torch
+
+                # Dynamic int8 quantization of every Linear layer: weights stored as int8,
+                # activations quantized on the fly; CPU only
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        dim = getattr(self.model, "get_embedding_dimension", None) or self.model.get_sentence_embedding_dimension
+        self.dim = int(dim())
+
+    @property
+    def cache_key(self) -> str:
+        # Cached vectors from another backend differ slightly, so they are kept apart
+        return self.model_name if self.backend == "torch" else f"{self.model_name}@{self.backend}"
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        emb = self.model.encode(texts, batch_size=max(1, batch_size), normalize_embeddings=True)
+        return np.asarray(emb, dtype="float32").reshape(len(texts), -1)
+
+
+def consistency(candidate: Encoder, reference: Encoder, texts: List[str] = CHECK_SENTENCES) -> float:
+    """Lowest cosine similarity between the two models' embeddings of the same texts."""
+    a = candidate.encode(texts)
+    b = reference.encode(texts)
+    return float(np.min(np.sum(a * b, axis=1)))
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional
+
+
+def _norm(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def _merge_bbox(boxes: List[Dict]) -> Dict:
+    x0 = min(b["x"] for b in boxes)
+    y0 = min(b["y"] for b in boxes)
+    x1 = max(b["x"] + b["w"] for b in boxes)
+    y1 = max(b["y"] + b["h"] for b in boxes)
+    return {"x": x0, "y": y0, "w": x1 - x0, "h": y1 - y0}
+
+
+def entity_block_map(blocks: List[Dict], entities: Optional[Dict[str, List[str]]]) -> Dict:
+    """Locate each entity value in the OCR blocks, including values that span several blocks.
+
+    Returns "entity_block_idxs" (entity type -> sorted block indexes, as the detail view
+    expects) and "entity_spans" (one entry per occurrence with its merged bounding box).
+    """
+    # Blocks joined with single spaces, remembering which characters belong to which block
+    starts: List[int] = []
+    ends: List[int] = []
+    parts: List[str] = []
+    pos = 0
+    for b in blocks:
+        text = _norm(str(b.get("text", "")))
+        starts.append(pos)
+        ends.append(pos + len(text))
+        parts.append(text)
+        pos += len(text) + 1
+    joined = " ".join(parts)
+
+    idxs: Dict[str, List[int]] = {}
+    spans: List[Dict] = []
+    for etype, values in (entities or {}).items():
+        hits = set()
+        for value in values:
+            needle = _norm(value)
+            if not needle:
+                continue
+            at = joined.find(needle)
+            while at >= 0:
+                stop = at + len(needle)
+                # Blocks overlapping [at, stop): both boundaries are sorted, so this is two bisects
+                covered = [i for i in range(bisect_right(ends, at), bisect_left(starts, stop)) if ends[i] > starts[i]]
+                if covered:
+                    hits.update(covered)
+                    boxes = [blocks[i]["bbox"] for i in covered if blocks[i].get("bbox")]
+                    spans.append({
+                        "type": etype,
+                        "value": value,
+                        "blocks": covered,
+                        "bbox": _merge_bbox(boxes) if boxes else None,
+                    })
+                at = joined.find(needle, at + 1)
+        if hits:
+            idxs[etype] = sorted(hits)
+    return {"entity_block_idxs": idxs, "entity_spans": spans}
@@ -1,122 +1,862 @@
 from __future__ import annotations
 
+import copy
 import io
 import json
+import logging
 import os
-from dataclasses import dataclass, asdict
+import shutil
+import threading
+import time
+from dataclasses import asdict, replace
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import faiss  # type: ignore
 from PIL import Image
-import pytesseract
-from sentence_transformers import SentenceTransformer
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+
+from .content_cache import ContentCache, content_hash, perceptual_hash
+from .highlights import entity_block_map
+from .ocr import OcrConfig, get_engine, ocr_image, warm_engine
+from .embeddings import Encoder
+from .lexical import LexicalIndex, reciprocal_rank_fusion
+from .metastore import NO_TIME, ImageMeta, MetaStore
+from .ann import AnnConfig, build_index, index_kind, search_params
+from .query_encoder import QueryEncoder
+from .rwlock import RWLock
+from .snapshots import acquire_writer_lock, publish_snapshot, read_snapshot
+from .storage import VECTOR_DTYPES, BlobLog, FlatVectorIndex, IdLog, MetaLog, SnapshotChanged, VectorLog, atomic_write_bytes, fsync_dir
+
+
+log = logging.getLogger("quarry")
 
 
 DEFAULT_DATA_DIR = Path(os.environ.get("QUARRY_DATA_DIR", "./data")).resolve()
 DEFAULT_DATA_DIR.mkdir(parents=True, exist_ok=True)
 
+SEARCH_MODES = ("hybrid", "semantic", "lexical")
+
+# Everything a read-only replica reopens when it moves to a new generation of files
+_SNAPSHOT_STATE = ("vector_dtype", "vectors_path", "metas", "vector_log", "index", "ocr_log", "tombstones", "_dead", "_next_id", "lexical", "ann_index", "_ann_checkpointed", "snapshot")
+
+
+def _encode_jpeg(image: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def _decode_and_ocr(content: bytes, config: OcrConfig) -> Dict:
+    # Runs in OCR worker processes: decode, OCR and JPEG re-encode one upload
+    image = Image.open(io.BytesIO(content)).convert("RGB")
+    text, blocks, timings = ocr_image(image, config)
+    return {"text": text, "blocks": blocks, "width": image.width, "height": image.height, "jpeg": _encode_jpeg(image), "timings": timings}
+
+
+def _decode(content: bytes) -> Dict:
+    # Content whose OCR result is cached only needs its preview re-encoded
+    image = Image.open(io.BytesIO(content)).convert("RGB")
+    return {"width": image.width, "height": image.height, "jpeg": _encode_jpeg(image)}
+
+
+def fuse(semantic: List[Tuple[Any, float]], lexical: List[Tuple[Any, float]], k: int, mode: str) -> List[Tuple[Any, float]]:
+    """Top k of one ranked candidate list, or of both fused by reciprocal rank (hybrid)."""
+    if mode == "semantic":
+        return semantic[:k]
+    if mode == "lexical":
+        return lexical[:k]
+    return reciprocal_rank_fusion(semantic, lexical)[:k]
 
-@dataclass
-class ImageMeta:
-    id: str
-    filename: str
-    text: str
-    width: int
-    height: int
-    collection: Optional[str] = None
-    imported_at: str = ""  # ISO 8601
-    type_label: Optional[str] = None
-    entities: Optional[Dict[str, List[str]]] = None
+
+def _date_bounds(start_date: Optional[str], end_date: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+    """Whole-day [start, end] bounds as epoch seconds [lo, hi), UTC."""
+    def day_start(value: str, days: int = 0) -> int:
+        day = datetime.fromisoformat(value).date() + timedelta(days=days)
+        return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+    try:
+        lo = day_start(start_date) if start_date else None
+        hi = day_start(end_date, 1) if end_date else None
+    except ValueError:
+        return None, None  # invalid bounds never filtered anything
+    return lo, hi
 
 
 class ScreenshotIndexer:
-    def __init__(self, data_dir: Path = DEFAULT_DATA_DIR, model_name: str = "sentence-transformers/all-MiniLM-L6-v2") -> None:
+    def __init__(self, data_dir: Path = DEFAULT_DATA_DIR, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", ocr_workers: Optional[int] = None, batch_size: int = 32, index_config: Optional[AnnConfig] = None, readonly: bool = False, parent: Optional[ScreenshotIndexer] = None) -> None:
         self.data_dir = data_dir
-        self.model = SentenceTransformer(model_name)
-        self.dim = self.model.get_sentence_embedding_dimension()
+        # A shard of a ShardedIndexer (parent: the library's root indexer) keeps its own
+        # vectors, metadata and postings but shares the model, query cache, content cache,
+        # OCR pool, images dir and id counter with the root
+        self.parent = parent
+        self.shard = data_dir.name if parent is not None else ""
+        # One process writes a data dir and publishes a snapshot.json after every change;
+        # read-only replicas (other workers or hosts on the same volume) serve searches from it
+        self.readonly = readonly
+        if not readonly:
+            self.data_dir.mkdir(parents=True, exist_ok=True)
+            acquire_writer_lock(self.data_dir)
+        self.snapshot: Dict = read_snapshot(self.data_dir) or {"version": 0, "generation": 0}
+        self.snapshot_poll = float(os.environ.get("QUARRY_SNAPSHOT_POLL", "1.0"))
+        self._follower: Optional[threading.Thread] = None
+        self._refresh_listeners: List[Callable[[], None]] = []
+        # torch, onnx or int8 (dynamically quantized) encoder; vectors stored as float32, float16 or int8
+        self.encoder = parent.encoder if parent is not None else Encoder(model_name, os.environ.get("QUARRY_EMBEDDING_BACKEND", "torch"))
+        self.dim = self.encoder.dim
+        self.vector_dtype = os.environ.get("QUARRY_VECTOR_DTYPE", "float32")
+        if self.vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(f"unknown vector dtype {self.vector_dtype!r}; expected one of {', '.join(VECTOR_DTYPES)}")
+        # Repeat and concurrent queries (album views, type-ahead) share encode calls
+        self.query_encoder = parent.query_encoder if parent is not None else QueryEncoder(
+            self.encoder.encode,
+            self.encoder.cache_key,
+            cache_size=int(os.environ.get("QUARRY_QUERY_CACHE_SIZE", "2048")),
+            ttl=float(os.environ.get("QUARRY_QUERY_CACHE_TTL", "600")),
+            batch_window=float(os.environ.get("QUARRY_QUERY_BATCH_MS", "3")) / 1000,
+        )
 
         self.index_path = self.data_dir / "index.faiss"
         self.meta_path = self.data_dir / "meta.jsonl"
-        self.images_dir = self.data_dir / "images"
+        self.vectors_path = self.data_dir / f"vectors.{VECTOR_DTYPES[self.vector_dtype][2]}"
+        self.images_dir = parent.images_dir if parent is not None else self.data_dir / "images"
         self.images_dir.mkdir(parents=True, exist_ok=True)
-        self.ocr_dir = self.data_dir / "ocr"
-        self.ocr_dir.mkdir(parents=True, exist_ok=True)
+        self.ocr_path = self.data_dir / "ocr.seg"
+        self.ocr_dir = self.data_dir / "ocr"  # legacy one-JSON-file-per-image layout
 
-        self.id_to_offset: Dict[str, int] = {}
-        self.metas: List[ImageMeta] = []
+        # Tesseract is single-threaded per call, so bulk OCR fans out over processes
+        if ocr_workers is None:
+            ocr_workers = int(os.environ.get("QUARRY_OCR_WORKERS", os.cpu_count() or 1))
+        self.ocr_workers = ocr_workers
+        self.ocr_config = OcrConfig.from_env()
+        self._ocr_timings: Dict[str, float] = {"images": 0}
+        self.batch_size = batch_size
+        self._ocr_pool = None
+        self._prep_lock = threading.Lock()  # the OCR pool and timing counters are shared by ingest workers
 
-        if self.index_path.exists() and self.meta_path.exists():
-            self._load()
+        # vectors.f32 is always searchable exactly; an ANN index takes over past train_threshold
+        self.ann = index_config or AnnConfig.from_env()
+        self.ann_index = None
+        self._ann_checkpointed = 0
+
+        # Lexical (BM25) postings are checkpointed every this many new documents
+        self.lexical_checkpoint_every = 10000
+        self.rrf_depth = 50
+
+        # Identical uploads link to the existing image; QUARRY_DEDUP_PHASH_DISTANCE also catches re-encoded copies
+        self.dedup = os.environ.get("QUARRY_DEDUP", "1") != "0"
+        phash_distance = os.environ.get("QUARRY_DEDUP_PHASH_DISTANCE")
+        self.phash_distance: Optional[int] = int(phash_distance) if phash_distance else None
+        self.content_cache = parent.content_cache if parent is not None else ContentCache(self.data_dir / "content.sqlite3", self.encoder.cache_key)
+
+        self._ingest_listeners: List[Callable[[ScreenshotIndexer, List[int], Any], None]] = []
+
+        # Deletes are tombstoned; once they make up this share of the rows (and at least
+        # compact_min of them) a background compaction drops them from every segment
+        self.compact_ratio = float(os.environ.get("QUARRY_COMPACT_RATIO", "0.2"))
+        self.compact_min = int(os.environ.get("QUARRY_COMPACT_MIN", "1000"))
+        self._compactor: Optional[threading.Thread] = None
+
+        # One writer at a time (ingest commits, deletes, edits, compaction) under _write_lock;
+        # searches share _rw and are excluded only while a writer swaps or appends in-memory
+        # state, not while it runs OCR, embeds, fsyncs checkpoints or trains an index
+        self._write_lock = threading.RLock()
+        self._rw = RWLock()
+        self._id_lock = threading.Lock()
+
+        if readonly:
+            self._open_snapshot()
         else:
-            self.index = faiss.IndexFlatIP(self.dim)
+            self._load()
+            self._publish()
 
     # ---------- persistence ----------
     def _load(self) -> None:
-        self.index = faiss.read_index(str(self.index_path))
-        with self.meta_path.open("r", encoding="utf-8") as f:
-            for i, line in enumerate(f):
-                meta = ImageMeta(**json.loads(line))
-                self.metas.append(meta)
-                self.id_to_offset[meta.id] = i
+        if self.readonly:
+            return self._load_snapshot()
+        self._finish_compaction()
+        # Metadata is parsed lazily per row; vectors are searched through a read-only mmap
+        self.metas = MetaStore(self.data_dir, cache_size=int(os.environ.get("QUARRY_META_CACHE_SIZE", "4096")))
+        if not self.vectors_path.exists():
+            self._migrate_vectors()
+        self.vector_log = VectorLog(self.vectors_path, self.dim, self.vector_dtype)
+
+        # Vectors are appended before their meta lines, so a crash can leave extra vectors
+        n = len(self.metas)
+        if len(self.vector_log) > n:
+            self.vector_log.truncate(n)
+        elif len(self.vector_log) < n:
+            raise RuntimeError(f"{self.vectors_path} holds {len(self.vector_log)} vectors for {n} metas")
+        self.index = FlatVectorIndex(self.vector_log)
+        self._load_ids()
+        self._load_ocr()
+        self._load_lexical()
+        self._load_ann()
+
+    def _load_ids(self) -> None:
+        # Ids are never reused, even for rows compaction dropped from the end of the log
+        ids = self.metas.columns()["id"]
+        next_path = self.data_dir / "next_id"
+        floor = int(next_path.read_text(encoding="utf-8")) if next_path.exists() else 0
+        self._next_id = max(int(ids[-1]) + 1 if len(ids) else 0, floor)
+        self.tombstones = IdLog(self.data_dir / "tombstones.i8")
+        self._dead = self._dead_rows(ids, self.tombstones.read())
+
+    @staticmethod
+    def _dead_rows(ids, deleted):
+        # Sorted offsets of deleted rows, excluded from every read path
+        import numpy as np
+
+        if not len(ids):
+            return np.zeros(0, dtype="int64")
+        rows = np.minimum(np.searchsorted(ids, deleted), len(ids) - 1)
+        return np.unique(rows[ids[rows] == deleted]).astype("int64")
+
+    def _migrate_vectors(self) -> None:
+        for dtype, (_, _, suffix) in VECTOR_DTYPES.items():
+            other = self.data_dir / f"vectors.{suffix}"
+            if other.exists():
+                # Stored at another precision: convert once, then drop the old segment
+                VectorLog(self.vectors_path, self.dim, self.vector_dtype).rewrite(VectorLog(other, self.dim, dtype).read())
+                other.unlink()
+                return
+        if self.index_path.exists():
+            # Pre-segment layout: the FAISS file was the only copy of the vectors
+            import faiss  # type: ignore
+
+            legacy = faiss.read_index(str(self.index_path))
+            self.vectors_path.write_bytes(b"")
+            VectorLog(self.vectors_path, self.dim, self.vector_dtype).append(legacy.reconstruct_n(0, legacy.ntotal))
+            if index_kind(legacy) == "flat":
+                self.index_path.unlink()
+
+    def _load_ocr(self) -> None:
+        self.ocr_log = BlobLog(self.ocr_path)
+        n = len(self.metas)
+        if len(self.ocr_log) > n:
+            self.ocr_log.truncate(n)
+        elif len(self.ocr_log) < n:
+            self._import_ocr_dir(len(self.ocr_log), n)
+
+    def _import_ocr_dir(self, start: int, stop: int) -> None:
+        # Pack ocr/{id}.json documents into the segment, resolving highlights they predate
+        for i in range(start, stop):
+            meta = self.metas[i]
+            path = self.ocr_dir / f"{meta.id}.json"
+            data = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {"blocks": []}
+            if "entity_block_idxs" not in data:
+                data.update(entity_block_map(data.get("blocks", []), meta.entities))
+            self.ocr_log.append(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        self.ocr_log.flush()
+
+    def _load_lexical(self) -> None:
+        self.lexical = LexicalIndex(self.data_dir / "lexical")
+        n = len(self.metas)
+        if len(self.lexical) > n:
+            self.lexical.reset()
+        # Index documents written since the last lexical checkpoint
+        start = len(self.lexical)
+        for i in range(start, n):
+            meta = self.metas[i]
+            self.lexical.add(i, meta.text, meta.entities)
+        if n - start >= self.lexical_checkpoint_every:
+            self.lexical.checkpoint()
+
+    def _load_ann(self) -> None:
+        n = len(self.metas)
+        if self.ann.kind != "flat" and self.index_path.exists():
+            import faiss  # type: ignore
+
+            ann_index = faiss.read_index(str(self.index_path))
+            # A checkpoint of another type (or from a longer, truncated log) is rebuilt instead
+            if index_kind(ann_index) == self.ann.kind and ann_index.ntotal <= n:
+                self._ann_checkpointed = ann_index.ntotal
+                # Replay vectors added since the last checkpoint
+                if ann_index.ntotal < n:
+                    ann_index.add(self.vector_log.read(ann_index.ntotal, n))
+                self.ann_index = ann_index
+        if self.ann_index is None and self.ann.kind != "flat" and n >= self.ann.train_threshold:
+            self.rebuild_index()
+
+    # ---------- snapshots ----------
+    def _publish(self) -> None:
+        """Describe the saved state in snapshot.json, for read-only replicas to move to.
+
+        Rows are only ever appended, so a snapshot is a row count per log; compaction, which
+        rewrites them, starts a new generation.
+        """
+        manifest = {
+            "version": self.snapshot["version"] + 1,
+            "generation": self.snapshot["generation"],
+            "rows": self.metas.saved,
+            "patch_bytes": self.metas.patch_bytes,
+            "tombstones": len(self.tombstones),
+            "lexical": self.lexical.checkpointed,
+            "ann": self._ann_checkpointed if self.ann_index is not None else 0,
+            "vector_dtype": self.vector_dtype,
+            "meta_file": self.metas.file_id(),
+            "next_id": self._next_id,
+            "published_at": time.time(),
+        }
+        publish_snapshot(self.data_dir, manifest)
+        self.snapshot = manifest
+
+    def _open_snapshot(self) -> None:
+        while True:
+            try:
+                return self._load()
+            except (SnapshotChanged, OSError) as e:
+                # No writer has published yet, or it moved on while this replica was opening
+                log.info("waiting for a snapshot: %s", e)
+                time.sleep(self.snapshot_poll)
+
+    def _load_snapshot(self) -> None:
+        """Open the last published snapshot read-only: later rows stay invisible, nothing on disk changes."""
+        snap = read_snapshot(self.data_dir)
+        if snap is None:
+            raise SnapshotChanged(f"no snapshot published in {self.data_dir} yet")
+        rows = snap["rows"]
+        # Stored at the writer's precision, whatever this process was configured with
+        self.vector_dtype = snap["vector_dtype"]
+        self.vectors_path = self.data_dir / f"vectors.{VECTOR_DTYPES[self.vector_dtype][2]}"
+        self.metas = MetaStore(self.data_dir, cache_size=int(os.environ.get("QUARRY_META_CACHE_SIZE", "4096")), rows=rows, patch_bytes=snap["patch_bytes"])
+        self.vector_log = VectorLog(self.vectors_path, self.dim, self.vector_dtype, repair=False)
+        self.index = FlatVectorIndex(self.vector_log, rows=rows)
+        if self.index.ntotal < rows:
+            raise SnapshotChanged(f"{self.vectors_path} holds fewer than {rows} vectors")
+        self.ocr_log = BlobLog(self.ocr_path, rows=rows)
+        self.tombstones = IdLog(self.data_dir / "tombstones.i8", repair=False)
+        self._dead = self._dead_rows(self.metas.columns()["id"], self.tombstones.read(snap["tombstones"]))
+        self._next_id = snap["next_id"]
+        self.lexical = self._replica_lexical(rows, self.metas.__getitem__)
+        self.ann_index, self._ann_checkpointed = self._replica_ann(snap) or (None, 0)
+        self._verify_snapshot(snap)
+        self.snapshot = snap
+
+    def _replica_lexical(self, rows: int, row: Callable[[int], ImageMeta]) -> LexicalIndex:
+        # The writer's last BM25 checkpoint plus the documents added since, in memory
+        lexical = LexicalIndex(self.data_dir / "lexical")
+        if len(lexical) > rows:
+            raise SnapshotChanged("the lexical checkpoint is newer than the snapshot")
+        for i in range(len(lexical), rows):
+            meta = row(i)
+            lexical.add(i, meta.text, meta.entities)
+        return lexical
+
+    def _replica_ann(self, snap: Dict) -> Optional[Tuple[Any, int]]:
+        # The writer's ANN checkpoint with the snapshot's later vectors replayed, or None (exact search)
+        if not snap["ann"] or not self.index_path.exists():
+            return None
+        import faiss  # type: ignore
+
+        ann_index = faiss.read_index(str(self.index_path))
+        checkpointed = ann_index.ntotal
+        if checkpointed > snap["rows"]:
+            return None  # already checkpointed past this snapshot; picked up with a later one
+        if checkpointed < snap["rows"]:
+            ann_index.add(self.vector_log.read(checkpointed, snap["rows"]))
+        return ann_index, checkpointed
+
+    def _verify_snapshot(self, snap: Dict) -> None:
+        # Compaction replaces meta.jsonl before any other file, while compact.json exists: if
+        # neither happened, every file read for this snapshot belonged to its generation
+        if (self.data_dir / "compact.json").exists() or not self.metas.file_id() == os.stat(self.meta_path).st_ino == snap["meta_file"]:
+            raise SnapshotChanged("the data dir was compacted while the snapshot was read")
+
+    def refresh(self) -> bool:
+        """Move a read-only replica to the newest published snapshot; True if it moved.
+
+        Appended rows, edits and deletes are read in place and swapped in at once; after a
+        compaction (a new generation) the replica reopens every file. Searches keep using the
+        previous snapshot until the swap. Raises SnapshotChanged if the writer moved on while
+        the snapshot was read; the next call picks up the newer one.
+        """
+        snap = read_snapshot(self.data_dir)
+        if snap is None or snap["version"] == self.snapshot["version"]:
+            return False
+        with self._write_lock:
+            same_files = snap["generation"] == self.snapshot["generation"] and snap["meta_file"] == self.snapshot["meta_file"]
+            if same_files and snap["rows"] >= self.metas.saved:
+                self._catch_up(snap)
+            else:
+                self._reopen()
+        for listener in self._refresh_listeners:
+            listener()
+        return True
+
+    def _catch_up(self, snap: Dict) -> None:
+        import numpy as np
+
+        # Read everything new without the lock, then swap it in
+        rows, start = snap["rows"], self.metas.saved
+        delta = self.metas.read_delta(rows, snap["patch_bytes"])
+        ocr_entries = self.ocr_log.read_index(start, rows)
+        added = [self.metas.read_row(int(offset)) for offset in delta["cols"]["offset"]]
+        ids = np.concatenate([self.metas.columns()["id"], delta["cols"]["id"]])
+        dead = self._dead_rows(ids, self.tombstones.read(snap["tombstones"]))
+        lexical = None
+        if snap["lexical"] != self.snapshot["lexical"]:
+            # The writer checkpointed its postings: take them over instead of growing ours
+            row: Callable[[int], ImageMeta] = lambda i: self.metas[i] if i < start else added[i - start]
+            try:
+                lexical = self._replica_lexical(rows, row)
+            except (SnapshotChanged, OSError):
+                lexical = None  # checkpointed again meanwhile; keep adding to the current postings
+        ann = None
+        if snap["ann"] and (self.ann_index is None or snap["ann"] != self.snapshot["ann"]):
+            ann = self._replica_ann(snap)
+        vectors = self.vector_log.read(start, rows) if ann is None and self.ann_index is not None else None
+        self._verify_snapshot(snap)
+
+        with self._rw.write():
+            self.metas.apply_delta(delta)
+            self.index.grow(rows)
+            self.ocr_log.extend(ocr_entries)
+            self._dead = dead
+            self._next_id = snap["next_id"]
+            if lexical is not None:
+                self.lexical = lexical
+            else:
+                for i, meta in enumerate(added, start):
+                    self.lexical.add(i, meta.text, meta.entities)
+            if ann is not None:
+                self.ann_index, self._ann_checkpointed = ann
+            elif vectors is not None:
+                self.ann_index.add(vectors)
+            self.snapshot = snap
+
+    def _reopen(self) -> None:
+        # A shallow copy opens the new generation while searches keep using this one
+        shadow = copy.copy(self)
+        shadow._load()
+        with self._rw.write():
+            for name in _SNAPSHOT_STATE:
+                setattr(self, name, getattr(shadow, name))
+
+    def follow(self) -> None:
+        """Poll for new snapshots every snapshot_poll seconds in a background thread (read-only replicas)."""
+        if self._follower is not None:
+            return
+        self._follower = threading.Thread(target=self._follow, name="quarry-follow", daemon=True)
+        self._follower.start()
+
+    def _follow(self) -> None:
+        while True:
+            time.sleep(self.snapshot_poll)
+            try:
+                self.refresh()
+            except SnapshotChanged:
+                pass  # retried with the writer's next snapshot
+            except Exception:
+                log.exception("snapshot refresh failed")
+
+    def add_refresh_listener(self, listener: Callable[[], None]) -> None:
+        """Call listener() after a read-only replica moved to a new snapshot."""
+        self._refresh_listeners.append(listener)
+
+    def _writable(self) -> None:
+        if self.readonly:
+            raise RuntimeError("read-only replica: uploads, deletes and edits go to the writer process")
 
     def save(self) -> None:
-        faiss.write_index(self.index, str(self.index_path))
-        with self.meta_path.open("w", encoding="utf-8") as f:
-            for meta in self.metas:
-                f.write(json.dumps(asdict(meta), ensure_ascii=False) + "\n")
+        """Persist only what changed: append OCR documents and new vectors, then the new meta lines."""
+        self._writable()
+        with self._write_lock:
+            with self._rw.write():
+                self.ocr_log.flush()
+                self.index.flush()
+                self.metas.flush()
+            if self.lexical.pending >= self.lexical_checkpoint_every:
+                self.lexical.checkpoint(self._rw.write())
+            if self.ann_index is None:
+                if self.ann.kind != "flat" and self.index.ntotal >= self.ann.train_threshold:
+                    self.rebuild_index()
+            elif self._ann_checkpointed + self.ann.checkpoint_every <= self.ann_index.ntotal:
+                self.checkpoint()
+            self._publish()
+
+    def rebuild_index(self) -> None:
+        """(Re)train the configured ANN index over every stored vector and checkpoint it."""
+        self._writable()
+        with self._write_lock:
+            if self.ann.kind == "flat":
+                with self._rw.write():
+                    self.ann_index = None
+                self.index_path.unlink(missing_ok=True)
+                self._publish()
+                return
+            # Trained while searches keep using the previous index (or exact search)
+            ann_index = build_index(self.ann, self.index.reconstruct_n(0, self.index.ntotal))
+            with self._rw.write():
+                self.ann_index = ann_index
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        self._writable()
+        with self._write_lock:
+            if self.ann_index is None:
+                return  # the flat index is the vector segment itself
+            # Write-then-rename so a crash mid-write leaves the previous checkpoint intact
+            import faiss  # type: ignore
+
+            tmp = self.index_path.with_name(self.index_path.name + ".tmp")
+            faiss.write_index(self.ann_index, str(tmp))
+            with tmp.open("rb+") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, self.index_path)
+            fsync_dir(self.data_dir)
+            self._ann_checkpointed = self.ann_index.ntotal
+            self._publish()
+
+    def compact(self) -> None:
+        """Rewrite the meta log, vector and OCR segments without deleted rows, with edits folded in.
+
+        New copies are written beside the live files and swapped in under a marker, so a crash
+        leaves either the old set or (finished on the next open) the new one. Derived files
+        (columns, BM25 postings, ANN checkpoint) are rebuilt from the new copies.
+        """
+        import numpy as np
+
+        self._writable()
+        with self._write_lock:
+            self.save()
+            n = len(self.metas)
+            live = self._live_mask()
+            self._remove_staged()
+            swaps: Dict[str, str] = {}  # staged copy -> file it replaces
+
+            def staged(path: Path) -> Path:
+                swaps[path.name + ".compact"] = path.name
+                return path.with_name(path.name + ".compact")
+
+            MetaLog(staged(self.meta_path)).rewrite([asdict(m) for m, keep in zip(self.metas.iter_from(0), live) if keep])
+            vectors = VectorLog(staged(self.vectors_path), self.dim, self.vector_dtype)
+            vectors.path.write_bytes(b"")
+            step = FlatVectorIndex.chunk_rows
+            for lo in range(0, n, step):
+                vectors.append(self.index.reconstruct_n(lo, step)[live[lo:lo + step]])
+            ocr = BlobLog(staged(self.ocr_path))
+            swaps[ocr.index_path.name] = self.ocr_log.index_path.name
+            for i in np.flatnonzero(live).tolist():
+                ocr.append(self.ocr_log.get(i))
+            ocr.flush()
+            for path in (self.metas.patch_log.path, self.tombstones.path):
+                staged(path).write_bytes(b"")
+            atomic_write_bytes(self.data_dir / "next_id", str(self._next_id).encode("utf-8"))
+
+            atomic_write_bytes(self.data_dir / "compact.json", json.dumps(swaps).encode("utf-8"))
+            # The new generation is opened, and its derived indexes rebuilt, in a shallow copy
+            # while searches keep reading the replaced files; they pause only for the swap
+            shadow = copy.copy(self)
+            shadow.ann_index, shadow._ann_checkpointed = None, 0
+            shadow._load()
+            shadow.lexical.checkpoint()
+            with self._rw.write():
+                self.metas.close()
+                self.vector_log.close()
+                self.ocr_log.close()
+                for name in _SNAPSHOT_STATE:
+                    setattr(self, name, getattr(shadow, name))
+            # A new generation: replicas reopen every file rather than catching up
+            self._publish()
+
+    def _finish_compaction(self) -> None:
+        marker = self.data_dir / "compact.json"
+        if not marker.exists():
+            self._remove_staged()  # copies from a compaction that never committed
+            return
+        self.snapshot = dict(self.snapshot, generation=self.snapshot["generation"] + 1)
+        for tmp, target in json.loads(marker.read_text(encoding="utf-8")).items():
+            if (self.data_dir / tmp).exists():
+                os.replace(self.data_dir / tmp, self.data_dir / target)
+        # Row offsets changed: everything derived from them is rebuilt on load
+        shutil.rmtree(self.data_dir / "meta.cols", ignore_errors=True)
+        shutil.rmtree(self.data_dir / "lexical", ignore_errors=True)
+        self.index_path.unlink(missing_ok=True)
+        fsync_dir(self.data_dir)
+        marker.unlink()
+
+    def _remove_staged(self) -> None:
+        for tmp in self.data_dir.glob("*.compact*"):
+            tmp.unlink()
+
+    def compaction_due(self) -> bool:
+        dead = len(self._dead)
+        return dead >= self.compact_min and dead >= self.compact_ratio * len(self.metas)
+
+    def _schedule_compaction(self) -> None:
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, name="quarry-compact", daemon=True)
+        self._compactor.start()
+
+    # ---------- deletes and edits ----------
+    def delete(self, image_ids: List[str], remove_images: bool = True) -> List[str]:
+        """Tombstone screenshots: hidden from every read at once, storage reclaimed by compaction.
+
+        Returns the ids that were deleted (unknown and already deleted ids are skipped).
+        remove_images=False keeps their image files, for rows moved to another shard.
+        """
+        import numpy as np
+
+        self._writable()
+        with self._write_lock, self._rw.write():
+            found: Dict[int, str] = {}
+            for image_id in image_ids:
+                offset = self._offset(image_id)
+                if offset is not None:
+                    found[offset] = self.metas[offset].id
+            if not found:
+                return []
+            self.tombstones.append([int(image_id) for image_id in found.values()])
+            self._dead = np.union1d(self._dead, np.fromiter(found, dtype="int64"))
+            for image_id in found.values() if remove_images else ():
+                (self.images_dir / f"{image_id}.jpg").unlink(missing_ok=True)
+            self._publish()
+            if self.compaction_due():
+                self._schedule_compaction()
+        return list(found.values())
+
+    def update(self, image_id: str, **fields) -> Optional[Dict]:
+        """Edit a screenshot's filename, collection or type label; None if the id is unknown."""
+        self._writable()
+        with self._write_lock:
+            offset = self._offset(image_id)
+            if offset is None:
+                return None
+            if "filename" in fields and not fields["filename"]:
+                raise ValueError("filename cannot be empty")
+            self.save()  # edits apply to saved rows
+            with self._rw.write():
+                payload = self._ingest_payload(self.metas.update(offset, fields))
+            self._publish()
+        payload.pop("duplicate")
+        return payload
+
+    def count(self) -> int:
+        """Screenshots in the library, not counting deleted ones."""
+        with self._rw.read():
+            return len(self.metas) - len(self._dead)
 
     # ---------- core ops ----------
     def _ocr(self, image: Image.Image) -> str:
-        # Simple OCR using Tesseract; users may configure TESSDATA_PREFIX externally
-        text = pytesseract.image_to_string(image)
-        return text.strip()
+        # Plain text through the configured engine; users may configure TESSDATA_PREFIX externally
+        return self._ocr_with_blocks(image)[0]
 
     def _embed(self, text: str) -> List[float]:
-        emb = self.model.encode([text], normalize_embeddings=True)[0]
-        return emb.astype("float32").tolist()  # type: ignore
+        return self._embed_batch([text])[0].tolist()
+
+    def _embed_batch(self, texts: List[str]):
+        # One encode call per ingest batch; returns a (len(texts), dim) float32 array
+        return self.encoder.encode(texts, batch_size=len(texts))
 
     def index_image_bytes(self, content: bytes, filename: str, collection: Optional[str] = None) -> Dict:
+        return self._ingest([(content, filename)], collection)[0]
+
+    def index_images_bytes(self, items: List[Tuple[bytes, str]], collection: Optional[str] = None) -> List[Dict]:
+        """Staged bulk ingest: parallel decode/OCR, one encode, one FAISS add and one save per batch."""
+        out: List[Dict] = []
+        for start in range(0, len(items), self.batch_size):
+            out.extend(self._ingest(items[start:start + self.batch_size], collection))
+            self.save()
+        return out
+
+    def _ingest(self, items: List[Tuple[bytes, str]], collection: Optional[str]) -> List[Dict]:
+        """Dedup by content hash, OCR and embed only uncached content, then commit the rest.
+
+        Everything up to the commit runs without locks, so concurrent ingest workers overlap
+        on OCR and embedding and serialize only on the commit itself.
+        """
+        import numpy as np
+
+        self._writable()
+        results: List[Optional[Dict]] = [None] * len(items)
+        shas = [content_hash(content) for content, _ in items]
+        phashes: Dict[str, int] = {}
+        first: Dict[str, int] = {}  # content hash -> position committed for it
+        todo: List[int] = []
+        for i, (content, _) in enumerate(items):
+            sha = shas[i]
+            if self.dedup:
+                if sha in first:
+                    continue  # linked to the first copy in this batch below
+                existing = self._indexed(sha)
+                if existing is None and self.phash_distance is not None:
+                    phashes[sha] = perceptual_hash(Image.open(io.BytesIO(content)))
+                    # Nearest first; a match that was deleted since gives way to the next live one
+                    for similar in self.content_cache.similar(phashes[sha], self.phash_distance):
+                        existing = self._indexed(similar)
+                        if existing is not None:
+                            break
+                if existing is not None:
+                    results[i] = dict(self._ingest_payload(existing), duplicate=True)
+                    continue
+            first[sha] = i
+            todo.append(i)
+
+        if todo:
+            cached = {shas[i]: self.content_cache.get(shas[i]) for i in todo}
+            prepared = self._prepare_many([items[i][0] for i in todo], [cached[shas[i]] for i in todo])
+            vectors = self.content_cache.vectors([shas[i] for i in todo])
+            missing = [j for j, i in enumerate(todo) if shas[i] not in vectors]
+            if missing:
+                for j, vec in zip(missing, self._embed_batch([prepared[j]["text"] for j in missing])):
+                    vectors[shas[todo[j]]] = vec
+            with self._write_lock:
+                with self._rw.write():
+                    if self.dedup:
+                        # Another worker may have committed the same content since the lookup above
+                        fresh = []
+                        for j, i in enumerate(todo):
+                            existing = self._indexed(shas[i])
+                            if existing is None:
+                                fresh.append(j)
+                            else:
+                                results[i] = dict(self._ingest_payload(existing), duplicate=True)
+                        todo, prepared = [todo[j] for j in fresh], [prepared[j] for j in fresh]
+                    vec_np = np.ascontiguousarray([vectors[shas[i]] for i in todo], dtype="float32").reshape(len(todo), self.dim)
+                    committed = self._commit(prepared, [items[i][1] for i in todo], vec_np, collection, [shas[i] for i in todo]) if todo else []
+                    # Recorded before the lock is released, so the next writer's dedup check sees it
+                    self.content_cache.put([
+                        dict(p, sha256=shas[i], phash=phashes.get(shas[i]), image_id=meta["id"], vector=vectors[shas[i]])
+                        for i, p, meta in zip(todo, prepared, committed)
+                    ])
+                # Listeners run after the swap: they may read the index, and searches need not wait on them
+                if committed:
+                    offsets = list(range(len(self.metas) - len(committed), len(self.metas)))
+                    for listener in self._ingest_listeners:
+                        listener(self, offsets, vec_np)
+            for i, meta in zip(todo, committed):
+                results[i] = meta
+
+        for i, sha in enumerate(shas):
+            if results[i] is None:
+                results[i] = dict(results[first[sha]], duplicate=True)
+        return results  # type: ignore[return-value]
+
+    def duplicate_of(self, sha: str) -> Optional[Dict]:
+        """Ingest payload (marked duplicate) of the screenshot with this content hash, if this index holds it."""
+        with self._rw.read():
+            meta = self._indexed(sha)
+            return None if meta is None else dict(self._ingest_payload(meta), duplicate=True)
+
+    def _indexed(self, sha: str) -> Optional[ImageMeta]:
+        # The cache may outlive the index (or predate a crash), so confirm against the meta itself
+        entry = self.content_cache.get(sha)
+        if entry is None or entry["image_id"] is None:
+            return None
+        meta = self.get_meta(entry["image_id"])
+        return meta if meta is not None and meta.content_hash == sha else None
+
+    def _prepare_many(self, contents: List[bytes], cached: List[Optional[Dict]]) -> List[Dict]:
+        if self._ocr_in_pool():
+            pool = self._get_ocr_pool()
+            futures = [pool.submit(_decode, content) if hit else pool.submit(_decode_and_ocr, content, self._pool_ocr_config()) for content, hit in zip(contents, cached)]
+            decoded = [f.result() for f in futures]
+            for d in decoded:
+                if "timings" in d:
+                    self._record_ocr_timings(d.pop("timings"))
+        else:
+            decoded = [_decode(content) if hit else self._prepare(content) for content, hit in zip(contents, cached)]
+        return [
+            dict(d, text=hit["text"], blocks=hit["blocks"]) if hit else d
+            for d, hit in zip(decoded, cached)
+        ]
+
+    def _prepare(self, content: bytes) -> Dict:
         image = Image.open(io.BytesIO(content)).convert("RGB")
         text, ocr_blocks = self._ocr_with_blocks(image)
-        vector = self._embed(text)
-        entities = self._extract_entities(text)
-        type_label = self._classify_type(text)
-
-        img_id = f"{len(self.metas):08d}"
-        meta = ImageMeta(
-            id=img_id,
-            filename=filename,
-            text=text,
-            width=image.width,
-            height=image.height,
-            collection=collection,
-            imported_at=datetime.now(timezone.utc).isoformat(),
-            type_label=type_label,
-            entities=entities,
-        )
+        return {"text": text, "blocks": ocr_blocks, "width": image.width, "height": image.height, "jpeg": _encode_jpeg(image)}
+
+    def _ocr_in_pool(self) -> bool:
+        # Subclasses that override OCR keep running it in-process
+        return self.ocr_workers > 1 and type(self)._ocr_with_blocks is ScreenshotIndexer._ocr_with_blocks
+
+    def _get_ocr_pool(self):
+        if self.parent is not None:
+            return self.parent._get_ocr_pool()
+        with self._prep_lock:
+            if self._ocr_pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # spawn: forking a process that already holds torch/FAISS threads is unsafe
+                # Workers are long-lived: each loads its OCR engine once and keeps it for every image
+                self._ocr_pool = ProcessPoolExecutor(
+                    max_workers=self.ocr_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=warm_engine,
+                    initargs=(self._pool_ocr_config(),),
+                )
+            return self._ocr_pool
 
-        # Persist original image for previews
-        out_path = self.images_dir / f"{img_id}.jpg"
-        image.save(out_path, format="JPEG", quality=85)
+    def _pool_ocr_config(self) -> OcrConfig:
+        # Every pool process OCRs its own image: the bands of a tall capture get that process's
+        # share of the cores, not tile_workers threads each on top of ocr_workers processes
+        return replace(self.ocr_config, tile_workers=max(1, (os.cpu_count() or 1) // self.ocr_workers))
 
-        # Persist OCR blocks per image
-        with (self.ocr_dir / f"{img_id}.json").open("w", encoding="utf-8") as f:
-            import json as _json
-            _json.dump({"blocks": ocr_blocks}, f, ensure_ascii=False)
+    def close(self) -> None:
+        if self._ocr_pool is not None:
+            self._ocr_pool.shutdown()
+            self._ocr_pool = None
+        if self.parent is None:
+            self.content_cache.close()
+        self.ocr_log.close()
 
+    def _take_ids(self, n: int) -> int:
+        # First of n fresh ids; shards draw from the root's counter, so ids stay unique (and
+        # increasing within every shard) across the library
+        if self.parent is not None:
+            first = self.parent._take_ids(n)
+            self._next_id = max(self._next_id, first + n)
+            return first
+        with self._id_lock:
+            first = self._next_id
+            self._next_id += n
+            return first
+
+    def _commit(self, prepared: List[Dict], filenames: List[str], vectors, collection: Optional[str], hashes: List[str]) -> List[Dict]:
+        # Runs under the write lock, so ids are handed out exactly once even with several ingest workers
         import numpy as np  # local import to avoid global dependency at import time
 
-        vec_np = np.array([vector], dtype="float32")
-        if not self.index.is_trained:
-            # For IndexFlatIP, training isn't needed, but keep branch for future swap
-            pass
-        self.index.add(vec_np)
+        out: List[Dict] = []
+        first = self._take_ids(len(prepared))
+        for n, (p, filename, sha) in enumerate(zip(prepared, filenames, hashes), first):
+            text = p["text"]
+            img_id = f"{n:08d}"
+            meta = ImageMeta(
+                id=img_id,
+                filename=filename,
+                text=text,
+                width=p["width"],
+                height=p["height"],
+                collection=collection,
+                imported_at=datetime.now(timezone.utc).isoformat(),
+                type_label=self._classify_type(text),
+                entities=self._extract_entities(text),
+                content_hash=sha,
+            )
+
+            # Persist original image for previews
+            out_path = self.images_dir / f"{img_id}.jpg"
+            out_path.write_bytes(p["jpeg"])
+
+            # OCR blocks go to the packed segment, with entity highlights resolved once here
+            ocr_doc = {"blocks": p["blocks"], **entity_block_map(p["blocks"], meta.entities)}
+            self.ocr_log.append(json.dumps(ocr_doc, ensure_ascii=False).encode("utf-8"))
 
-        self.metas.append(meta)
-        self.id_to_offset[meta.id] = len(self.metas) - 1
+            self.metas.append(meta)
+            self.lexical.add(len(self.metas) - 1, meta.text, meta.entities)
 
+            out.append(self._ingest_payload(meta))
+
+        vec_np = np.ascontiguousarray(vectors, dtype="float32").reshape(len(prepared), self.dim)
+        self.index.add(vec_np)
+        if self.ann_index is not None:
+            # Trained once at build time; new vectors go to their nearest existing lists
+            self.ann_index.add(vec_np)
+        return out
+
+    def _ingest_payload(self, meta: ImageMeta) -> Dict:
         return {
             "id": meta.id,
             "filename": meta.filename,
@@ -127,92 +867,257 @@ class ScreenshotIndexer:
             "imported_at": meta.imported_at,
             "type_label": meta.type_label,
             "entities": meta.entities,
-            "image_path": str(out_path.relative_to(self.data_dir)),
+            "image_path": f"images/{meta.id}.jpg",
+            "duplicate": False,
         }
 
-    def search(self, query: str, k: int = 12, collection: Optional[str] = None, entity_type: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, type_label: Optional[str] = None) -> List[Dict]:
-        if len(self.metas) == 0:
-            return []
+    def search(self, query: str, k: int = 12, collection: Optional[str] = None, entity_type: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, type_label: Optional[str] = None, mode: str = "hybrid") -> List[Dict]:
+        """Rank by embedding similarity, BM25 over OCR text, or both fused ("hybrid", the default)."""
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"unknown search mode {mode!r}; expected one of {', '.join(SEARCH_MODES)}")
+        # Encoded before taking the read lock: a waiting writer is never held up by the model
+        q_vec = None if mode == "lexical" else self.query_encoder.encode(query)
+        with self._rw.read():
+            semantic, lexical = self._ranked(query, q_vec, k, mode, collection=collection, entity_type=entity_type, start_date=start_date, end_date=end_date, type_label=type_label)
+            return [self._payload(self.metas[i], score) for i, score in fuse(semantic, lexical, k, mode)]
 
-        import numpy as np
+    def ranked(self, query: str, q_vec, k: int, mode: str = "hybrid", **filters) -> Tuple[List[Tuple[str, float]], List[Tuple[str, float]]]:
+        """search() before fusion: the semantic and lexical candidates as (image id, score) lists.
 
-        q_vec = self.model.encode([query], normalize_embeddings=True).astype("float32")
-        scores, idxs = self.index.search(q_vec, min(k, len(self.metas)))
+        q_vec is the encoded query (None in lexical mode); a ShardedIndexer encodes once and
+        merges these lists across shards.
+        """
+        with self._rw.read():
+            ids = self.metas.columns()["id"]
+            return tuple([(f"{int(ids[i]):08d}", score) for i, score in hits] for hits in self._ranked(query, q_vec, k, mode, **filters))  # type: ignore[return-value]
 
-        results: List[Tuple[int, float]] = []
-        for i, score in zip(idxs[0].tolist(), scores[0].tolist()):
-            if i < 0:
-                continue
-            meta = self.metas[i]
-            if collection is not None and meta.collection != collection:
-                continue
-            if entity_type is not None:
-                if not meta.entities or entity_type not in meta.entities or len(meta.entities[entity_type]) == 0:
-                    continue
-            if start_date or end_date:
-                try:
-                    ts = datetime.fromisoformat(meta.imported_at.replace("Z", "+00:00")).date()
-                    if start_date:
-                        sd = datetime.fromisoformat(start_date).date()
-                        if ts < sd:
-                            continue
-                    if end_date:
-                        ed = datetime.fromisoformat(end_date).date()
-                        if ts > ed:
-                            continue
-                except Exception:
-                    pass
-            if type_label is not None and meta.type_label != type_label:
-                continue
-            results.append((i, float(score)))
-
-        # Map to payloads
+    def _ranked(self, query: str, q_vec, k: int, mode: str, **filters) -> Tuple[List[Tuple[int, float]], List[Tuple[int, float]]]:
+        # (offset, score) lists from each side the mode uses: k deep, or rrf_depth for hybrid
+        if self.count() == 0:
+            return [], []
+        allowed = self._filter_offsets(**filters)
+        if allowed is not None and allowed.size == 0:
+            return [], []
+
+        available = len(self.metas) if allowed is None else int(allowed.size)
+        k = min(k, available)
+        if mode == "hybrid":
+            # Fuse deeper candidate lists so an exact token hit ranked low semantically still surfaces
+            k = min(max(k, self.rrf_depth), available)
+        semantic = self._knn(q_vec, k, allowed) if mode != "lexical" else []
+        lexical = self.lexical.search(query, k, allowed) if mode != "semantic" else []
+        return semantic, lexical
+
+    def _payload(self, meta: ImageMeta, score: float) -> Dict:
+        return {
+            "id": meta.id,
+            "filename": meta.filename,
+            "text": meta.text,
+            "width": meta.width,
+            "height": meta.height,
+            "collection": meta.collection,
+            "imported_at": meta.imported_at,
+            "type_label": meta.type_label,
+            "score": score,
+            "entities": meta.entities,
+            "image_path": f"images/{meta.id}.jpg",
+        }
+
+    def results_for(self, scored_ids: List[Tuple[str, float]]) -> List[Dict]:
+        """Search-style payloads for precomputed (id, score) pairs, skipping unknown ids."""
         out: List[Dict] = []
-        for i, score in results:
-            meta = self.metas[i]
-            out.append(
-                {
-                    "id": meta.id,
-                    "filename": meta.filename,
-                    "text": meta.text,
-                    "width": meta.width,
-                    "height": meta.height,
-                    "collection": meta.collection,
-                    "imported_at": meta.imported_at,
-                    "type_label": meta.type_label,
-                    "score": score,
-                    "entities": meta.entities,
-                    "image_path": f"images/{meta.id}.jpg",
-                }
-            )
+        with self._rw.read():
+            for image_id, score in scored_ids:
+                meta = self.get_meta(image_id)
+                if meta is not None:
+                    out.append(self._payload(meta, score))
         return out
 
+    # ---------- OCR payloads ----------
+    def ocr_payload(self, image_id: str) -> Optional[bytes]:
+        """The image-detail OCR document (blocks plus entity highlights) as stored JSON bytes."""
+        with self._rw.read():
+            offset = self._offset(image_id)
+            return None if offset is None else self.ocr_log.get(offset)
+
+    # ---------- export ----------
+    def page(self, cursor: int, limit: Optional[int]) -> Tuple[int, int, Optional[int]]:
+        """Offsets [start, stop) holding up to limit live rows with ids >= cursor, and the next page's cursor.
+
+        Cursors are image ids, so pages stay aligned when compaction moves rows.
+        """
+        import numpy as np
+
+        with self._rw.read():
+            ids = self.metas.columns()["id"]
+            start = int(np.searchsorted(ids, cursor))
+            if limit is None:
+                return start, len(ids), None
+            live = np.flatnonzero(self._live_mask(np.arange(start, len(ids), dtype="int64")))
+            if len(live) <= limit:
+                return start, len(ids), None
+            stop = start + int(live[limit])
+            return start, stop, int(ids[stop])
+
+    def live_ids(self, cursor: int = 0, limit: Optional[int] = None):
+        """Ids (int64) of up to limit live rows with ids >= cursor, in order."""
+        import numpy as np
+
+        with self._rw.read():
+            ids = self.metas.columns()["id"]
+            start = int(np.searchsorted(ids, cursor))
+            # limit live rows lie within limit + (deleted rows) positions
+            stop = len(ids) if limit is None else min(len(ids), start + limit + len(self._dead))
+            rows = np.arange(start, stop, dtype="int64")
+            return ids[rows[self._live_mask(rows)][:limit]].astype("int64")
+
+    # The export iterators capture the current rows when called and then stream without
+    # holding the read lock, so a slow client never blocks ingest
+
+    def iter_metas(self, start: int = 0, stop: Optional[int] = None):
+        """Stream live rows at offsets [start, stop) in order."""
+        with self._rw.read():
+            stop = len(self.metas) if stop is None else min(stop, len(self.metas))
+            dead = set(self._dead.tolist())
+            rows = self.metas.iter_from(start)
+        return (meta for offset, meta in zip(range(start, stop), rows) if offset not in dead)
+
+    def iter_vectors(self, start: int = 0, stop: Optional[int] = None, chunk: int = 4096, with_ids: bool = False):
+        """Yield (rows, dim) float32 blocks of the live rows' vectors for offsets [start, stop).
+
+        with_ids=True yields (ids, block) pairs instead, ids as int64.
+        """
+        import numpy as np
+
+        with self._rw.read():
+            index, dead = self.index, self._dead
+            ids = self.metas.columns()["id"]
+            stop = index.ntotal if stop is None else min(stop, index.ntotal)
+
+        def blocks():
+            for lo in range(start, stop, chunk):
+                block = index.reconstruct_n(lo, min(chunk, stop - lo))
+                live = ~np.isin(np.arange(lo, lo + len(block)), dead)
+                yield (ids[lo:lo + len(block)][live].astype("int64"), block[live]) if with_ids else block[live]
+
+        return blocks()
+
+    # ---------- ingest listeners ----------
+    def add_ingest_listener(self, listener: Callable[[ScreenshotIndexer, List[int], Any], None]) -> None:
+        """Call listener(indexer, offsets, vectors) after each committed ingest batch; offsets are rows of indexer."""
+        self._ingest_listeners.append(listener)
+
+    def parts(self) -> List[ScreenshotIndexer]:
+        """The indexers holding this library's rows: this one, or every shard of a ShardedIndexer."""
+        return [self]
+
+    def score_query(self, query: str, vectors):
+        # Cosine similarity of query to each row of vectors (both are normalized)
+        return vectors @ self.query_encoder.encode(query)[0]
+
+    # ---------- filters ----------
+    def _filter_mask(self, rows=None, collection: Optional[str] = None, entity_type: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, type_label: Optional[str] = None):
+        """Boolean mask over rows (default: every row) of those passing the filters; None means no filter applies."""
+        import numpy as np
+
+        cols = self.metas.columns()
+
+        def col(name: str):
+            return cols[name] if rows is None else cols[name][rows]
+
+        n = len(self.metas) if rows is None else len(rows)
+        mask = None
+
+        def narrow(m) -> None:
+            nonlocal mask
+            mask = m if mask is None else mask & m
+
+        if len(self._dead):
+            narrow(self._live_mask(rows))
+
+        for attr, value in (("collection", collection), ("type_label", type_label)):
+            if value is not None:
+                code = self.metas.code(attr, value)
+                narrow(col(attr) == code if code is not None else np.zeros(n, dtype=bool))
+        if entity_type is not None:
+            bit = self.metas.code("entity", entity_type)
+            narrow((col("entities") & np.uint64(1 << bit)) != 0 if bit is not None else np.zeros(n, dtype=bool))
+        if start_date or end_date:
+            lo, hi = _date_bounds(start_date, end_date)
+            if lo is not None or hi is not None:
+                ts = col("imported_at")
+                # Rows without a parseable import time are never excluded by dates
+                in_range = ts == NO_TIME
+                bounded = np.ones(n, dtype=bool)
+                if lo is not None:
+                    bounded &= ts >= lo
+                if hi is not None:
+                    bounded &= ts < hi
+                narrow(in_range | bounded)
+        return mask
+
+    def _live_mask(self, rows=None):
+        """Boolean mask over rows (default: every row) of those not deleted."""
+        import numpy as np
+
+        if rows is None:
+            live = np.ones(len(self.metas), dtype=bool)
+            live[self._dead] = False
+            return live
+        return ~np.isin(rows, self._dead)
+
+    def matches_filters(self, offset: int, **filters) -> bool:
+        """Single-row version of _filter_offsets, for evaluating rules against new items."""
+        import numpy as np
+
+        with self._rw.read():
+            mask = self._filter_mask(np.asarray([offset], dtype="int64"), **filters)
+        return True if mask is None else bool(mask[0])
+
+    def _filter_offsets(self, collection: Optional[str] = None, entity_type: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, type_label: Optional[str] = None):
+        """Sorted offsets passing the filters, from one vectorized pass over the columns; None means no filter applies."""
+        import numpy as np
+
+        mask = self._filter_mask(collection=collection, entity_type=entity_type, start_date=start_date, end_date=end_date, type_label=type_label)
+        return None if mask is None else np.flatnonzero(mask).astype("int64")
+
+    def _knn(self, q_vec, k: int, allowed=None) -> List[Tuple[int, float]]:
+        import numpy as np
+
+        def hits(scores, idxs) -> List[Tuple[int, float]]:
+            return [(i, float(score)) for i, score in zip(idxs[0].tolist(), scores[0].tolist()) if i >= 0]
+
+        # Selective filters are cheaper (and exact) over just the allowed rows of the mmap
+        if self.ann_index is not None and (allowed is None or allowed.size > self.ann.exact_subset_limit):
+            import faiss  # type: ignore
+
+            sel = None
+            if allowed is not None:
+                # A bitmap costs n/8 bytes per query, where a batch selector hashes every allowed id
+                bits = np.zeros(self.index.ntotal, dtype=bool)
+                bits[allowed] = True
+                bitmap = np.packbits(bits, bitorder="little")
+                sel = faiss.IDSelectorBitmap(len(bits), faiss.swig_ptr(bitmap))
+            # Pre-filtered search: the ANN index only scores ids the selector lets through
+            found = hits(*self.ann_index.search(q_vec, k, params=search_params(self.ann, self.ann_index, sel)))
+            if len(found) >= k or allowed is None:
+                return found
+            # Graph/list traversal ran dry under the filter: widen to an exact scan of the subset
+        return hits(*self.index.search(q_vec, k, subset=allowed))
+
     # ---------- OCR with blocks ----------
     def _ocr_with_blocks(self, image: Image.Image):
-        data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
-        blocks = []
-        texts: List[str] = []
-        n = len(data.get("text", []))
-        for i in range(n):
-            text = data["text"][i] or ""
-            if text.strip() == "":
-                continue
-            conf_raw = data.get("conf", ["0"]) [i] if isinstance(data.get("conf"), list) else "0"
-            try:
-                conf = float(conf_raw)
-            except Exception:
-                conf = -1.0
-            left = int(data["left"][i])
-            top = int(data["top"][i])
-            width = int(data["width"][i])
-            height = int(data["height"][i])
-            blocks.append({
-                "text": text,
-                "conf": conf,
-                "bbox": {"x": left, "y": top, "w": width, "h": height},
-            })
-            texts.append(text)
-        return (" ".join(texts).strip(), blocks)
+        text, blocks, timings = ocr_image(image, self.ocr_config)
+        self._record_ocr_timings(timings)
+        return text, blocks
+
+    def _record_ocr_timings(self, timings: Dict[str, float]) -> None:
+        if self.parent is not None:
+            return self.parent._record_ocr_timings(timings)
+        with self._prep_lock:
+            self._ocr_timings["images"] += 1
+            for stage, seconds in timings.items():
+                self._ocr_timings[stage] = self._ocr_timings.get(stage, 0.0) + seconds
 
     # ---------- type classification (heuristic) ----------
     def _classify_type(self, text: str) -> Optional[str]:
@@ -233,14 +1138,35 @@ class ScreenshotIndexer:
                 return label
         return None
 
+    def stats(self) -> Dict:
+        with self._prep_lock:
+            timings = dict(self._ocr_timings)
+        n = timings["images"]
+        ocr = {"engine": get_engine(self.ocr_config.engine).name, "images": n, "mean_seconds": {stage: total / n for stage, total in timings.items() if stage != "images"} if n else {}}
+        vectors = {"backend": self.encoder.backend, "dtype": self.vector_dtype, "bytes": self.vectors_path.stat().st_size if self.vectors_path.exists() else 0}
+        snapshot = {
+            "role": "reader" if self.readonly else "writer",
+            "version": self.snapshot["version"],
+            "generation": self.snapshot["generation"],
+            "age_seconds": time.time() - self.snapshot["published_at"],
+        }
+        return {"images": self.count(), "deleted": len(self._dead), "query_encoder": self.query_encoder.stats(), "ocr": ocr, "vectors": vectors, "snapshot": snapshot}
+
     # ---------- meta lookup ----------
     def get_meta(self, image_id: str) -> Optional[ImageMeta]:
-        idx = self.id_to_offset.get(image_id)
-        if idx is None:
+        with self._rw.read():
+            offset = self._offset(image_id)
+            return None if offset is None else self.metas[offset]
+
+    def _offset(self, image_id: str) -> Optional[int]:
+        # Ids are increasing numbers, so the id column is binary searched; no id map is loaded
+        import numpy as np
+
+        offset = self.metas.find(image_id)
+        if offset is None or image_id != f"{int(image_id):08d}":
             return None
-        if 0 <= idx < len(self.metas):
-            return self.metas[idx]
-        return None
+        i = int(np.searchsorted(self._dead, offset))
+        return None if i < len(self._dead) and self._dead[i] == offset else offset
 
     # ---------- entities ----------
     def _extract_entities(self, text: str) -> Dict[str, List[str]]:
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+
+
+# process(items, collection) -> one meta dict per item, in order
+ProcessFn = Callable[[List[Tuple[bytes, str]], Optional[str]], List[Dict]]
+
+SPOOL_CHUNK = 1 << 20
+
+
+class QueueFull(RuntimeError):
+    """The ingest backlog is at max_pending files; retry later."""
+
+
+class JobQueue:
+    """Persistent ingest queue: uploads are spooled to disk and journaled in SQLite, workers drain them.
+
+    Several processes may submit to one data dir; only the one that calls start() drains it.
+    """
+
+    def __init__(self, data_dir: Path, process: ProcessFn, workers: int = 1, batch_size: int = 32, autostart: bool = True, max_pending: Optional[int] = None) -> None:
+        self.data_dir = data_dir
+        self.db_path = self.data_dir / "jobs.sqlite3"
+        self.spool_dir = self.data_dir / "spool"
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.process = process
+        self.workers = workers
+        self.batch_size = batch_size
+        self.autostart = autostart  # start workers on the first submit
+        self.max_pending = max_pending  # files waiting or running before submit refuses more
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    collection TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    image_id TEXT,
+                    error TEXT,
+                    finished_at REAL,
+                    PRIMARY KEY (job_id, seq)
+                );
+                CREATE INDEX IF NOT EXISTS job_files_status ON job_files (status, job_id, seq);
+                """
+            )
+
+    # ---------- submit ----------
+    def submit(self, files: List[Tuple[Union[bytes, BinaryIO], str]], collection: Optional[str] = None) -> str:
+        """Spool files (bytes, or binary file objects copied in chunks) and journal a job.
+
+        Raises QueueFull while max_pending files wait; an empty queue takes any job.
+        """
+        if self.max_pending is not None:
+            backlog = self.backlog()
+            if backlog and backlog + len(files) > self.max_pending:
+                raise QueueFull(f"{backlog} files are waiting to be indexed; retry later")
+        job_id = f"job_{uuid.uuid4().hex[:12]}"
+        job_dir = self.spool_dir / job_id
+        job_dir.mkdir(parents=True, exist_ok=True)
+        for seq, (content, _) in enumerate(files):
+            if isinstance(content, bytes):
+                (job_dir / str(seq)).write_bytes(content)
+            else:
+                with (job_dir / str(seq)).open("wb") as out:
+                    shutil.copyfileobj(content, out, SPOOL_CHUNK)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO jobs (id, collection, created_at) VALUES (?, ?, ?)", (job_id, collection, time.time()))
+            self._conn.executemany(
+                "INSERT INTO job_files (job_id, seq, filename, status) VALUES (?, ?, ?, 'pending')",
+                [(job_id, seq, filename) for seq, (_, filename) in enumerate(files)],
+            )
+        if self.autostart:
+            self.start()
+        self._wakeup.set()
+        return job_id
+
+    # ---------- status ----------
+    def backlog(self) -> int:
+        """Files submitted and not finished yet, across every job."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM job_files WHERE status IN ('pending', 'running')").fetchone()[0]
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            files = self._conn.execute(
+                "SELECT seq, filename, status, image_id, error FROM job_files WHERE job_id = ? ORDER BY seq", (job_id,)
+            ).fetchall()
+
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        for f in files:
+            counts[f["status"]] += 1
+        finished = counts["done"] + counts["failed"]
+        remaining = counts["pending"] + counts["running"]
+        if remaining == 0:
+            status = "completed"
+        elif job["started_at"] is None:
+            status = "queued"
+        else:
+            status = "running"
+
+        throughput = None
+        eta_seconds = None
+        if job["started_at"] is not None and finished:
+            elapsed = (job["finished_at"] or time.time()) - job["started_at"]
+            if elapsed > 0:
+                throughput = finished / elapsed
+                eta_seconds = remaining / throughput
+        return {
+            "id": job["id"],
+            "status": status,
+            "collection": job["collection"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            "total": len(files),
+            **counts,
+            "throughput_per_sec": throughput,
+            "eta_seconds": eta_seconds,
+            "files": [
+                {"seq": f["seq"], "filename": f["filename"], "status": f["status"], "image_id": f["image_id"], "error": f["error"]}
+                for f in files
+            ],
+        }
+
+    # ---------- workers ----------
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            with self._conn:
+                # Work claimed by a worker that died is retried
+                self._conn.execute("UPDATE job_files SET status = 'pending' WHERE status = 'running'")
+            finished = {r["id"] for r in self._conn.execute("SELECT id FROM jobs WHERE finished_at IS NOT NULL")}
+            for job_dir in self.spool_dir.iterdir():
+                if job_dir.name in finished:
+                    shutil.rmtree(job_dir, ignore_errors=True)  # left by a crash after the job finished
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"quarry-ingest-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _run(self) -> None:
+        while True:
+            claimed = self._claim()
+            if claimed is None:
+                self._wakeup.wait(timeout=1.0)
+                self._wakeup.clear()
+                continue
+            self._process(*claimed)
+
+    def _claim(self) -> Optional[Tuple[str, Optional[str], List[sqlite3.Row]]]:
+        with self._lock, self._conn:
+            head = self._conn.execute(
+                "SELECT job_id FROM job_files WHERE status = 'pending' ORDER BY rowid LIMIT 1"
+            ).fetchone()
+            if head is None:
+                return None
+            job_id = head["job_id"]
+            rows = self._conn.execute(
+                "SELECT seq, filename FROM job_files WHERE job_id = ? AND status = 'pending' ORDER BY seq LIMIT ?",
+                (job_id, self.batch_size),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE job_files SET status = 'running' WHERE job_id = ? AND seq = ?", [(job_id, r["seq"]) for r in rows]
+            )
+            self._conn.execute("UPDATE jobs SET started_at = ? WHERE id = ? AND started_at IS NULL", (time.time(), job_id))
+            collection = self._conn.execute("SELECT collection FROM jobs WHERE id = ?", (job_id,)).fetchone()["collection"]
+        return job_id, collection, rows
+
+    def _process(self, job_id: str, collection: Optional[str], rows: List[sqlite3.Row]) -> None:
+        job_dir = self.spool_dir / job_id
+        items = [((job_dir / str(r["seq"])).read_bytes(), r["filename"]) for r in rows]
+        try:
+            metas = self.process(items, collection)
+            outcomes = [(r["seq"], m["id"], None) for r, m in zip(rows, metas)]
+        except Exception:
+            # Isolate the failure: retry one by one so a bad file only fails itself
+            outcomes = []
+            for r, item in zip(rows, items):
+                try:
+                    outcomes.append((r["seq"], self.process([item], collection)[0]["id"], None))
+                except Exception as e:
+                    outcomes.append((r["seq"], None, str(e)))
+        self._finish(job_id, outcomes)
+
+    def _finish(self, job_id: str, outcomes: List[Tuple[int, Optional[str], Optional[str]]]) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE job_files SET status = ?, image_id = ?, error = ?, finished_at = ? WHERE job_id = ? AND seq = ?",
+                [("failed" if err else "done", image_id, err, now, job_id, seq) for seq, image_id, err in outcomes],
+            )
+            remaining = self._conn.execute(
+                "SELECT COUNT(*) FROM job_files WHERE job_id = ? AND status IN ('pending', 'running')", (job_id,)
+            ).fetchone()[0]
+            if remaining == 0:
+                self._conn.execute("UPDATE jobs SET finished_at = ? WHERE id = ?", (now, job_id))
+        # Only once the statuses are committed: a crash in between leaves files start() sweeps
+        for seq, _, _ in outcomes:
+            (self.spool_dir / job_id / str(seq)).unlink(missing_ok=True)
+        if remaining == 0:
+            shutil.rmtree(self.spool_dir / job_id, ignore_errors=True)
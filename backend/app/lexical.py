@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import math
+import re
+from array import array
+from contextlib import nullcontext
+from pathlib import Path
+from typing import ContextManager, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .storage import atomic_write_bytes
+
+
+WORD_RE = re.compile(r"\w+")
+
+
+def doc_terms(text: str, entities: Optional[Dict[str, List[str]]] = None) -> List[str]:
+    # Word tokens plus every extracted entity value as one whole term ("$42.00", "a@b.com")
+    terms = WORD_RE.findall(text.lower())
+    for values in (entities or {}).values():
+        terms.extend(" ".join(v.split()).lower() for v in values if v.strip())
+    return terms
+
+
+def query_terms(query: str) -> List[str]:
+    terms = WORD_RE.findall(query.lower())
+    # Whitespace-delimited pieces with punctuation can match whole entity terms
+    for piece in query.lower().split():
+        piece = piece.strip(".,;:!?\"'()")
+        if piece and not WORD_RE.fullmatch(piece):
+            terms.append(piece)
+    return list(dict.fromkeys(terms))
+
+
+class LexicalIndex:
+    """BM25 inverted index over OCR text and entity values.
+
+    A checkpoint is stored as CSR arrays (term -> doc offsets, term frequencies) that are
+    memory-mapped on load; documents added since then live in in-memory delta postings.
+    """
+
+    def __init__(self, path: Path, k1: float = 1.2, b: float = 0.75) -> None:
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self._clear()
+        self._load()
+
+    def _clear(self) -> None:
+        self.terms: Dict[str, int] = {}
+        self.indptr = np.zeros(1, dtype="int64")
+        self.docs = np.zeros(0, dtype="int64")
+        self.tfs = np.zeros(0, dtype="int32")
+        self.doc_len = np.zeros(0, dtype="int32")
+        # term -> (doc offsets, term frequencies) as typed arrays, ~12 bytes per posting
+        self._delta: Dict[str, Tuple[array, array]] = {}
+        self._delta_len = array("i")
+        self._total_len = 0
+
+    # ---------- persistence ----------
+    def _load(self) -> None:
+        current = self.path / "CURRENT"
+        if not current.exists():
+            return
+        version = current.read_text(encoding="utf-8").strip()
+
+        def arr(name: str) -> np.ndarray:
+            return np.load(str(self.path / f"{version}.{name}.npy"), mmap_mode="r")
+
+        raw = (self.path / f"{version}.terms.txt").read_text(encoding="utf-8")
+        self.terms = {t: i for i, t in enumerate(raw.split("\n"))} if raw else {}
+        self.indptr, self.docs, self.tfs, self.doc_len = arr("indptr"), arr("docs"), arr("tfs"), arr("doclen")
+        self._total_len = int(self.doc_len.sum())
+
+    def checkpoint(self, swap_lock: Optional[ContextManager] = None) -> None:
+        """Merge the delta into a new CSR checkpoint and switch CURRENT to it atomically.
+
+        Searches may run during the merge; swap_lock, if given, is held only while the
+        in-memory arrays are replaced.
+        """
+        if not self._delta_len and (self.path / "CURRENT").exists():
+            return
+        merged_terms = list(self.terms) + [t for t in self._delta if t not in self.terms]
+        indptr = [0]
+        docs: List[np.ndarray] = []
+        tfs: List[np.ndarray] = []
+        for term in merged_terms:
+            d_docs, d_tfs = self._postings(term)
+            docs.append(d_docs)
+            tfs.append(d_tfs)
+            indptr.append(indptr[-1] + len(d_docs))
+        doc_len = np.concatenate([np.asarray(self.doc_len), np.frombuffer(self._delta_len, dtype="int32")])
+
+        version = f"{len(doc_len):010d}"
+        empty_i64 = np.zeros(0, dtype="int64")
+        arrays = {
+            "indptr": np.asarray(indptr, dtype="int64"),
+            "docs": np.concatenate(docs) if docs else empty_i64,
+            "tfs": np.concatenate(tfs).astype("int32") if tfs else np.zeros(0, dtype="int32"),
+            "doclen": doc_len.astype("int32"),
+        }
+        for name, a in arrays.items():
+            np.save(str(self.path / f"{version}.{name}.npy"), a)
+        (self.path / f"{version}.terms.txt").write_text("\n".join(merged_terms), encoding="utf-8")
+        old = (self.path / "CURRENT").read_text(encoding="utf-8").strip() if (self.path / "CURRENT").exists() else None
+        atomic_write_bytes(self.path / "CURRENT", version.encode("utf-8"))
+
+        with swap_lock or nullcontext():
+            self._clear()
+            self._load()
+        if old and old != version:
+            for f in self.path.glob(f"{old}.*"):
+                try:
+                    f.unlink()
+                except OSError:
+                    pass  # still mapped elsewhere (Windows); removed on a later checkpoint
+
+    def reset(self) -> None:
+        (self.path / "CURRENT").unlink(missing_ok=True)
+        for f in self.path.iterdir():
+            try:
+                f.unlink()
+            except OSError:
+                pass
+        self._clear()
+
+    # ---------- writes ----------
+    def __len__(self) -> int:
+        return len(self.doc_len) + len(self._delta_len)
+
+    @property
+    def pending(self) -> int:
+        return len(self._delta_len)
+
+    @property
+    def checkpointed(self) -> int:
+        return len(self.doc_len)
+
+    def add(self, offset: int, text: str, entities: Optional[Dict[str, List[str]]] = None) -> None:
+        if offset != len(self):
+            raise ValueError(f"documents must be added in offset order (expected {len(self)}, got {offset})")
+        terms = doc_terms(text, entities)
+        counts: Dict[str, int] = {}
+        for t in terms:
+            counts[t] = counts.get(t, 0) + 1
+        for t, tf in counts.items():
+            postings = self._delta.get(t)
+            if postings is None:
+                postings = self._delta[t] = (array("q"), array("i"))
+            postings[0].append(offset)
+            postings[1].append(tf)
+        self._delta_len.append(len(terms))
+        self._total_len += len(terms)
+
+    # ---------- search ----------
+    def _postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        parts_docs = []
+        parts_tfs = []
+        row = self.terms.get(term)
+        if row is not None:
+            lo, hi = int(self.indptr[row]), int(self.indptr[row + 1])
+            parts_docs.append(np.asarray(self.docs[lo:hi]))
+            parts_tfs.append(np.asarray(self.tfs[lo:hi]))
+        delta = self._delta.get(term)
+        if delta:
+            parts_docs.append(np.frombuffer(delta[0], dtype="int64").copy())
+            parts_tfs.append(np.frombuffer(delta[1], dtype="int32").copy())
+        if not parts_docs:
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="int32")
+        return np.concatenate(parts_docs), np.concatenate(parts_tfs)
+
+    def _doc_lengths(self, docs: np.ndarray) -> np.ndarray:
+        n_base = len(self.doc_len)
+        out = np.empty(len(docs), dtype="float32")
+        base = docs < n_base
+        out[base] = np.asarray(self.doc_len)[docs[base]]
+        if (~base).any():
+            out[~base] = np.frombuffer(self._delta_len, dtype="int32")[docs[~base] - n_base]
+        return out
+
+    def search(self, query: str, k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        n = len(self)
+        if n == 0 or k <= 0:
+            return []
+        avgdl = max(self._total_len / n, 1.0)
+        all_docs = []
+        all_scores = []
+        for term in query_terms(query):
+            docs, tfs = self._postings(term)
+            df = len(docs)  # idf stays corpus-wide under filters
+            if allowed is not None and df:
+                keep = np.isin(docs, allowed)
+                docs, tfs = docs[keep], tfs[keep]
+            if len(docs) == 0:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            tf = tfs.astype("float32")
+            norm = self.k1 * (1 - self.b + self.b * self._doc_lengths(docs) / avgdl)
+            all_docs.append(docs)
+            all_scores.append(idf * tf * (self.k1 + 1) / (tf + norm))
+        if not all_docs:
+            return []
+        uniq, inv = np.unique(np.concatenate(all_docs), return_inverse=True)
+        scores = np.bincount(inv, weights=np.concatenate(all_scores))
+        kk = min(k, len(uniq))
+        top = np.argpartition(-scores, kk - 1)[:kk]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(uniq[i]), float(scores[i])) for i in top]
+
+
+def reciprocal_rank_fusion(*rankings: List[Tuple[int, float]], k: int = 60) -> List[Tuple[int, float]]:
+    """Fuse ranked (offset, score) lists by summing 1 / (k + rank)."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (offset, _) in enumerate(ranking):
+            fused[offset] = fused.get(offset, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: (-item[1], item[0]))
@@ -1,15 +1,115 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import Body, FastAPI, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import List, Optional
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Union
+import anyio
+import json
+import logging
+import os
+import threading
+import time
 import uvicorn
 
-from .indexer import ScreenshotIndexer
-from .albums import AlbumStore
+from .indexer import DEFAULT_DATA_DIR, ScreenshotIndexer
+from .albums import AlbumResults, AlbumStore
+from .jobs import JobQueue, QueueFull
+from .previews import PREVIEW_SIZES, PreviewStore
+from .shards import ShardedIndexer, read_layout
+from .snapshots import WriterLockHeld
 from starlette.staticfiles import StaticFiles
 
 
-app = FastAPI(title="Quarry.io API", version="0.1.0")
+log = logging.getLogger("quarry")
+
+# The indexer (embedding model, vectors, metadata) loads in the background after startup:
+# /health answers at once, /ready and the endpoints that need the index report 503 until then
+indexer: Optional[Union[ScreenshotIndexer, ShardedIndexer]] = None
+_indexer_loaded = threading.Event()
+_load_error: Optional[str] = None
+
+# One process per data dir writes (ingest, deletes, edits) and publishes index snapshots;
+# readers serve searches from them. "auto" makes the first process to start the writer
+ROLE = os.environ.get("QUARRY_ROLE", "auto")
+if ROLE not in ("auto", "writer", "reader"):
+    raise ValueError(f"unknown QUARRY_ROLE {ROLE!r}; expected auto, writer or reader")
+
+# QUARRY_SHARD_BY=collection (one shard per collection) or hash (QUARRY_SHARDS of them);
+# a data dir sharded once keeps its layout without it
+SHARD_BY = os.environ.get("QUARRY_SHARD_BY") or None
+SHARD_COUNT = int(os.environ["QUARRY_SHARDS"]) if os.environ.get("QUARRY_SHARDS") else None
+
+
+def _attach(ix: Union[ScreenshotIndexer, ShardedIndexer]) -> None:
+    ix.add_ingest_listener(_update_albums)
+    if EAGER_PREVIEWS:
+        ix.add_ingest_listener(_render_previews)
+    ix.add_refresh_listener(_on_snapshot)
+
+
+def _new_indexer(readonly: bool = False) -> Union[ScreenshotIndexer, ShardedIndexer]:
+    if SHARD_BY or read_layout(DATA_DIR) is not None:
+        return ShardedIndexer(DATA_DIR, by=SHARD_BY, count=SHARD_COUNT, readonly=readonly)
+    return ScreenshotIndexer(DATA_DIR, readonly=readonly)
+
+
+def _open_indexer() -> Union[ScreenshotIndexer, ShardedIndexer]:
+    if ROLE == "reader":
+        return _new_indexer(readonly=True)
+    try:
+        return _new_indexer()
+    except WriterLockHeld:
+        if ROLE == "writer":
+            raise
+        log.info("another process writes %s; serving as a read-only replica", DATA_DIR)
+        return _new_indexer(readonly=True)
+
+
+def _load_indexer() -> None:
+    global indexer, _load_error
+    t0 = time.perf_counter()
+    try:
+        ix = _open_indexer()
+        _attach(ix)
+        indexer = ix
+        log.info("index loaded in %.1fs", time.perf_counter() - t0)
+        if ix.readonly:
+            ix.follow()
+        else:
+            # Uploads spooled before a restart, while loading or by replicas are drained here
+            jobs.start()
+    except Exception as e:
+        _load_error = str(e)
+        log.exception("index failed to load")
+    finally:
+        _indexer_loaded.set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if indexer is None:
+        threading.Thread(target=_load_indexer, name="quarry-load", daemon=True).start()
+    yield
+
+
+def _not_ready() -> JSONResponse:
+    error = f"index failed to load: {_load_error}" if _load_error else "index is loading"
+    return JSONResponse(status_code=503, content={"error": error}, headers={"Retry-After": "5"})
+
+
+def _read_only() -> JSONResponse:
+    return JSONResponse(status_code=409, content={"error": "read-only replica: send deletes, edits and album changes to the writer process"})
+
+
+def _albums_read_only() -> Optional[JSONResponse]:
+    # albums.jsonl is rewritten whole: a replica's stale copy would drop albums made elsewhere
+    if indexer is None:
+        return _not_ready()
+    return _read_only() if indexer.readonly else None
+
+
+app = FastAPI(title="Quarry.io API", version="0.1.0", lifespan=lifespan)
 
 # Allow local dev frontends by default
 app.add_middleware(
@@ -20,38 +120,111 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-indexer = ScreenshotIndexer()
-albums = AlbumStore(indexer.data_dir)
+DATA_DIR = DEFAULT_DATA_DIR
+albums = AlbumStore(DATA_DIR)
+album_results = AlbumResults(DATA_DIR, limit=int(os.environ.get("QUARRY_ALBUM_RESULTS", "200")))
+
+
+def _update_albums(part, offsets, vectors):
+    # Score only the newly committed screenshots against every album rule
+    album_results.on_ingest(albums.list(), part, offsets, vectors)
+
+
+def _index_batch(items, collection):
+    # Resolved at call time so the queue always feeds the current indexer; uploads
+    # accepted while it loads wait here rather than failing
+    if indexer is None:
+        _indexer_loaded.wait()
+        if indexer is None:
+            raise RuntimeError(f"index failed to load: {_load_error}")
+    return indexer.index_images_bytes(items, collection)
+
+
+# Workers start once this process turns out to be the writer; replicas only journal uploads.
+# Past QUARRY_INGEST_MAX_PENDING queued files, /index answers 429 until workers catch up
+jobs = JobQueue(
+    DATA_DIR,
+    process=_index_batch,
+    workers=int(os.environ.get("QUARRY_INDEX_WORKERS", "1")),
+    autostart=False,
+    max_pending=int(os.environ.get("QUARRY_INGEST_MAX_PENDING", "10000")),
+)
+
+# Uploads are spooled on threads of their own: a burst of large uploads never occupies the
+# threads sync endpoints (search, OCR, exports) run on
+_upload_limiter = anyio.CapacityLimiter(int(os.environ.get("QUARRY_UPLOAD_CONCURRENCY", "4")))
+
+previews = PreviewStore(DATA_DIR)
+# Sizes rendered at ingest rather than on first view, e.g. QUARRY_PREVIEWS_AT_INGEST=small
+EAGER_PREVIEWS = tuple(s for s in os.environ.get("QUARRY_PREVIEWS_AT_INGEST", "").split(",") if s in PREVIEW_SIZES)
+
+
+def _render_previews(part, offsets, vectors):
+    for offset in offsets:
+        previews.render_all(part.metas[offset].id, EAGER_PREVIEWS)
+
 
 # Serve stored images (e.g., /images/00000001.jpg)
-app.mount("/images", StaticFiles(directory=str(indexer.images_dir)), name="images")
+(DATA_DIR / "images").mkdir(parents=True, exist_ok=True)
+app.mount("/images", StaticFiles(directory=str(DATA_DIR / "images")), name="images")
+
+
+def _with_previews(results, preview: Optional[str]):
+    if preview:
+        for r in results:
+            r["preview_path"] = f"preview/{r['id']}?size={preview}"
+    return results
 
 
 @app.get("/health")
 def health() -> dict:
+    # Liveness only: answers while the index is still loading
     return {"status": "ok"}
 
 
-@app.post("/index")
+@app.get("/ready")
+def ready():
+    # Readiness: route traffic here only once the model and index are loaded
+    if indexer is None:
+        return _not_ready()
+    return {"status": "ready", "images": indexer.count(), "role": "reader" if indexer.readonly else "writer"}
+
+
+@app.get("/stats")
+def stats():
+    if indexer is None:
+        return _not_ready()
+    # Query-encoder cache hit rate and micro-batch sizes, for tuning
+    return indexer.stats()
+
+
+@app.post("/index", status_code=202)
 async def index_images(
     files: List[UploadFile] = File(...),
     collection: Optional[str] = Form(None),
 ):
     try:
-        results = []
-        for f in files:
-            content = await f.read()
-            meta = indexer.index_image_bytes(content, filename=f.filename, collection=collection)
-            results.append(meta)
-        indexer.save()
-        return {"indexed": results}
+        # Each upload is already in a temporary file; it is copied to the job spool in chunks
+        # off the event loop, never read into memory whole
+        job_id = await anyio.to_thread.run_sync(jobs.submit, [(f.file, f.filename) for f in files], collection, limiter=_upload_limiter)
+        return {"job_id": job_id, "status": "queued", "files": len(files)}
+    except QueueFull as e:
+        return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "5"})
     except Exception as e:  # pragma: no cover (logged to response)
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        return JSONResponse(status_code=404, content={"error": "job not found"})
+    return job
+
+
 @app.get("/search")
 def search_images(
-    q: str,
+    q: str = "",
     k: int = 12,
     collection: Optional[str] = None,
     entity_type: Optional[str] = None,
@@ -59,22 +232,38 @@ def search_images(
     end_date: Optional[str] = None,
     album_id: Optional[str] = None,
     type_label: Optional[str] = None,
+    mode: Optional[str] = None,
+    preview: Optional[str] = None,
 ):
+    if indexer is None:
+        return _not_ready()
     try:
+        if preview is not None and preview not in PREVIEW_SIZES:
+            raise ValueError(f"unknown preview size {preview!r}; expected one of {', '.join(PREVIEW_SIZES)}")
         # If album_id present, merge its rule into parameters
         if album_id:
-            album = albums.get(album_id)
+            album = _current_albums().get(album_id)
             if not album:
                 return JSONResponse(status_code=404, content={"error": "album not found"})
             rule = album.rule or {}
             q_rule = rule.get("q")
+            extra_filters = any(v is not None for v in (collection, entity_type, start_date, end_date, type_label))
+            # Albums rank by embedding similarity to their rule, whichever path serves them
+            mode = mode or "semantic"
+            if (not q or q == q_rule) and mode == "semantic" and not extra_filters:
+                # Opening an album reads its materialized membership instead of searching
+                cached = album_results.view(album, indexer, k)
+                if cached is not None:
+                    return {"query": q_rule or "", "mode": mode, "results": _with_previews(indexer.results_for(cached), preview)}
             if q_rule and not q:
                 q = q_rule
             collection = rule.get("collection", collection)
             entity_type = rule.get("entity_type", entity_type)
             start_date = rule.get("start_date", start_date)
             end_date = rule.get("end_date", end_date)
+            type_label = rule.get("type_label", type_label)
 
+        mode = mode or "hybrid"
         matches = indexer.search(
             q,
             k=k,
@@ -83,50 +272,138 @@ def search_images(
             start_date=start_date,
             end_date=end_date,
             type_label=type_label,
+            mode=mode,
         )
-        return {"query": q, "results": matches}
+        return {"query": q, "mode": mode, "results": _with_previews(matches, preview)}
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
     except Exception as e:  # pragma: no cover
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
+# Recently opened OCR documents, served without touching disk
+_ocr_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+OCR_CACHE_SIZE = int(os.environ.get("QUARRY_OCR_CACHE_SIZE", "256"))
+
+
+@app.get("/preview/{image_id}")
+def get_preview(image_id: str, request: Request, size: str = "small"):
+    try:
+        path = previews.path(image_id, size, previews.format_for(request.headers.get("accept")))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    if path is None:
+        return JSONResponse(status_code=404, content={"error": "image not found"})
+    etag = previews.etag(path)
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable", "Vary": "Accept"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=previews.media_type(path), headers=headers)
+
+
 @app.get("/image/{image_id}/ocr")
 def get_image_ocr(image_id: str):
+    if indexer is None:
+        return _not_ready()
     try:
-        ocr_path = indexer.ocr_dir / f"{image_id}.json"
-        if not ocr_path.exists():
-            return JSONResponse(status_code=404, content={"error": "ocr not found"})
-        import json, re
-        with ocr_path.open("r", encoding="utf-8") as f:
-            data = json.load(f)
-        # Map entities to blocks by substring match (best-effort)
-        meta = indexer.get_meta(image_id)
-        entity_to_block_idxs = {}
-        if meta and meta.entities:
-            blocks = data.get("blocks", [])
-            for etype, values in meta.entities.items():
-                hits = []
-                for v in values:
-                    v_low = v.strip().lower()
-                    for i, b in enumerate(blocks):
-                        if v_low and v_low in str(b.get("text", "")).lower():
-                            hits.append(i)
-                if hits:
-                    entity_to_block_idxs[etype] = sorted(list(set(hits)))
-        data["entity_block_idxs"] = entity_to_block_idxs
-        return data
+        with _ocr_cache_lock:
+            payload = _ocr_cache.get(image_id)
+            if payload is not None:
+                _ocr_cache.move_to_end(image_id)
+        if payload is None:
+            # Entity highlights were resolved at ingest; this is one read of the stored document
+            payload = indexer.ocr_payload(image_id)
+            if payload is None:
+                return JSONResponse(status_code=404, content={"error": "ocr not found"})
+            with _ocr_cache_lock:
+                _ocr_cache[image_id] = payload
+                while len(_ocr_cache) > OCR_CACHE_SIZE:
+                    _ocr_cache.popitem(last=False)
+        return Response(content=payload, media_type="application/json")
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
+def _on_snapshot() -> None:
+    # A replica moved to a newer snapshot: the writer may have deleted or edited screenshots
+    with _ocr_cache_lock:
+        _ocr_cache.clear()
+    albums.reload()
+    album_results.reload()
+
+
+def _current_albums() -> AlbumStore:
+    # Albums are written by the writer only; a replica picks up its changes as they land
+    if indexer is not None and indexer.readonly:
+        albums.reload()
+    return albums
+
+
+def _forget(image_ids: List[str]) -> None:
+    # Drop everything derived from deleted screenshots that the indexer does not own
+    with _ocr_cache_lock:
+        for image_id in image_ids:
+            _ocr_cache.pop(image_id, None)
+    for image_id in image_ids:
+        previews.remove(image_id)
+    album_results.forget(image_ids)
+
+
+@app.delete("/image/{image_id}")
+def delete_image(image_id: str):
+    if indexer is None:
+        return _not_ready()
+    if indexer.readonly:
+        return _read_only()
+    deleted = indexer.delete([image_id])
+    if not deleted:
+        return JSONResponse(status_code=404, content={"error": "image not found"})
+    _forget(deleted)
+    return {"deleted": deleted}
+
+
+@app.post("/delete")
+def delete_images(ids: List[str] = Body(..., embed=True)):
+    """Bulk delete: each id costs one tombstone, not a rewrite; unknown ids are skipped."""
+    if indexer is None:
+        return _not_ready()
+    if indexer.readonly:
+        return _read_only()
+    deleted = indexer.delete(ids)
+    _forget(deleted)
+    return {"deleted": deleted}
+
+
+@app.patch("/image/{image_id}")
+def update_image(image_id: str, fields: Dict[str, Optional[str]] = Body(...)):
+    if indexer is None:
+        return _not_ready()
+    if indexer.readonly:
+        return _read_only()
+    try:
+        meta = indexer.update(image_id, **fields)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    if meta is None:
+        return JSONResponse(status_code=404, content={"error": "image not found"})
+    # Collection and type changes can move the screenshot in or out of any album
+    album_results.clear()
+    return {"image": meta}
+
+
 @app.get("/albums")
 def list_albums():
     return {"albums": [
-        {"id": a.id, "name": a.name, "rule": a.rule} for a in albums.list()
+        {"id": a.id, "name": a.name, "rule": a.rule} for a in _current_albums().list()
     ]}
 
 
 @app.post("/albums")
 def create_album(name: str = Form(...), rule: str = Form(...)):
+    refused = _albums_read_only()
+    if refused is not None:
+        return refused
     try:
         import json
         rule_obj = json.loads(rule)
@@ -138,43 +415,125 @@ def create_album(name: str = Form(...), rule: str = Form(...)):
 
 @app.post("/albums/{album_id}/rename")
 def rename_album(album_id: str, name: str = Form(...)):
+    refused = _albums_read_only()
+    if refused is not None:
+        return refused
     a = albums.rename(album_id, name)
     if not a:
         return JSONResponse(status_code=404, content={"error": "album not found"})
     return {"album": {"id": a.id, "name": a.name, "rule": a.rule}}
 
 
+@app.post("/albums/{album_id}/rule")
+def update_album_rule(album_id: str, rule: str = Form(...)):
+    refused = _albums_read_only()
+    if refused is not None:
+        return refused
+    try:
+        import json
+        rule_obj = json.loads(rule)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    a = albums.update_rule(album_id, rule_obj)
+    if not a:
+        return JSONResponse(status_code=404, content={"error": "album not found"})
+    album_results.invalidate(album_id)
+    return {"album": {"id": a.id, "name": a.name, "rule": a.rule}}
+
+
 @app.delete("/albums/{album_id}")
 def delete_album(album_id: str):
+    refused = _albums_read_only()
+    if refused is not None:
+        return refused
     ok = albums.delete(album_id)
     if not ok:
         return JSONResponse(status_code=404, content={"error": "album not found"})
+    album_results.invalidate(album_id)
     return {"deleted": True}
 
 
-@app.get("/export.json")
-def export_json():
-    # Light-weight export of meta + entities (texts stored inside meta.text)
+EXPORT_FIELDS = ("id", "filename", "text", "width", "height", "collection", "imported_at", "entities", "image_path")
+
+
+def _export_row(m) -> dict:
     return {
-        "images": [
-            {
-                "id": m.id,
-                "filename": m.filename,
-                "text": m.text,
-                "width": m.width,
-                "height": m.height,
-                "collection": m.collection,
-                "imported_at": m.imported_at,
-                "entities": m.entities,
-                "image_path": f"images/{m.id}.jpg",
-            }
-            for m in indexer.metas
-        ]
+        "id": m.id,
+        "filename": m.filename,
+        "text": m.text,
+        "width": m.width,
+        "height": m.height,
+        "collection": m.collection,
+        "imported_at": m.imported_at,
+        "entities": m.entities,
+        "image_path": f"images/{m.id}.jpg",
     }
 
 
+def _export_page(cursor: int, limit: Optional[int]):
+    # The page's rows and the next cursor are known before streaming starts
+    start, stop, next_cursor = indexer.page(cursor, limit)
+    headers = {"X-Total-Count": str(indexer.count())}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+    return start, stop, headers
+
+
+def _export_lines(start: int, stop: int, fields=None):
+    for m in indexer.iter_metas(start, stop):
+        row = _export_row(m)
+        if fields:
+            row = {f: row[f] for f in fields}
+        yield json.dumps(row, ensure_ascii=False)
+
+
+@app.get("/export.json")
+def export_json():
+    if indexer is None:
+        return _not_ready()
+    # Same document as before, streamed row by row instead of built in memory
+    start, stop, _ = _export_page(0, None)
+
+    def body():
+        yield '{"images": ['
+        for i, line in enumerate(_export_lines(start, stop)):
+            yield (", " if i else "") + line
+        yield "]}"
+
+    return StreamingResponse(body(), media_type="application/json")
+
+
+@app.get("/export.ndjson")
+def export_ndjson(cursor: int = 0, limit: Optional[int] = None, fields: Optional[str] = None):
+    """One JSON object per line; page with cursor/limit (X-Next-Cursor) and project with fields=id,text,..."""
+    selected = [f for f in fields.split(",") if f] if fields else None
+    unknown = [f for f in selected or [] if f not in EXPORT_FIELDS]
+    if unknown or cursor < 0 or (limit is not None and limit <= 0):
+        return JSONResponse(status_code=400, content={"error": f"unknown fields: {', '.join(unknown)}" if unknown else "invalid cursor or limit"})
+    if indexer is None:
+        return _not_ready()
+    start, stop, headers = _export_page(cursor, limit)
+    lines = (line + "\n" for line in _export_lines(start, stop, selected))
+    return StreamingResponse(lines, media_type="application/x-ndjson", headers=headers)
+
+
+@app.get("/export.vectors")
+def export_vectors(cursor: int = 0, limit: Optional[int] = None):
+    """Binary sidecar to /export.ndjson: row i is the little-endian float32 embedding of line i."""
+    if cursor < 0 or (limit is not None and limit <= 0):
+        return JSONResponse(status_code=400, content={"error": "invalid cursor or limit"})
+    if indexer is None:
+        return _not_ready()
+    start, stop, headers = _export_page(cursor, limit)
+    headers["X-Vector-Dim"] = str(indexer.dim)
+    body = (block.astype("<f4").tobytes() for block in indexer.iter_vectors(start, stop))
+    return StreamingResponse(body, media_type="application/octet-stream", headers=headers)
+
+
 @app.post("/ask")
 def ask_question(question: str = Form(...)):
+    if indexer is None:
+        return _not_ready()
     try:
         # Simple RAG: search for relevant images, then generate answer from their text
         matches = indexer.search(question, k=5)
@@ -0,0 +1,428 @@
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .storage import MetaLog, SnapshotChanged, atomic_write_bytes
+
+
+# Rows are materialized only for results and ingest, but slots keep each one small
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_SLOTS)
+class ImageMeta:
+    id: str
+    filename: str
+    text: str
+    width: int
+    height: int
+    collection: Optional[str] = None
+    imported_at: str = ""  # ISO 8601
+    type_label: Optional[str] = None
+    entities: Optional[Dict[str, List[str]]] = None
+    content_hash: Optional[str] = None  # SHA-256 of the uploaded bytes
+
+
+# Fields that can be edited after ingest; text, entities and vectors are fixed at ingest
+EDITABLE_FIELDS = ("filename", "collection", "type_label")
+
+NO_CODE = -1
+NO_TIME = -(2 ** 63)  # imported_at missing or unparseable
+
+# column name -> dtype; dictionary-encoded columns hold codes into dict.json
+COLUMNS = {
+    "offset": "<u8",  # byte offset of the record in meta.jsonl
+    "id": "<i8",  # numeric image id; ids only grow, so the column is sorted
+    "collection": "<i4",
+    "type_label": "<i4",
+    "entities": "<u8",  # bit i set when entity type dict["entity"][i] has values
+    "imported_at": "<i8",  # epoch seconds (naive timestamps are taken as UTC)
+}
+
+
+def epoch_seconds(timestamp: str) -> int:
+    try:
+        dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except Exception:
+        return NO_TIME
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def _meta(record: Dict) -> ImageMeta:
+    # Collections, type labels and entity types repeat across rows: share one string each
+    for key in ("collection", "type_label"):
+        if record.get(key) is not None:
+            record[key] = sys.intern(record[key])
+    if record.get("entities"):
+        record["entities"] = {sys.intern(k): v for k, v in record["entities"].items()}
+    return ImageMeta(**record)
+
+
+def _parse(line: bytes) -> ImageMeta:
+    return _meta(json.loads(line))
+
+
+class MetaStore:
+    """Lazily loaded metadata: meta.jsonl stays the source of truth, with a byte-offset
+    index and dictionary-encoded attribute columns beside it so startup never parses JSON.
+
+    Edits are appended to meta.patches.jsonl and applied on read, so changing one row
+    never rewrites the log; compaction folds them back in.
+    """
+
+    def __init__(self, data_dir: Path, cache_size: int = 4096, rows: Optional[int] = None, patch_bytes: Optional[int] = None) -> None:
+        # Only offsets and fixed-width columns stay resident; OCR text and entities are
+        # read back from meta.jsonl for the (LRU-cached) rows actually returned.
+        # Given rows (and patch_bytes of the patch log), the store is a read-only view of a
+        # published snapshot: nothing is repaired or derived, later rows stay invisible
+        readonly = rows is not None
+        self.log = MetaLog(data_dir / "meta.jsonl", repair=not readonly)
+        self.patch_log = MetaLog(data_dir / "meta.patches.jsonl", repair=not readonly)
+        self.cols_dir = data_dir / "meta.cols"
+        self.dict_path = self.cols_dir / "dict.json"
+        self.cache_size = cache_size
+
+        self._cache: "OrderedDict[int, ImageMeta]" = OrderedDict()
+        self._pending: List[ImageMeta] = []
+        self._pending_cols: Dict[str, List[int]] = {name: [] for name in COLUMNS}
+        self._cols_view: Optional[Dict[str, np.ndarray]] = None
+        self._mm: Optional[mmap.mmap] = None
+        self._read_lock = threading.Lock()  # the row cache and mmap are shared by concurrent readers
+        if not readonly:
+            self.cols_dir.mkdir(parents=True, exist_ok=True)
+            self.log.path.touch()
+        # Rows are read through this handle, so they keep coming from this file even after
+        # compaction replaces meta.jsonl
+        self._fh = self.log.path.open("rb")
+
+        self.dicts: Dict[str, List[str]] = {"collection": [], "type_label": [], "entity": []}
+        self._codes: Dict[str, Dict[str, int]] = {}
+        # row -> edited fields; columns on disk hold ingest-time values, patched here in memory
+        self._patches: Dict[int, Dict] = {}
+        self.patch_bytes = 0  # how much of the patch log has been applied
+        if readonly:
+            self._cols = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+            self.apply_delta(self.read_delta(rows, patch_bytes or 0))
+            return
+        if self.dict_path.exists():
+            self._load_dicts(json.loads(self.dict_path.read_text(encoding="utf-8")))
+        else:
+            self._load_dicts({})
+        self._cols = {name: self._read_column(name) for name in COLUMNS}
+        self._sync()
+        self._apply_patches(*self._read_patches())
+
+    def _load_dicts(self, dicts: Dict[str, List[str]]) -> None:
+        self.dicts.update(dicts)
+        self._codes = {attr: {v: i for i, v in enumerate(values)} for attr, values in self.dicts.items()}
+
+    # ---------- derived files ----------
+    def _column_path(self, name: str) -> Path:
+        return self.cols_dir / f"{name}.bin"
+
+    def _read_column(self, name: str) -> np.ndarray:
+        path = self._column_path(name)
+        if not path.exists():
+            return np.zeros(0, dtype=COLUMNS[name])
+        col = np.fromfile(str(path), dtype=COLUMNS[name])
+        if path.stat().st_size % col.itemsize:
+            self._truncate_column(name, len(col))
+        return col
+
+    def _truncate_column(self, name: str, count: int) -> None:
+        with self._column_path(name).open("rb+") as f:
+            f.truncate(count * np.dtype(COLUMNS[name]).itemsize)
+
+    def _sync(self) -> None:
+        # Derived files trail the log after a crash; index whatever they are missing
+        size = self.log.path.stat().st_size if self.log.path.exists() else 0
+        offsets = self._cols["offset"]
+        start = 0
+        if len(offsets):
+            last = int(offsets[-1])
+            end = self._line_end(last) if last < size else -1
+            start = end if end >= 0 else 0
+        if start == 0:
+            for name in COLUMNS:
+                self._cols[name] = np.zeros(0, dtype=COLUMNS[name])
+                self._column_path(name).write_bytes(b"")
+        n = len(self._cols["offset"])
+        for name in COLUMNS:
+            if len(self._cols[name]) > n:
+                self._cols[name] = self._cols[name][:n]
+                self._truncate_column(name, n)
+            elif len(self._cols[name]) < n:
+                # A column fell behind the offsets: rebuild everything from the log
+                return self._rebuild()
+        if start < size:
+            with self.log.path.open("rb") as f:
+                f.seek(start)
+                pos = start
+                for line in f:
+                    self._encode_row(pos, _parse(line))
+                    pos += len(line)
+            self._write_pending_columns()
+
+    def _rebuild(self) -> None:
+        for path in self.cols_dir.glob("*.bin"):
+            if path.stem not in COLUMNS:
+                path.unlink()  # column from an older layout
+        for name in COLUMNS:
+            self._cols[name] = np.zeros(0, dtype=COLUMNS[name])
+            self._column_path(name).write_bytes(b"")
+        self._sync()
+
+    def _line_end(self, offset: int) -> int:
+        with self.log.path.open("rb") as f:
+            f.seek(offset)
+            line = f.readline()
+        return offset + len(line) if line.endswith(b"\n") else -1
+
+    def _code(self, attr: str, value: Optional[str]) -> int:
+        if value is None:
+            return NO_CODE
+        code = self._codes[attr].get(value)
+        if code is None:
+            code = len(self.dicts[attr])
+            self.dicts[attr].append(value)
+            self._codes[attr][value] = code
+        return code
+
+    def _encode_row(self, offset: int, meta: ImageMeta) -> None:
+        mask = 0
+        for etype, values in (meta.entities or {}).items():
+            if values:
+                mask |= 1 << self._code("entity", etype)
+        row = {
+            "offset": offset,
+            "id": int(meta.id),
+            "collection": self._code("collection", meta.collection),
+            "type_label": self._code("type_label", meta.type_label),
+            "entities": mask,
+            "imported_at": epoch_seconds(meta.imported_at),
+        }
+        for name, value in row.items():
+            self._pending_cols[name].append(value)
+        self._cols_view = None
+
+    def _write_pending_columns(self) -> None:
+        # Dictionary first, so every code on disk resolves
+        atomic_write_bytes(self.dict_path, json.dumps(self.dicts, ensure_ascii=False).encode("utf-8"))
+        for name, values in self._pending_cols.items():
+            arr = np.asarray(values, dtype=COLUMNS[name])
+            with self._column_path(name).open("ab") as f:
+                f.write(arr.tobytes())
+            self._cols[name] = np.concatenate([self._cols[name], arr])
+            values.clear()
+        self._cols_view = None
+
+    def _read_patches(self, stop: Optional[int] = None) -> Tuple[List[Dict], int]:
+        # Patch records past those applied, up to byte stop (default: the end of the log)
+        data = b""
+        if self.patch_log.path.exists():
+            with self.patch_log.path.open("rb") as f:
+                f.seek(self.patch_bytes)
+                data = f.read() if stop is None else f.read(stop - self.patch_bytes)
+        if stop is not None and len(data) < stop - self.patch_bytes:
+            raise SnapshotChanged(f"{self.patch_log.path} is shorter than {stop} bytes")
+        return [json.loads(line) for line in data.splitlines()], self.patch_bytes + len(data)
+
+    def _apply_patches(self, records: List[Dict], end: int) -> None:
+        for record in records:
+            row = record.pop("row")
+            if row < len(self._cols["offset"]):
+                self._patch(row, record)
+        self.patch_bytes = end
+
+    # ---------- snapshots ----------
+    @property
+    def saved(self) -> int:
+        """Rows written to meta.jsonl (and its columns)."""
+        return len(self._cols["offset"])
+
+    def read_delta(self, rows: int, patch_bytes: int) -> Dict:
+        """Read what another process appended up to a snapshot of rows rows and patch_bytes of
+        edits, without changing this store; apply_delta() then makes it visible."""
+        start = self.saved
+        cols = {}
+        for name, dtype in COLUMNS.items():
+            path = self._column_path(name)
+            itemsize = np.dtype(dtype).itemsize
+            values = np.fromfile(str(path), dtype=dtype, count=rows - start, offset=start * itemsize) if path.exists() else np.zeros(0, dtype=dtype)
+            if len(values) < rows - start:
+                raise SnapshotChanged(f"{path} holds fewer than {rows} rows")
+            cols[name] = values
+        patches = self._read_patches(patch_bytes)
+        # Read last: the dictionary is written before the columns and edits that use its codes
+        dicts = json.loads(self.dict_path.read_text(encoding="utf-8")) if self.dict_path.exists() else {}
+        return {"cols": cols, "patches": patches, "dicts": dicts}
+
+    def read_row(self, offset: int) -> ImageMeta:
+        """Parse the record at byte offset of meta.jsonl, as stored (edits not applied)."""
+        with self._read_lock:
+            line = self._read_line(offset)
+        return _parse(line)
+
+    def apply_delta(self, delta: Dict) -> None:
+        self._load_dicts(delta["dicts"])
+        for name, values in delta["cols"].items():
+            self._cols[name] = np.concatenate([self._cols[name], values])
+        self._apply_patches(*delta["patches"])
+        self._cols_view = None
+
+    # ---------- sequence protocol ----------
+    def __len__(self) -> int:
+        return len(self._cols["offset"]) + len(self._pending)
+
+    def __getitem__(self, i: int) -> ImageMeta:
+        n_saved = len(self._cols["offset"])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if i >= n_saved:
+            return self._pending[i - n_saved]
+        with self._read_lock:
+            meta = self._cache.get(i)
+            if meta is not None:
+                self._cache.move_to_end(i)
+                return meta
+            line = self._read_line(int(self._cols["offset"][i]))
+        meta = self._patched(i, _parse(line))
+        with self._read_lock:
+            self._cache[i] = meta
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return meta
+
+    def __iter__(self) -> Iterator[ImageMeta]:
+        return self.iter_from(0)
+
+    def iter_from(self, start: int = 0) -> Iterator[ImageMeta]:
+        """Stream rows start.. in order, reading the log sequentially; memory stays flat.
+
+        The log is mapped and the unsaved rows captured on the call, so the rows streamed
+        are those present now even if the log is compacted while they are consumed.
+        """
+        n_saved = len(self._cols["offset"])
+        pending = list(self._pending)[max(0, start - n_saved):]
+        mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ) if start < n_saved else None
+        pos = int(self._cols["offset"][start]) if mm is not None else 0
+
+        def rows() -> Iterator[ImageMeta]:
+            nonlocal pos
+            if mm is not None:
+                for i in range(start, n_saved):
+                    end = mm.find(b"\n", pos)
+                    yield self._patched(i, _parse(mm[pos:end]))
+                    pos = end + 1
+            yield from pending
+
+        return rows()
+
+    def _read_line(self, offset: int) -> bytes:
+        end = self._mm.find(b"\n", offset) if self._mm is not None else -1
+        if end < 0:
+            # The row was appended after the log was mapped
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            end = self._mm.find(b"\n", offset)
+        return self._mm[offset:end if end >= 0 else len(self._mm)]
+
+    def file_id(self) -> int:
+        """Inode of the meta.jsonl this store reads; compaction gives the path a new one."""
+        return os.fstat(self._fh.fileno()).st_ino
+
+    def close(self) -> None:
+        with self._read_lock:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+            self._fh.close()
+
+    # ---------- writes ----------
+    def append(self, meta: ImageMeta) -> None:
+        self._pending.append(meta)
+        self._encode_row(0, meta)  # offset is assigned on flush
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        self._pending_cols["offset"][:] = self.log.append([asdict(m) for m in self._pending])
+        self._pending.clear()
+        self._write_pending_columns()
+
+    def update(self, i: int, fields: Dict) -> ImageMeta:
+        """Edit EDITABLE_FIELDS of saved row i by appending to the patch log."""
+        unknown = [k for k in fields if k not in EDITABLE_FIELDS]
+        if unknown:
+            raise ValueError(f"fields cannot be edited: {', '.join(unknown)}")
+        if not 0 <= i < len(self._cols["offset"]):
+            raise IndexError(i)
+        self.patch_log.append([dict(fields, row=i)])
+        self.patch_bytes = self.patch_log.path.stat().st_size
+        self._patch(i, fields)
+        atomic_write_bytes(self.dict_path, json.dumps(self.dicts, ensure_ascii=False).encode("utf-8"))
+        return self[i]
+
+    def _patch(self, i: int, fields: Dict) -> None:
+        self._patches.setdefault(i, {}).update(fields)
+        for attr in ("collection", "type_label"):
+            if attr in fields:
+                self._cols[attr][i] = self._code(attr, fields[attr])
+        with self._read_lock:
+            self._cache.pop(i, None)
+        self._cols_view = None
+
+    def _patched(self, i: int, meta: ImageMeta) -> ImageMeta:
+        fields = self._patches.get(i)
+        return replace(meta, **fields) if fields else meta
+
+    def rewrite(self, metas: List[ImageMeta]) -> None:
+        self.close()
+        self.log.rewrite([asdict(m) for m in metas])
+        self._fh = self.log.path.open("rb")
+        self.patch_log.rewrite([])
+        self.patch_bytes = 0
+        self._patches.clear()
+        self._pending.clear()
+        for values in self._pending_cols.values():
+            values.clear()
+        self._cache.clear()
+        self._rebuild()
+
+    # ---------- columns ----------
+    def find(self, image_id: str) -> Optional[int]:
+        """Row of image_id by binary search over the id column, or None."""
+        try:
+            key = int(image_id)
+        except ValueError:
+            return None
+        ids = self.columns()["id"]
+        i = int(np.searchsorted(ids, key))
+        return i if i < len(ids) and ids[i] == key else None
+
+    def code(self, attr: str, value: str) -> Optional[int]:
+        """Dictionary code of value, or None if no row has it."""
+        return self._codes[attr].get(value)
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        if self._cols_view is None:
+            self._cols_view = {
+                name: np.concatenate([self._cols[name], np.asarray(self._pending_cols[name], dtype=COLUMNS[name])])
+                if self._pending_cols[name] else self._cols[name]
+                for name in COLUMNS
+            }
+        return self._cols_view
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+@dataclass
+class OcrConfig:
+    """Tesseract settings and the preprocessing applied before it runs."""
+
+    engine: str = "auto"  # "tesserocr" (libtesseract in-process), "pytesseract" (CLI per call) or "auto"
+    psm: int = 3  # page segmentation mode; 3 = fully automatic (Tesseract's default)
+    oem: int = 3  # engine mode; 3 = whatever is available
+    lang: str = "eng"
+    max_width: int = 1280  # wider captures are downscaled to this width first (never upscaled)
+    binarize: bool = True  # Otsu threshold to pure black/white
+    tile_height: int = 1600  # taller captures are cut into bands OCR'd in parallel
+    tile_overlap: int = 64  # rows shared by neighbouring bands so no text line is cut in half
+    tile_workers: int = 4
+    skip_blank: bool = True  # bands without ink are never sent to Tesseract
+    skip_photos: bool = False  # nor, if set, are bands textured edge to edge like a photo
+
+    @classmethod
+    def from_env(cls) -> "OcrConfig":
+        env = os.environ
+        return cls(
+            engine=env.get("QUARRY_OCR_ENGINE", "auto"),
+            psm=int(env.get("QUARRY_OCR_PSM", "3")),
+            oem=int(env.get("QUARRY_OCR_OEM", "3")),
+            lang=env.get("QUARRY_OCR_LANG", "eng"),
+            max_width=int(env.get("QUARRY_OCR_MAX_WIDTH", "1280")),
+            binarize=env.get("QUARRY_OCR_BINARIZE", "1") != "0",
+            tile_height=int(env.get("QUARRY_OCR_TILE_HEIGHT", "1600")),
+            skip_photos=env.get("QUARRY_OCR_SKIP_PHOTOS", "0") == "1",
+        )
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    hist = np.bincount(gray.ravel(), minlength=256).astype("float64")
+    total = hist.sum()
+    if total == 0:
+        return 128
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    m0 = np.cumsum(hist * levels)
+    w1 = total - w0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (m0[-1] * w0 / total - m0) ** 2 / (w0 * w1)
+    return int(np.nanargmax(between)) if np.isfinite(between).any() else 128
+
+
+def preprocess(image: Image.Image, config: OcrConfig) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Grayscale, downscale and binarize; returns (grayscale, Tesseract input, scale applied)."""
+    gray = image.convert("L")
+    scale = 1.0
+    if config.max_width and gray.width > config.max_width:
+        scale = config.max_width / gray.width
+        gray = gray.resize((config.max_width, max(1, round(gray.height * scale))), Image.LANCZOS)
+    arr = np.asarray(gray, dtype="uint8")
+    if not config.binarize:
+        return arr, arr, scale
+    return arr, np.where(arr > otsu_threshold(arr), 255, 0).astype("uint8"), scale
+
+
+PHOTO_CELL = 32  # side of the squares whose texture tells photos from UI
+
+
+def _is_photo(band: np.ndarray) -> bool:
+    # UI has flat background between text lines, whatever its colour; a photo has texture
+    # in nearly every cell. A mid-tone or dark background alone never makes a band a photo.
+    rows, cols = band.shape[0] // PHOTO_CELL, band.shape[1] // PHOTO_CELL
+    if rows == 0 or cols == 0:
+        return False
+    cells = band[:rows * PHOTO_CELL, :cols * PHOTO_CELL].reshape(rows, PHOTO_CELL, cols, PHOTO_CELL)
+    flat = np.count_nonzero(cells.std(axis=(1, 3)) < 4)
+    return flat < 0.05 * rows * cols
+
+
+def _has_text(band: np.ndarray, config: OcrConfig) -> bool:
+    if band.size == 0:
+        return False
+    if config.skip_blank and int(band.max()) - int(band.min()) < 32:
+        return False
+    if config.skip_photos and _is_photo(band):
+        return False
+    return True
+
+
+def text_tiles(gray: np.ndarray, config: OcrConfig) -> List[Tuple[int, int, int, int]]:
+    """(top, bottom, own_top, own_bottom) bands of the grayscale image worth OCR'ing; each band
+    owns the rows [own_top, own_bottom) so blocks read twice in an overlap are kept once."""
+    height = gray.shape[0]
+    step = max(1, config.tile_height)
+    tiles = []
+    for own_top in range(0, height, step):
+        own_bottom = min(height, own_top + step)
+        top = max(0, own_top - config.tile_overlap)
+        bottom = min(height, own_bottom + config.tile_overlap)
+        if _has_text(gray[own_top:own_bottom], config):
+            tiles.append((top, bottom, own_top, own_bottom))
+    return tiles
+
+
+class PytesseractEngine:
+    """Runs the tesseract CLI per call: a process start, a temp file and a model load each time."""
+
+    name = "pytesseract"
+
+    def image_to_data(self, band: np.ndarray, config: OcrConfig) -> Dict:
+        import pytesseract
+
+        return pytesseract.image_to_data(
+            Image.fromarray(band),
+            lang=config.lang,
+            config=f"--psm {config.psm} --oem {config.oem}",
+            output_type=pytesseract.Output.DICT,
+        )
+
+
+class TesserocrEngine:
+    """libtesseract through tesserocr: long-lived APIs with the model loaded, checked out by
+    whichever thread OCRs a band and fed images in memory. Returns the same column dict as
+    pytesseract.image_to_data."""
+
+    name = "tesserocr"
+
+    def __init__(self) -> None:
+        import tesserocr  # optional dependency; ImportError lets "auto" fall back
+
+        self._tesserocr = tesserocr
+        self._lock = threading.Lock()
+        self._idle: Dict[Tuple[str, int, int], List] = {}  # loaded APIs not in use, by settings
+
+    def _checkout(self, config: OcrConfig):
+        key = (config.lang, config.psm, config.oem)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if idle:
+                return key, idle.pop()
+        # Only as many APIs are ever loaded as bands run at once
+        return key, self._tesserocr.PyTessBaseAPI(lang=config.lang, psm=config.psm, oem=config.oem)
+
+    def _release(self, key: Tuple[str, int, int], api) -> None:
+        with self._lock:
+            self._idle[key].append(api)
+
+    def warm(self, config: OcrConfig) -> None:
+        self._release(*self._checkout(config))
+
+    def image_to_data(self, band: np.ndarray, config: OcrConfig) -> Dict:
+        key, api = self._checkout(config)
+        try:
+            return self._read(api, band)
+        finally:
+            self._release(key, api)
+
+    def _read(self, api, band: np.ndarray) -> Dict:
+        api.SetImage(Image.fromarray(band))
+        api.Recognize()
+        out: Dict[str, List] = {"text": [], "conf": [], "left": [], "top": [], "width": [], "height": []}
+        it = api.GetIterator()
+        if it is None:
+            return out
+        level = self._tesserocr.RIL.WORD
+        for word in self._tesserocr.iterate_level(it, level):
+            box = word.BoundingBox(level)
+            text = word.GetUTF8Text(level)
+            if not text or box is None:
+                continue
+            x0, y0, x1, y1 = box
+            out["text"].append(text)
+            out["conf"].append(word.Confidence(level))
+            out["left"].append(x0)
+            out["top"].append(y0)
+            out["width"].append(x1 - x0)
+            out["height"].append(y1 - y0)
+        return out
+
+
+OCR_ENGINES = {"tesserocr": TesserocrEngine, "pytesseract": PytesseractEngine}
+_engines: Dict[str, object] = {}
+_engines_lock = threading.Lock()
+_tiles: Optional[ThreadPoolExecutor] = None
+
+
+def get_engine(name: str = "auto"):
+    """The process-wide engine for name; created once so its model stays loaded."""
+    with _engines_lock:
+        engine = _engines.get(name)
+        if engine is None:
+            if name == "auto":
+                try:
+                    engine = TesserocrEngine()
+                except ImportError:
+                    engine = PytesseractEngine()
+            elif name in OCR_ENGINES:
+                engine = OCR_ENGINES[name]()
+            else:
+                raise ValueError(f"unknown OCR engine {name!r}; expected auto or one of {', '.join(OCR_ENGINES)}")
+            _engines[name] = engine
+        return engine
+
+
+def warm_engine(config: OcrConfig) -> None:
+    # OCR pool initializer: load the engine (and language data) before the first image arrives
+    engine = get_engine(config.engine)
+    if isinstance(engine, TesserocrEngine):
+        engine.warm(config)
+
+
+def _tile_pool(workers: int) -> ThreadPoolExecutor:
+    """The process-wide executor tall captures' bands run on; its threads outlive each image."""
+    global _tiles
+    with _engines_lock:
+        if _tiles is None:
+            _tiles = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="quarry-ocr-tile")
+        return _tiles
+
+
+def _tesseract(band: np.ndarray, config: OcrConfig) -> Dict:
+    return get_engine(config.engine).image_to_data(band, config)
+
+
+def _blocks(data: Dict, top: int, own_top: int, own_bottom: int, scale: float) -> List[Dict]:
+    blocks = []
+    for i in range(len(data.get("text", []))):
+        text = data["text"][i] or ""
+        if text.strip() == "":
+            continue
+        conf_raw = data["conf"][i] if isinstance(data.get("conf"), list) else "0"
+        try:
+            conf = float(conf_raw)
+        except Exception:
+            conf = -1.0
+        left, y, width, height = (int(data[k][i]) for k in ("left", "top", "width", "height"))
+        y += top
+        if not own_top <= y + height // 2 < own_bottom:
+            continue  # read by the neighbouring band, which owns these rows
+        # Boxes are reported in the original image's pixels
+        blocks.append({
+            "text": text,
+            "conf": conf,
+            "bbox": {"x": round(left / scale), "y": round(y / scale), "w": round(width / scale), "h": round(height / scale)},
+        })
+    return blocks
+
+
+def ocr_image(image: Image.Image, config: OcrConfig) -> Tuple[str, List[Dict], Dict[str, float]]:
+    """OCR one image into (text, word blocks, per-stage seconds)."""
+    timings: Dict[str, float] = {}
+    t0 = time.perf_counter()
+    gray, prepared, scale = preprocess(image, config)
+    t1 = time.perf_counter()
+    tiles = text_tiles(gray, config)
+    t2 = time.perf_counter()
+
+    def run(tile: Tuple[int, int, int, int]) -> List[Dict]:
+        top, bottom, own_top, own_bottom = tile
+        return _blocks(_tesseract(prepared[top:bottom], config), top, own_top, own_bottom, scale)
+
+    if len(tiles) > 1 and config.tile_workers > 1:
+        # Tesseract releases the GIL (tesserocr) or runs in a subprocess (CLI), so bands overlap fully
+        per_tile = list(_tile_pool(config.tile_workers).map(run, tiles))
+    else:
+        per_tile = [run(t) for t in tiles]
+    t3 = time.perf_counter()
+
+    blocks = [b for tile_blocks in per_tile for b in tile_blocks]
+    timings.update({"preprocess": t1 - t0, "regions": t2 - t1, "tesseract": t3 - t2})
+    return " ".join(b["text"] for b in blocks).strip(), blocks, timings
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, features
+
+
+# size name -> longest edge in pixels
+PREVIEW_SIZES: Dict[str, int] = {"small": 256, "medium": 768}
+PREVIEW_FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg")}
+
+
+class PreviewStore:
+    """Downscaled copies of images/{id}.jpg, rendered on first request and kept under previews/.
+
+    Files never change once written (an image id always names the same upload and ids are
+    never reused after a delete), so they are served with strong ETags and year-long cache headers.
+    """
+
+    def __init__(self, data_dir: Path, quality: int = 80) -> None:
+        self.images_dir = data_dir / "images"
+        self.dir = data_dir / "previews"
+        self.quality = quality
+        self.webp = features.check("webp")
+        self._lock = threading.Lock()
+        self._rendering: Dict[Path, threading.Lock] = {}
+
+    def format_for(self, accept: Optional[str]) -> str:
+        return "webp" if self.webp and accept and "image/webp" in accept else "jpg"
+
+    def path(self, image_id: str, size: str, fmt: str = "jpg") -> Optional[Path]:
+        """Path of the rendered preview, rendering it now if needed; None if the image is unknown."""
+        if size not in PREVIEW_SIZES or fmt not in PREVIEW_FORMATS:
+            raise ValueError(f"unknown preview size {size!r}; expected one of {', '.join(PREVIEW_SIZES)}")
+        # Ids are checked before any path is built from them, whatever the caller already checked
+        if not image_id.isalnum():
+            return None
+        out = self.dir / size / f"{image_id}.{fmt}"
+        if out.exists():
+            return out
+        source = self.images_dir / f"{image_id}.jpg"
+        if not source.exists():
+            return None
+        # One render per file even when a results page requests it many times at once
+        with self._lock:
+            lock = self._rendering.setdefault(out, threading.Lock())
+        with lock:
+            if not out.exists():
+                self._render(source, out, PREVIEW_SIZES[size], fmt)
+        with self._lock:
+            self._rendering.pop(out, None)
+        return out
+
+    def _render(self, source: Path, out: Path, edge: int, fmt: str) -> None:
+        with Image.open(source) as image:
+            image = image.convert("RGB")
+            image.thumbnail((edge, edge), Image.LANCZOS)
+            out.parent.mkdir(parents=True, exist_ok=True)
+            tmp = out.with_name(out.name + ".tmp")
+            image.save(tmp, format=PREVIEW_FORMATS[fmt][0], quality=self.quality)
+        os.replace(tmp, out)
+
+    @staticmethod
+    def etag(path: Path) -> str:
+        st = path.stat()
+        return f'"{path.stem}-{path.parent.name}-{path.suffix[1:]}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+    @staticmethod
+    def media_type(path: Path) -> str:
+        return PREVIEW_FORMATS[path.suffix[1:]][1]
+
+    def remove(self, image_id: str) -> None:
+        """Delete every rendered preview of a deleted image."""
+        for size in PREVIEW_SIZES:
+            for fmt in PREVIEW_FORMATS:
+                (self.dir / size / f"{image_id}.{fmt}").unlink(missing_ok=True)
+
+    def render_all(self, image_id: str, sizes: Tuple[str, ...]) -> None:
+        for size in sizes:
+            self.path(image_id, size)
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class QueryEncoder:
+    """Query embedding front-end: an LRU/TTL cache of normalized vectors plus micro-batching.
+
+    Concurrent cache misses that arrive within `batch_window` seconds of each other are
+    encoded with a single call; the first caller of a window runs the batch for everyone.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[str]], np.ndarray],
+        model_name: str,
+        cache_size: int = 2048,
+        ttl: float = 600.0,
+        batch_window: float = 0.003,
+        max_batch: int = 64,
+    ) -> None:
+        self._encode = encode
+        self.model_name = model_name
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]]" = OrderedDict()
+        self._pending: "OrderedDict[str, Future]" = OrderedDict()
+        self._leader_active = False
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "expired": 0, "evictions": 0, "batches": 0, "batched_queries": 0, "max_batch_size": 0}
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.split())
+
+    def encode(self, query: str) -> np.ndarray:
+        """Return the (1, dim) float32 embedding of query."""
+        text = self.normalize(query)
+        key = (self.model_name, text)
+        lead = False
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                if time.monotonic() - entry[0] <= self.ttl:
+                    self._cache.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                del self._cache[key]
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            fut = self._pending.get(text)
+            if fut is None:
+                fut = Future()
+                self._pending[text] = fut
+                if not self._leader_active:
+                    self._leader_active = True
+                    lead = True
+            else:
+                self._stats["coalesced"] += 1
+        if lead:
+            self._run_batches()
+        return fut.result()
+
+    def _run_batches(self) -> None:
+        # Give concurrent callers a moment to join, then drain until nothing is pending
+        time.sleep(self.batch_window)
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._leader_active = False
+                    return
+                batch: List[Tuple[str, Future]] = []
+                while self._pending and len(batch) < self.max_batch:
+                    batch.append(self._pending.popitem(last=False))
+            texts = [text for text, _ in batch]
+            try:
+                vectors = np.array(self._encode(texts), dtype="float32").reshape(len(texts), -1)
+                vectors.setflags(write=False)  # cached vectors are shared between callers
+            except BaseException as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            now = time.monotonic()
+            with self._lock:
+                self._stats["batches"] += 1
+                self._stats["batched_queries"] += len(batch)
+                self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+                for (text, _), vec in zip(batch, vectors):
+                    self._cache[(self.model_name, text)] = (now, vec[None, :])
+                    self._cache.move_to_end((self.model_name, text))
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+                    self._stats["evictions"] += 1
+            for (_, fut), vec in zip(batch, vectors):
+                fut.set_result(vec[None, :])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        with self._lock:
+            s: Dict[str, Optional[float]] = dict(self._stats)
+            lookups = self._stats["hits"] + self._stats["misses"]
+            s["hit_rate"] = self._stats["hits"] / lookups if lookups else None
+            s["mean_batch_size"] = self._stats["batched_queries"] / self._stats["batches"] if self._stats["batches"] else None
+            s["cache_entries"] = len(self._cache)
+            s["cache_size"] = self.cache_size
+        return s
@@ -0,0 +1,483 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+from .content_cache import content_hash
+from .indexer import DEFAULT_DATA_DIR, SEARCH_MODES, ScreenshotIndexer, fuse, log
+from .metastore import ImageMeta
+from .snapshots import SNAPSHOT_FILE
+from .storage import VECTOR_DTYPES, BlobLog, MetaLog, SnapshotChanged, VectorLog, atomic_write_bytes, fsync_dir
+
+
+SHARDS_DIR = "shards"
+LAYOUT_FILE = "layout.json"
+RESHARD_FILE = "reshard.json"
+SHARD_KEYS = ("collection", "hash")
+
+UNFILED = "_unfiled"  # shard of screenshots without a collection
+_CLEAN_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+
+
+def shard_name(collection: Optional[str]) -> str:
+    """Directory name of a collection's shard: the name itself when it is filesystem-safe."""
+    if collection is None:
+        return UNFILED
+    if _CLEAN_NAME.fullmatch(collection):
+        return collection
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "-", collection).strip("-.")[:40] or "c"
+    return f"{slug}-{content_hash(collection.encode('utf-8'))[:8]}"
+
+
+def make_layout(by: str, count: Optional[int] = None, routes: Optional[Dict[str, str]] = None) -> Dict:
+    """Validated layout: shard by collection (routes send collections to a shared shard) or by content hash."""
+    if by not in SHARD_KEYS:
+        raise ValueError(f"unknown shard key {by!r}; expected one of {', '.join(SHARD_KEYS)}")
+    if by == "hash":
+        if not count or count < 1:
+            raise ValueError("hash sharding needs a shard count (QUARRY_SHARDS)")
+        return {"by": "hash", "count": count}
+    for name in (routes or {}).values():
+        if not _CLEAN_NAME.fullmatch(name):
+            raise ValueError(f"invalid shard name {name!r}")
+    return {"by": "collection", "routes": dict(routes or {})}
+
+
+def read_layout(data_dir: Path) -> Optional[Dict]:
+    """The data dir's shard layout, or None if it is not sharded."""
+    path = data_dir / SHARDS_DIR / LAYOUT_FILE
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+
+
+def route(layout: Dict, collection: Optional[str], sha: str) -> str:
+    """Shard a screenshot is stored in, by its collection or its content hash."""
+    if layout["by"] == "hash":
+        return f"h{int(sha[:8], 16) % layout['count']:03d}"
+    if collection is None:
+        return UNFILED
+    return layout["routes"].get(collection) or shard_name(collection)
+
+
+class ShardedIndexer:
+    """A library split into shards, each a ScreenshotIndexer with its own vector segment, ANN
+    index, metadata, postings and tombstones under shards/<name>/.
+
+    New screenshots go to the shard of their collection (or of their content hash). A search
+    encodes the query once, asks only the shards whose collection dictionary holds the
+    filtered collection, in parallel, and merges their top-k lists, so a collection-scoped
+    query costs what that collection's shard holds. The data dir itself is the root shard:
+    rows indexed before sharding stay searchable there until scripts/reshard.py moves them,
+    and it owns what the shards share (model, caches, OCR pool, images, ids, writer lock).
+    """
+
+    def __init__(self, data_dir: Path = DEFAULT_DATA_DIR, by: Optional[str] = None, count: Optional[int] = None, readonly: bool = False, workers: Optional[int] = None, indexer_class: Type[ScreenshotIndexer] = ScreenshotIndexer, **kwargs) -> None:
+        self.data_dir = data_dir
+        self.readonly = readonly
+        self.indexer_class = indexer_class
+        self._kwargs = kwargs
+        self.root = indexer_class(data_dir, readonly=readonly, **kwargs)
+        self.dim = self.root.dim
+        self.dir = data_dir / SHARDS_DIR
+        self.shards: Dict[str, ScreenshotIndexer] = {}
+        self._lock = threading.Lock()  # shards are opened lazily, by concurrent ingest workers
+        self._ingest_listeners: List[Callable[[ScreenshotIndexer, List[int], Any], None]] = []
+        self._refresh_listeners: List[Callable[[], None]] = []
+        self._follower: Optional[threading.Thread] = None
+
+        if not readonly:
+            _finish_reshard(data_dir)
+        layout = read_layout(data_dir)
+        if layout is None:
+            if by is None:
+                raise ValueError(f"{data_dir} is not sharded; pass by='collection' or by='hash'")
+            layout = make_layout(by, count)
+            if not readonly:
+                self.dir.mkdir(parents=True, exist_ok=True)
+                atomic_write_bytes(self.dir / LAYOUT_FILE, json.dumps(layout).encode("utf-8"))
+        elif by is not None and (by != layout["by"] or (count is not None and count != layout.get("count"))):
+            raise ValueError(f"{data_dir} is sharded by {layout['by']}; change it with scripts/reshard.py")
+        self.layout = layout
+
+        self._open_shards()
+        # Searches fan out over this many shards at once
+        workers = workers or int(os.environ.get("QUARRY_SHARD_WORKERS", min(8, os.cpu_count() or 1)))
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="quarry-shard")
+
+    # ---------- shards ----------
+    def _open_shards(self) -> None:
+        if not self.readonly:
+            _finish_reshard(self.data_dir)
+            self.layout = read_layout(self.data_dir) or self.layout
+        if self.dir.exists():
+            for path in sorted(p for p in self.dir.iterdir() if p.is_dir()):
+                # A replica only opens shards the writer has published
+                if not self.readonly or (path / SNAPSHOT_FILE).exists():
+                    self._open(path.name)
+        if self.readonly:
+            return
+        # Ids are drawn from the root: it hands out none that a shard already used
+        self.root._next_id = max([self.root._next_id] + [shard._next_id for shard in self.shards.values()])
+        marker = self.dir / RESHARD_FILE
+        if marker.exists():
+            # Rows resharding copied out of the root leave it now, images kept
+            self.root.delete([f"{i:08d}" for i in json.loads(marker.read_text(encoding="utf-8"))["moved"]], remove_images=False)
+            marker.unlink()
+
+    def _open(self, name: str) -> ScreenshotIndexer:
+        shard = self.indexer_class(self.dir / name, readonly=self.readonly, parent=self.root, **self._kwargs)
+        for listener in self._ingest_listeners:
+            shard.add_ingest_listener(listener)
+        self.shards[name] = shard
+        return shard
+
+    def _shard(self, name: str) -> ScreenshotIndexer:
+        with self._lock:
+            return self.shards.get(name) or self._open(name)
+
+    def parts(self) -> List[ScreenshotIndexer]:
+        """The root followed by every shard."""
+        with self._lock:
+            return [self.root, *self.shards.values()]
+
+    def _relevant(self, collection: Optional[str]) -> List[ScreenshotIndexer]:
+        # A shard that never held the collection has no dictionary code for it
+        return [
+            part for part in self.parts()
+            if part.count() and (collection is None or part.metas.code("collection", collection) is not None)
+        ]
+
+    def _gather(self, fn: Callable[[ScreenshotIndexer], Any], parts: List[ScreenshotIndexer]) -> List[Any]:
+        if len(parts) <= 1:
+            return [fn(part) for part in parts]
+        return list(self._pool.map(fn, parts))
+
+    def _owner(self, image_id: str) -> Optional[ScreenshotIndexer]:
+        for part in self.parts():
+            if part.get_meta(image_id) is not None:
+                return part
+        return None
+
+    # ---------- ingest, deletes and edits ----------
+    def index_image_bytes(self, content: bytes, filename: str, collection: Optional[str] = None) -> Dict:
+        return self.index_images_bytes([(content, filename)], collection)[0]
+
+    def index_images_bytes(self, items: List[Tuple[bytes, str]], collection: Optional[str] = None) -> List[Dict]:
+        """Route each upload to its shard and ingest there; results in input order."""
+        self.root._writable()
+        results: List[Optional[Dict]] = [None] * len(items)
+        groups: Dict[str, List[int]] = {}
+        for i, (content, _) in enumerate(items):
+            sha = content_hash(content)
+            # Shards dedup only what they hold: known content elsewhere links here first
+            duplicate = self._duplicate(sha) if self.root.dedup else None
+            if duplicate is not None:
+                results[i] = duplicate
+            else:
+                groups.setdefault(route(self.layout, collection, sha), []).append(i)
+        for name, positions in groups.items():
+            metas = self._shard(name).index_images_bytes([items[i] for i in positions], collection)
+            for i, meta in zip(positions, metas):
+                results[i] = meta
+        return results  # type: ignore[return-value]
+
+    def _duplicate(self, sha: str) -> Optional[Dict]:
+        entry = self.root.content_cache.get(sha)
+        owner = self._owner(entry["image_id"]) if entry is not None and entry["image_id"] is not None else None
+        return owner.duplicate_of(sha) if owner is not None else None
+
+    def delete(self, image_ids: List[str]) -> List[str]:
+        self.root._writable()
+        deleted: List[str] = []
+        for part in self.parts():
+            deleted.extend(part.delete(image_ids))
+        return deleted
+
+    def update(self, image_id: str, **fields) -> Optional[Dict]:
+        """Edit a screenshot in place: a new collection does not move it to that collection's shard
+        (searches for the collection find it through its shard's dictionary); reshard to move it."""
+        owner = self._owner(image_id)
+        return None if owner is None else owner.update(image_id, **fields)
+
+    # ---------- reads ----------
+    def count(self) -> int:
+        return sum(part.count() for part in self.parts())
+
+    def get_meta(self, image_id: str) -> Optional[ImageMeta]:
+        for part in self.parts():
+            meta = part.get_meta(image_id)
+            if meta is not None:
+                return meta
+        return None
+
+    def ocr_payload(self, image_id: str) -> Optional[bytes]:
+        for part in self.parts():
+            payload = part.ocr_payload(image_id)
+            if payload is not None:
+                return payload
+        return None
+
+    def search(self, query: str, k: int = 12, collection: Optional[str] = None, entity_type: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, type_label: Optional[str] = None, mode: str = "hybrid") -> List[Dict]:
+        """Scatter-gather ScreenshotIndexer.search over the shards that can hold matches.
+
+        Cosine scores merge exactly; BM25 scores use each shard's own term statistics.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"unknown search mode {mode!r}; expected one of {', '.join(SEARCH_MODES)}")
+        q_vec = None if mode == "lexical" else self.root.query_encoder.encode(query)
+        filters = dict(collection=collection, entity_type=entity_type, start_date=start_date, end_date=end_date, type_label=type_label)
+        parts = self._relevant(collection)
+        owners: Dict[str, ScreenshotIndexer] = {}
+        semantic: List[Tuple[str, float]] = []
+        lexical: List[Tuple[str, float]] = []
+        for part, (sem, lex) in zip(parts, self._gather(lambda part: part.ranked(query, q_vec, k, mode, **filters), parts)):
+            owners.update((image_id, part) for image_id, _ in itertools.chain(sem, lex))
+            semantic.extend(sem)
+            lexical.extend(lex)
+        depth = max(k, self.root.rrf_depth) if mode == "hybrid" else k
+        semantic, lexical = (sorted(hits, key=lambda hit: (-hit[1], hit[0]))[:depth] for hits in (semantic, lexical))
+        out: List[Dict] = []
+        for image_id, score in fuse(semantic, lexical, k, mode):
+            out.extend(owners[image_id].results_for([(image_id, score)]))
+        return out
+
+    def results_for(self, scored_ids: List[Tuple[str, float]]) -> List[Dict]:
+        """Search-style payloads for precomputed (id, score) pairs, skipping unknown ids."""
+        out: List[Dict] = []
+        parts = self.parts()
+        for image_id, score in scored_ids:
+            for part in parts:
+                found = part.results_for([(image_id, score)])
+                if found:
+                    out.extend(found)
+                    break
+        return out
+
+    def score_query(self, query: str, vectors):
+        return self.root.score_query(query, vectors)
+
+    # ---------- export ----------
+    def page(self, cursor: int, limit: Optional[int]) -> Tuple[int, Optional[int], Optional[int]]:
+        """Bounds of up to limit live rows with ids >= cursor across every shard, and the next cursor.
+
+        Unlike ScreenshotIndexer.page the bounds are image ids [start, stop) (stop None: to
+        the end); iter_metas and iter_vectors take them back the same way.
+        """
+        import numpy as np
+
+        if limit is None:
+            return cursor, None, None
+        ids = np.sort(np.concatenate([part.live_ids(cursor, limit + 1) for part in self.parts()]))
+        if len(ids) <= limit:
+            return cursor, None, None
+        return cursor, int(ids[limit]), int(ids[limit])
+
+    def iter_metas(self, start: int = 0, stop: Optional[int] = None):
+        """Stream live rows with ids in [start, stop), in id order across shards."""
+        streams = [
+            itertools.takewhile(lambda meta: stop is None or int(meta.id) < stop, part.iter_metas(part.page(start, None)[0]))
+            for part in self.parts()
+        ]
+        return heapq.merge(*streams, key=lambda meta: int(meta.id))
+
+    def iter_vectors(self, start: int = 0, stop: Optional[int] = None, chunk: int = 4096):
+        """Yield float32 blocks of the vectors of iter_metas(start, stop), row for row."""
+        import numpy as np
+
+        def rows(part: ScreenshotIndexer):
+            for ids, block in part.iter_vectors(part.page(start, None)[0], chunk=chunk, with_ids=True):
+                for image_id, vector in zip(ids.tolist(), block):
+                    if stop is not None and image_id >= stop:
+                        return
+                    yield image_id, vector
+
+        streams = [rows(part) for part in self.parts()]
+
+        def blocks():
+            batch = []
+            for _, vector in heapq.merge(*streams, key=itemgetter(0)):
+                batch.append(vector)
+                if len(batch) == chunk:
+                    yield np.stack(batch)
+                    batch = []
+            if batch:
+                yield np.stack(batch)
+
+        return blocks()
+
+    # ---------- listeners and snapshots ----------
+    def add_ingest_listener(self, listener: Callable[[ScreenshotIndexer, List[int], Any], None]) -> None:
+        """Call listener(shard, offsets, vectors) after each batch committed to any shard."""
+        with self._lock:
+            self._ingest_listeners.append(listener)
+            for part in (self.root, *self.shards.values()):
+                part.add_ingest_listener(listener)
+
+    def add_refresh_listener(self, listener: Callable[[], None]) -> None:
+        """Call listener() after a read-only replica moved any shard to a new snapshot."""
+        self._refresh_listeners.append(listener)
+
+    def refresh(self) -> bool:
+        """Move every shard of a read-only replica to its newest snapshot, and open shards the
+        writer created since; True if anything moved."""
+        moved = False
+        for part in self.parts():
+            try:
+                moved = part.refresh() or moved
+            except SnapshotChanged:
+                pass  # retried with the writer's next snapshot
+        if self.dir.exists():
+            for path in sorted(self.dir.iterdir()):
+                if path.name not in self.shards and (path / SNAPSHOT_FILE).exists():
+                    with self._lock:
+                        self._open(path.name)
+                    moved = True
+        if moved:
+            for listener in self._refresh_listeners:
+                listener()
+        return moved
+
+    def follow(self) -> None:
+        """Poll for new snapshots of every shard in a background thread (read-only replicas)."""
+        if self._follower is not None:
+            return
+        self._follower = threading.Thread(target=self._follow, name="quarry-follow", daemon=True)
+        self._follower.start()
+
+    def _follow(self) -> None:
+        while True:
+            time.sleep(self.root.snapshot_poll)
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("snapshot refresh failed")
+
+    def stats(self) -> Dict:
+        stats = self.root.stats()
+        shards = {}
+        for part in self.parts():
+            part_stats = stats if part is self.root else part.stats()
+            shards[part.shard or "(root)"] = {"images": part_stats["images"], "deleted": part_stats["deleted"], "vector_bytes": part_stats["vectors"]["bytes"]}
+        stats["images"] = sum(s["images"] for s in shards.values())
+        stats["deleted"] = sum(s["deleted"] for s in shards.values())
+        stats["vectors"]["bytes"] = sum(s["vector_bytes"] for s in shards.values())
+        stats["sharding"] = dict(self.layout, shards=shards)
+        return stats
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False)
+        for shard in self.shards.values():
+            shard.close()
+        self.root.close()
+
+
+# ---------- resharding ----------
+def reshard(data_dir: Path, by: str, count: Optional[int] = None, routes: Optional[Dict[str, str]] = None, indexer_class: Type[ScreenshotIndexer] = ScreenshotIndexer, **kwargs) -> Dict[str, int]:
+    """Move every live row to the shard a new layout routes it to; returns rows per shard.
+
+    Splits (more hash shards, a collection routed back to its own shard), merges (fewer hash
+    shards, collections routed to a shared one) and moves rows left behind by edits or by
+    an unsharded data dir. Offline: it takes the writer lock, and replicas should restart
+    after. Shards that neither gain nor lose rows are kept as they are; the rest are written
+    afresh in id order under shards.new/ and swapped in together, then rows copied out of
+    the root are tombstoned there and the root compacted. Ids, images and previews stay.
+    An interrupted run is finished or discarded on the next open; rows are never lost.
+    """
+    import numpy as np
+    from .albums import AlbumResults
+
+    layout = make_layout(by, count, routes)
+    ix = ShardedIndexer(data_dir, by=None if read_layout(data_dir) else by, count=count, indexer_class=indexer_class, **kwargs)
+    plan: Dict[str, List[Tuple[int, ScreenshotIndexer, int]]] = {}  # shard -> (id, part, offset)
+    leaving = set()  # parts some of whose rows go elsewhere
+    moved: List[int] = []  # root rows copied out
+    for part in ix.parts():
+        ids = part.metas.columns()["id"]
+        for meta in part.iter_metas():
+            target = route(layout, meta.collection, meta.content_hash or content_hash(meta.id.encode("utf-8")))
+            plan.setdefault(target, []).append((int(meta.id), part, int(np.searchsorted(ids, int(meta.id)))))
+            if target != part.shard:
+                leaving.add(part.shard)
+                if part is ix.root:
+                    moved.append(int(meta.id))
+
+    staging = data_dir / "shards.new"
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+    keep = []
+    for name, rows in plan.items():
+        if name in ix.shards and name not in leaving and all(part.shard == name for _, part, _ in rows):
+            keep.append(name)
+        else:
+            _write_shard(staging / name, rows, ix.dim, ix.root.vector_dtype)
+    atomic_write_bytes(staging / LAYOUT_FILE, json.dumps(layout).encode("utf-8"))
+    # Ids of rows in dropped shards are not handed out again either
+    atomic_write_bytes(data_dir / "next_id", str(ix.root._next_id).encode("utf-8"))
+    # The marker commits the new layout: from here on an open finishes the swap
+    atomic_write_bytes(staging / RESHARD_FILE, json.dumps({"keep": keep, "moved": moved}).encode("utf-8"))
+    fsync_dir(staging)
+
+    for shard in ix.shards.values():
+        shard.close()
+    ix.shards.clear()
+    ix._open_shards()
+    if ix.root.count() < len(ix.root.metas):
+        ix.root.compact()
+    # Album results count rows per shard, and rows moved
+    AlbumResults(data_dir).clear()
+    out = {part.shard or "(root)": part.count() for part in ix.parts()}
+    ix.close()
+    return out
+
+
+def _write_shard(path: Path, rows: List[Tuple[int, ScreenshotIndexer, int]], dim: int, dtype: str) -> None:
+    import numpy as np
+
+    rows = sorted(rows, key=itemgetter(0))
+    # A rerun after an interrupted one finds rows both in the root and their new shard
+    rows = [row for i, row in enumerate(rows) if i == 0 or row[0] != rows[i - 1][0]]
+    path.mkdir(parents=True)
+    MetaLog(path / "meta.jsonl").rewrite([asdict(part.metas[offset]) for _, part, offset in rows])
+    vectors = VectorLog(path / f"vectors.{VECTOR_DTYPES[dtype][2]}", dim, dtype)
+    vectors.path.write_bytes(b"")
+    step = 4096
+    for lo in range(0, len(rows), step):
+        vectors.append(np.stack([part.index.reconstruct_n(offset, 1)[0] for _, part, offset in rows[lo:lo + step]]))
+    vectors.close()
+    ocr = BlobLog(path / "ocr.seg")
+    for _, part, offset in rows:
+        ocr.append(part.ocr_log.get(offset))
+    ocr.flush()
+    ocr.close()
+    atomic_write_bytes(path / "next_id", str(rows[-1][0] + 1).encode("utf-8"))
+
+
+def _finish_reshard(data_dir: Path) -> None:
+    # shards.new/ with its marker replaces shards/ (moving kept shards over first); without
+    # the marker it is an unfinished build and dropped. The root's part happens on open.
+    staging, live, old = data_dir / "shards.new", data_dir / SHARDS_DIR, data_dir / "shards.old"
+    if (staging / RESHARD_FILE).exists():
+        source = live if live.exists() else old
+        for name in json.loads((staging / RESHARD_FILE).read_text(encoding="utf-8"))["keep"]:
+            if not (staging / name).exists():
+                os.replace(source / name, staging / name)
+        if live.exists():
+            shutil.rmtree(old, ignore_errors=True)
+            os.replace(live, old)
+        os.replace(staging, live)
+        fsync_dir(data_dir)
+    shutil.rmtree(old, ignore_errors=True)
+    shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import json
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from .storage import atomic_write_bytes
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+    import msvcrt
+
+
+SNAPSHOT_FILE = "snapshot.json"
+LOCK_FILE = "writer.lock"
+
+
+class WriterLockHeld(RuntimeError):
+    """Another process already writes to this data dir."""
+
+
+def read_snapshot(data_dir: Path) -> Optional[Dict]:
+    """The manifest of the last published snapshot, or None if none was published yet."""
+    path = data_dir / SNAPSHOT_FILE
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+
+
+def publish_snapshot(data_dir: Path, manifest: Dict) -> None:
+    # Replaced atomically: a replica reads either the previous manifest or this one
+    atomic_write_bytes(data_dir / SNAPSHOT_FILE, json.dumps(manifest, sort_keys=True).encode("utf-8"))
+
+
+# data dir -> open lock file, for as long as this process lives
+_held: Dict[Path, object] = {}
+_held_lock = threading.Lock()
+
+
+def acquire_writer_lock(data_dir: Path) -> None:
+    """Make this process the only writer of data_dir, or raise WriterLockHeld.
+
+    The lock is advisory and held until the process exits (the OS drops it even after a
+    crash); indexers in the same process share it.
+    """
+    key = data_dir.resolve()
+    with _held_lock:
+        if key in _held:
+            return
+        f = (data_dir / LOCK_FILE).open("a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            raise WriterLockHeld(f"another process is writing to {data_dir}; start this one as a reader (QUARRY_ROLE=reader)") from None
+        _held[key] = f
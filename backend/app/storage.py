@@ -0,0 +1,443 @@
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+
+def fsync_dir(path: Path) -> None:
+    # Make a rename durable; not supported on every platform (e.g. Windows)
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path.parent)
+
+
+class SnapshotChanged(RuntimeError):
+    """A read-only view found the files it was opening already past (or replaced since) its snapshot."""
+
+
+class MetaLog:
+    """Append-only JSONL log; a torn trailing line from a crash is dropped on open."""
+
+    def __init__(self, path: Path, repair: bool = True) -> None:
+        self.path = path
+        # Read-only replicas never repair: a torn tail is the writer's append in progress
+        if repair and self.path.exists():
+            self._repair()
+
+    def _repair(self) -> None:
+        with self.path.open("rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # Scan back to the last complete record
+            pos = size
+            while pos > 0:
+                step = min(65536, pos)
+                f.seek(pos - step)
+                chunk = f.read(step)
+                nl = chunk.rfind(b"\n")
+                if nl >= 0:
+                    f.truncate(pos - step + nl + 1)
+                    return
+                pos -= step
+            f.truncate(0)
+
+    def __iter__(self) -> Iterator[Dict]:
+        if not self.path.exists():
+            return
+        with self.path.open("r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def append(self, records: List[Dict]) -> List[int]:
+        """Append records and return the byte offset each one was written at."""
+        if not records:
+            return []
+        lines = [(json.dumps(r, ensure_ascii=False) + "\n").encode("utf-8") for r in records]
+        with self.path.open("ab") as f:
+            pos = f.seek(0, os.SEEK_END)
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        offsets = []
+        for line in lines:
+            offsets.append(pos)
+            pos += len(line)
+        return offsets
+
+    def truncate(self, count: int) -> None:
+        # Keep only the first `count` records
+        with self.path.open("rb+") as f:
+            pos = 0
+            for _ in range(count):
+                if not f.readline():
+                    break
+                pos = f.tell()
+            f.truncate(pos)
+
+    def rewrite(self, records: List[Dict]) -> None:
+        payload = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        atomic_write_bytes(self.path, payload.encode("utf-8"))
+
+
+# storage dtype -> (numpy dtype, scale, file suffix); int8 is scalar-quantized unit vectors
+VECTOR_DTYPES = {
+    "float32": ("<f4", 1.0, "f32"),
+    "float16": ("<f2", 1.0, "f16"),
+    "int8": ("i1", 127.0, "i8"),
+}
+
+
+def encode_vectors(x: np.ndarray, dtype: str) -> np.ndarray:
+    np_dtype, scale, _ = VECTOR_DTYPES[dtype]
+    x = np.asarray(x, dtype="float32")
+    if dtype == "int8":
+        return np.clip(np.rint(x * scale), -127, 127).astype(np_dtype)
+    return x.astype(np_dtype)
+
+
+def decode_vectors(x: np.ndarray, dtype: str) -> np.ndarray:
+    scale = VECTOR_DTYPES[dtype][1]
+    out = np.asarray(x, dtype="float32")
+    return out / scale if scale != 1.0 else out
+
+
+class VectorLog:
+    """Append-only segment of vector rows stored as float32, float16 or int8; reads return float32.
+    A partial trailing row from a crash is dropped on open.
+
+    Reads go through one handle opened on first use, so they keep seeing this segment even
+    after compaction replaces the file at path.
+    """
+
+    def __init__(self, path: Path, dim: int, dtype: str = "float32", repair: bool = True) -> None:
+        self.path = path
+        self.dim = dim
+        self.dtype = dtype
+        self.row_bytes = dim * np.dtype(VECTOR_DTYPES[dtype][0]).itemsize
+        self._fh = None
+        if repair and self.path.exists():
+            size = self.path.stat().st_size
+            if size % self.row_bytes:
+                self.truncate(size // self.row_bytes)
+
+    def _file(self):
+        if self._fh is None and self.path.exists():
+            self._fh = self.path.open("rb")
+        return self._fh
+
+    def __len__(self) -> int:
+        f = self._file()
+        return 0 if f is None else os.fstat(f.fileno()).st_size // self.row_bytes
+
+    def append(self, vectors: np.ndarray) -> None:
+        if len(vectors) == 0:
+            return
+        with self.path.open("ab") as f:
+            f.write(np.ascontiguousarray(encode_vectors(vectors, self.dtype)).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self, start: int = 0, stop: int = -1) -> np.ndarray:
+        total = len(self)
+        stop = total if stop < 0 else min(stop, total)
+        if stop <= start:
+            return np.zeros((0, self.dim), dtype="float32")
+        return decode_vectors(np.array(self.mmap(stop)[start:stop]), self.dtype)
+
+    def truncate(self, count: int) -> None:
+        with self.path.open("rb+") as f:
+            f.truncate(count * self.row_bytes)
+
+    def rewrite(self, vectors: np.ndarray) -> None:
+        self.close()
+        atomic_write_bytes(self.path, np.ascontiguousarray(encode_vectors(vectors, self.dtype)).tobytes())
+
+    def mmap(self, rows: Optional[int] = None) -> np.ndarray:
+        """Raw rows (the first `rows` of them, if given) in the storage dtype; decode_vectors() turns a slice into float32."""
+        n = len(self) if rows is None else min(rows, len(self))
+        np_dtype = VECTOR_DTYPES[self.dtype][0]
+        if n == 0:
+            return np.zeros((0, self.dim), dtype=np_dtype)
+        return np.memmap(self._file(), dtype=np_dtype, mode="r", shape=(n, self.dim))
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class FlatVectorIndex:
+    """Exact inner-product search straight over the memory-mapped vector segment.
+
+    Processes sharing a data dir share its pages through the OS page cache; rows added
+    since the last save live in a small in-RAM tail until flush() appends them. A read-only
+    replica maps only the first `rows` rows, those of the snapshot it serves.
+    """
+
+    is_trained = True
+    chunk_rows = 65536  # float16/int8 rows are decoded this many at a time while scoring
+    dense_subset = 0.25  # subsets larger than this share of the rows are masked, not gathered
+
+    def __init__(self, log: VectorLog, rows: Optional[int] = None) -> None:
+        self.log = log
+        self.d = log.dim
+        self.rows = rows
+        self._tail: List[np.ndarray] = []
+        self._remap()
+
+    def _remap(self) -> None:
+        self._base = self.log.mmap(self.rows)
+        self._tail_rows = np.concatenate(self._tail) if self._tail else np.zeros((0, self.d), dtype="float32")
+
+    def grow(self, rows: int) -> None:
+        """Map the first rows of the segment, e.g. once a newer snapshot publishes them."""
+        self.rows = rows
+        self._remap()
+
+    @property
+    def ntotal(self) -> int:
+        return len(self._base) + len(self._tail_rows)
+
+    def add(self, x: np.ndarray) -> None:
+        x = np.ascontiguousarray(x, dtype="float32")
+        if self.log.dtype != "float32":
+            # Score unsaved rows exactly as they will read back from disk
+            x = decode_vectors(encode_vectors(x, self.log.dtype), self.log.dtype)
+        self._tail.append(x)
+        self._tail_rows = np.concatenate(self._tail)
+
+    def flush(self) -> None:
+        if self._tail:
+            self.log.append(self._tail_rows)
+            self._tail = []
+        self._remap()
+
+    def reconstruct_n(self, start: int, n: int) -> np.ndarray:
+        # Copies only the requested rows, not the whole mapped segment
+        n_base = len(self._base)
+        stop = min(start + n, self.ntotal)
+        head = decode_vectors(self._base[start:min(stop, n_base)], self.log.dtype)
+        if stop <= n_base:
+            return head
+        return np.concatenate([head, self._tail_rows[max(start - n_base, 0):stop - n_base]])
+
+    def _base_scores(self, q: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        dtype = self.log.dtype
+        if dtype == "float32":
+            return self._base @ q if rows is None else self._base[rows] @ q
+        # Scaled dot products in bounded chunks; never materializes the whole segment as float32
+        n = len(self._base) if rows is None else len(rows)
+        out = np.empty(n, dtype="float32")
+        for lo in range(0, n, self.chunk_rows):
+            block = self._base[lo:lo + self.chunk_rows] if rows is None else self._base[rows[lo:lo + self.chunk_rows]]
+            out[lo:lo + len(block)] = decode_vectors(block, dtype) @ q
+        return out
+
+    def _scores(self, q: np.ndarray, subset: Optional[np.ndarray]) -> np.ndarray:
+        n_base = len(self._base)
+        if subset is None:
+            return np.concatenate([self._base_scores(q, None), self._tail_rows @ q])
+        split = int(np.searchsorted(subset, n_base))
+        return np.concatenate([self._base_scores(q, subset[:split]), self._tail_rows[subset[split:] - n_base] @ q])
+
+    def search(self, x: np.ndarray, k: int, subset: Optional[np.ndarray] = None):
+        """FAISS-style search returning (scores, ids) of shape (nq, k), padded with -1; subset must be sorted."""
+        nq = len(x)
+        scores = np.full((nq, k), -np.inf, dtype="float32")
+        ids = np.full((nq, k), -1, dtype="int64")
+        excluded = None
+        if subset is not None and len(subset) > self.dense_subset * self.ntotal:
+            # Gathering most rows copies the segment on every query: score the mapped rows in
+            # place and rule out the few that are filtered or deleted instead
+            excluded = np.ones(self.ntotal, dtype=bool)
+            excluded[subset] = False
+        for qi in range(nq):
+            q = np.asarray(x[qi], dtype="float32")
+            if excluded is None:
+                s = self._scores(q, subset)
+                kk = min(k, len(s))
+            else:
+                s = self._scores(q, None)
+                s[excluded] = -np.inf
+                kk = min(k, len(subset))
+            if kk == 0:
+                continue
+            top = np.sort(np.argpartition(-s, kk - 1)[:kk])  # ties resolve to the lower id
+            top = top[np.argsort(-s[top], kind="stable")]
+            scores[qi, :kk] = s[top]
+            ids[qi, :kk] = top if subset is None or excluded is not None else subset[top]
+        return scores, ids
+
+
+class BlobLog:
+    """Append-only segment of variable-length records with a fixed-width (offset, length) index.
+
+    Record i is one seek into the memory-mapped segment; a backup or full scan is one
+    sequential read. Records past the last complete index entry are dropped on open.
+    Given rows, the log is a read-only view of its first rows records and nothing is repaired.
+    """
+
+    def __init__(self, path: Path, rows: Optional[int] = None) -> None:
+        self.path = path
+        self.index_path = path.with_name(path.name + ".idx")
+        self._pending: List[bytes] = []
+        self._fh = None
+        self._mm: Optional[mmap.mmap] = None
+        self._mm_size = 0
+        self._mm_lock = threading.Lock()  # concurrent readers remap the grown segment once
+        self._index = self.read_index(0, rows)
+        if rows is None:
+            self._repair()
+        else:
+            # The segment is opened now, before any compaction can replace it
+            self._fh = self.path.open("rb") if rows or self.path.exists() else None
+
+    def read_index(self, start: int, stop: Optional[int] = None) -> np.ndarray:
+        """(offset, length) entries of records [start, stop) as stored in the index file."""
+        if not self.index_path.exists():
+            entries = np.zeros(0, dtype="<u8")
+        else:
+            count = -1 if stop is None else 2 * (stop - start)
+            entries = np.fromfile(str(self.index_path), dtype="<u8", count=count, offset=16 * start)
+        if stop is not None and len(entries) < 2 * (stop - start):
+            raise SnapshotChanged(f"{self.index_path} holds fewer than {stop} records")
+        return entries[: len(entries) // 2 * 2].reshape(-1, 2)
+
+    def extend(self, entries: np.ndarray) -> None:
+        """Expose records another process has flushed, given their index entries."""
+        with self._mm_lock:
+            if self._fh is None and len(entries):
+                self._fh = self.path.open("rb")
+            self._index = np.concatenate([self._index, entries])
+
+    def _repair(self) -> None:
+        # Segment bytes are written before their index entries, so trim the segment to the index
+        end = int(self._index[-1].sum()) if len(self._index) else 0
+        size = self.path.stat().st_size if self.path.exists() else 0
+        if size < end:
+            # Index entries without their bytes: keep only records that are fully on disk
+            valid = self._index[:, 0] + self._index[:, 1] <= size
+            self._index = self._index[: int(np.argmin(valid)) if not valid.all() else len(self._index)]
+            end = int(self._index[-1].sum()) if len(self._index) else 0
+        if size != end:
+            with self.path.open("ab") as f:
+                f.truncate(end)
+        if self.index_path.exists() and self.index_path.stat().st_size != self._index.nbytes:
+            atomic_write_bytes(self.index_path, self._index.tobytes())
+
+    def __len__(self) -> int:
+        return len(self._index) + len(self._pending)
+
+    def append(self, record: bytes) -> None:
+        self._pending.append(record)
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        pos = int(self._index[-1].sum()) if len(self._index) else 0
+        entries = np.zeros((len(self._pending), 2), dtype="<u8")
+        for i, record in enumerate(self._pending):
+            entries[i] = (pos, len(record))
+            pos += len(record)
+        with self.path.open("ab") as f:
+            f.write(b"".join(self._pending))
+            f.flush()
+            os.fsync(f.fileno())
+        with self.index_path.open("ab") as f:
+            f.write(entries.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._index = np.concatenate([self._index, entries])
+        self._pending.clear()
+
+    def get(self, i: int) -> bytes:
+        n_saved = len(self._index)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if i >= n_saved:
+            return self._pending[i - n_saved]
+        offset, length = (int(v) for v in self._index[i])
+        with self._mm_lock:
+            if self._fh is None:
+                self._fh = self.path.open("rb")
+            if self._mm is None or self._mm_size < offset + length:
+                if self._mm is not None:
+                    self._mm.close()
+                self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mm_size = len(self._mm)
+            return self._mm[offset:offset + length]
+
+    def truncate(self, count: int) -> None:
+        self.close()
+        self._pending.clear()
+        self._index = self._index[:count]
+        atomic_write_bytes(self.index_path, self._index.tobytes())
+        self._repair()
+
+    def close(self) -> None:
+        with self._mm_lock:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+class IdLog:
+    """Append-only list of int64 ids; a partial trailing entry from a crash is dropped on open."""
+
+    def __init__(self, path: Path, repair: bool = True) -> None:
+        self.path = path
+        if repair and self.path.exists() and self.path.stat().st_size % 8:
+            with self.path.open("rb+") as f:
+                f.truncate(self.path.stat().st_size // 8 * 8)
+
+    def __len__(self) -> int:
+        return self.path.stat().st_size // 8 if self.path.exists() else 0
+
+    def read(self, count: Optional[int] = None) -> np.ndarray:
+        """The first count ids (default: all of them)."""
+        if not self.path.exists():
+            ids = np.zeros(0, dtype="<i8")
+        else:
+            ids = np.fromfile(str(self.path), dtype="<i8", count=-1 if count is None else count)
+        if count is not None and len(ids) < count:
+            raise SnapshotChanged(f"{self.path} holds fewer than {count} ids")
+        return ids
+
+    def append(self, ids: List[int]) -> None:
+        if not ids:
+            return
+        with self.path.open("ab") as f:
+            f.write(np.asarray(ids, dtype="<i8").tobytes())
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,27 @@
+import argparse
+import sys
+import time
+from app.embeddings import CHECK_SENTENCES, EMBEDDING_BACKENDS, Encoder, consistency
+
+
+def main():
+    p = argparse.ArgumentParser(description='Compare an embedding backend against the reference PyTorch model')
+    p.add_argument('--model', type=str, default='sentence-transformers/all-MiniLM-L6-v2')
+    p.add_argument('--backend', type=str, choices=EMBEDDING_BACKENDS, required=True)
+    p.add_argument('--min-cosine', type=float, default=0.98)
+    args = p.parse_args()
+
+    reference = Encoder(args.model, 'torch')
+    candidate = Encoder(args.model, args.backend)
+    for name, enc in (('torch', reference), (args.backend, candidate)):
+        t0 = time.perf_counter()
+        for _ in range(10):
+            enc.encode(CHECK_SENTENCES)
+        print(f"{name}: {(time.perf_counter() - t0) / (10 * len(CHECK_SENTENCES)) * 1000:.2f} ms/sentence")
+    worst = consistency(candidate, reference)
+    print(f"min cosine vs torch: {worst:.4f}")
+    sys.exit(0 if worst >= args.min_cosine else 1)
+
+
+if __name__ == '__main__':
+    main()
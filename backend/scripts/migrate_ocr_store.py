@@ -0,0 +1,25 @@
+import argparse
+import shutil
+import time
+from pathlib import Path
+from app.indexer import ScreenshotIndexer
+
+
+def main():
+    p = argparse.ArgumentParser(description='Pack a data dir\'s ocr/{id}.json files into the ocr.seg block store')
+    p.add_argument('--data', type=str, default='./data')
+    p.add_argument('--remove', action='store_true', help='delete the ocr/ directory once it is packed')
+    args = p.parse_args()
+
+    t0 = time.perf_counter()
+    # Opening the indexer packs every document the segment is missing
+    idx = ScreenshotIndexer(data_dir=Path(args.data))
+    print(f"N={len(idx.ocr_log)} OCR documents in {idx.ocr_path} ({time.perf_counter() - t0:.1f}s)")
+    if args.remove and idx.ocr_dir.exists():
+        shutil.rmtree(idx.ocr_dir)
+        print(f"removed {idx.ocr_dir}")
+    idx.close()
+
+
+if __name__ == '__main__':
+    main()
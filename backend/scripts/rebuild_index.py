@@ -0,0 +1,25 @@
+import argparse
+import time
+from pathlib import Path
+from app.ann import INDEX_TYPES, AnnConfig
+from app.indexer import ScreenshotIndexer
+
+
+def main():
+    p = argparse.ArgumentParser(description='Rebuild the vector index of a data dir as another index type')
+    p.add_argument('--data', type=str, default='./data')
+    p.add_argument('--type', type=str, choices=INDEX_TYPES, required=True)
+    p.add_argument('--nlist', type=int, default=None, help='IVF lists (default ~4*sqrt(N))')
+    p.add_argument('--pq-m', type=int, default=16, help='PQ sub-quantizers for ivf_pq')
+    p.add_argument('--hnsw-m', type=int, default=32)
+    args = p.parse_args()
+
+    config = AnnConfig(kind=args.type, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
+    idx = ScreenshotIndexer(data_dir=Path(args.data), index_config=config)
+    t0 = time.perf_counter()
+    idx.rebuild_index()
+    print(f"N={len(idx.metas)} type={args.type} rebuilt in {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import argparse
+import time
+from pathlib import Path
+from app.shards import SHARD_KEYS, read_layout, reshard
+
+
+def main():
+    p = argparse.ArgumentParser(description='Split, merge or rehash the shards of a data dir (stop the writer and replicas first)')
+    p.add_argument('--data', type=str, default='./data')
+    p.add_argument('--by', type=str, choices=SHARD_KEYS, required=True)
+    p.add_argument('--shards', type=int, default=None, help='shard count for --by hash')
+    p.add_argument('--merge', type=str, default=None, help='comma-separated collections to serve from one shard (--by collection)')
+    p.add_argument('--into', type=str, default=None, help='shard the --merge collections share')
+    p.add_argument('--split', type=str, default=None, help='comma-separated collections to give their own shard again')
+    args = p.parse_args()
+
+    data = Path(args.data)
+    layout = read_layout(data) or {}
+    routes = dict(layout.get('routes', {}))
+    if args.merge:
+        if not args.into:
+            p.error('--merge needs --into')
+        routes.update({c: args.into for c in args.merge.split(',') if c})
+    for c in (args.split or '').split(','):
+        routes.pop(c, None)
+
+    t0 = time.perf_counter()
+    counts = reshard(data, args.by, count=args.shards, routes=routes)
+    for name, n in sorted(counts.items()):
+        print(f"{name}: {n}")
+    print(f"resharded by {args.by} in {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
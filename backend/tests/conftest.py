@@ -0,0 +1,47 @@
+import io
+import itertools
+import os
+import tempfile
+
+from PIL import Image
+
+# app.main opens its job queue, albums and previews in QUARRY_DATA_DIR at import;
+# keep them out of the checkout
+os.environ["QUARRY_DATA_DIR"] = tempfile.mkdtemp(prefix="quarry-tests-")
+
+from app.indexer import ScreenshotIndexer  # noqa: E402
+
+
+class DummyIndexer(ScreenshotIndexer):
+    """Indexer with canned OCR and constant embeddings, so tests need neither Tesseract nor the model's output."""
+
+    def _ocr(self, image):  # type: ignore
+        return "Your booking reference is ABC123 and total $42.00"
+
+    def _ocr_with_blocks(self, image):  # type: ignore
+        # Minimal block list for highlight semantics
+        blocks = [
+            {"text": "Your", "conf": 90, "bbox": {"x": 0, "y": 0, "w": 10, "h": 10}},
+            {"text": "booking", "conf": 90, "bbox": {"x": 10, "y": 0, "w": 10, "h": 10}},
+            {"text": "reference", "conf": 90, "bbox": {"x": 20, "y": 0, "w": 10, "h": 10}},
+            {"text": "ABC123", "conf": 90, "bbox": {"x": 30, "y": 0, "w": 10, "h": 10}},
+        ]
+        return ("Your booking reference is ABC123 and total $42.00", blocks)
+
+    def _embed_batch(self, texts):  # type: ignore
+        # Deterministic small vectors of correct dim
+        import numpy as np
+        v = np.zeros((len(texts), self.dim), dtype="float32")
+        v[:, 0] = 1.0
+        return v
+
+
+_png_counter = itertools.count()
+
+
+def make_png() -> bytes:
+    # A distinct image per call: identical uploads are deduplicated on ingest
+    n = next(_png_counter)
+    buf = io.BytesIO()
+    Image.new("RGB", (50, 20), color=(n % 256, n // 256 % 256, 255)).save(buf, format="PNG")
+    return buf.getvalue()
@@ -1,5 +1,6 @@
 from pathlib import Path
 from app.albums import AlbumStore
+from conftest import DummyIndexer, make_png
 
 
 def test_album_crud(tmp_path: Path):
@@ -44,3 +45,81 @@ def test_album_id_collision_regression(tmp_path: Path):
     assert len({original_id, new_id, third_id}) == 3  # All unique
 
 
+
+
+def test_album_results_materialize_and_update_incrementally(tmp_path: Path):
+    from app.albums import AlbumResults
+
+    class Indexer(DummyIndexer):
+        searches = 0
+
+        def search(self, *args, **kwargs):  # type: ignore
+            Indexer.searches += 1
+            return super().search(*args, **kwargs)
+
+    idx = Indexer(data_dir=tmp_path)
+    store = AlbumStore(tmp_path)
+    results = AlbumResults(tmp_path, limit=10)
+    idx.add_ingest_listener(lambda part, offsets, vectors: results.on_ingest(store.list(), part, offsets, vectors))
+    album = store.create(name="Work", rule={"collection": "work"})
+
+    idx.index_images_bytes([(make_png(), "a.png"), (make_png(), "b.png")], collection="work")
+    idx.index_images_bytes([(make_png(), "c.png")], collection="home")
+    assert [i for i, _ in results.view(album, idx, 10)] == ["00000000", "00000001"]
+    assert Indexer.searches == 1
+
+    # New screenshots are scored against the rule as they arrive; views stay lookups
+    idx.index_images_bytes([(make_png(), "d.png")], collection="work")
+    idx.index_images_bytes([(make_png(), "e.png")], collection="home")
+    assert [i for i, _ in results.view(album, idx, 10)] == ["00000000", "00000001", "00000003"]
+    assert Indexer.searches == 1
+
+    # Persisted, and caught up with items indexed while nobody was listening
+    idx._ingest_listeners.clear()
+    idx.index_images_bytes([(make_png(), "f.png")], collection="work")
+    reopened = AlbumResults(tmp_path, limit=10)
+    assert [i for i, _ in reopened.view(album, idx, 10)][-1] == "00000005"
+    assert Indexer.searches == 1
+    assert reopened.view(album, idx, 11) is None
+
+    # A rule change invalidates the materialized set
+    album = store.update_rule(album.id, {"collection": "home"})
+    assert [i for i, _ in reopened.view(album, idx, 10)] == ["00000002", "00000004"]
+    assert Indexer.searches == 2
+
+
+def test_album_results_survive_compaction(tmp_path: Path):
+    from app.albums import AlbumResults
+
+    def pngs(n: int):
+        return [(make_png(), "x.png") for _ in range(n)]
+
+    idx = DummyIndexer(data_dir=tmp_path)
+    store = AlbumStore(tmp_path)
+    results = AlbumResults(tmp_path, limit=50)
+    idx.add_ingest_listener(lambda part, offsets, vectors: results.on_ingest(store.list(), part, offsets, vectors))
+    album = store.create(name="Work", rule={"collection": "work"})
+
+    idx.index_images_bytes(pngs(5), collection="work")
+    home = idx.index_images_bytes(pngs(8), collection="home")
+    assert len(results.view(album, idx, 50)) == 5
+
+    # Compaction renumbers rows; offsets counted before it no longer line up with new rows
+    idx.delete([m["id"] for m in home])
+    idx.compact()
+    idx.index_images_bytes(pngs(10), collection="work")
+    assert len(results.view(album, idx, 50)) == len(idx.search("", k=50, collection="work", mode="semantic")) == 15
+
+
+def test_replica_keeps_album_results_in_memory(tmp_path: Path):
+    from types import SimpleNamespace
+    from app.albums import AlbumResults
+
+    album = AlbumStore(tmp_path).create(name="All", rule={"q": "x"})
+    replica = SimpleNamespace(
+        readonly=True, shard="", snapshot={"generation": 0}, metas=[None],
+        parts=lambda: [replica], search=lambda *args, **kwargs: [{"id": "00000000", "score": 0.5}],
+    )
+    results = AlbumResults(tmp_path)
+    assert results.view(album, replica, 5) == [("00000000", 0.5)]
+    assert not list((tmp_path / "album_results").iterdir())
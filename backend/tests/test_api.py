@@ -1,6 +1,14 @@
 from pathlib import Path
 from typing import Dict, List, Optional
 from fastapi.testclient import TestClient
+import os
+import subprocess
+import sys
+import time
+
+from app.albums import AlbumResults, AlbumStore
+from app.jobs import JobQueue
+from app.previews import PreviewStore
 
 
 def make_client(tmp_path: Path):
@@ -15,6 +23,7 @@ def make_client(tmp_path: Path):
             self.ocr_dir = self.data_dir / "ocr"
             self.ocr_dir.mkdir(parents=True, exist_ok=True)
             self.metas: List[object] = []
+            self.readonly = False
 
         def index_image_bytes(self, content: bytes, filename: str, collection: Optional[str] = None) -> Dict:
             img_id = f"{len(self.metas):08d}"
@@ -47,10 +56,13 @@ def make_client(tmp_path: Path):
                 "image_path": f"images/{img_id}.jpg",
             }
 
+        def index_images_bytes(self, items, collection: Optional[str] = None) -> List[Dict]:
+            return [self.index_image_bytes(content, filename=filename, collection=collection) for content, filename in items]
+
         def save(self):
             pass
 
-        def search(self, q: str, k: int = 12, collection: Optional[str] = None, entity_type: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, type_label: Optional[str] = None):
+        def search(self, q: str, k: int = 12, collection: Optional[str] = None, entity_type: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None, type_label: Optional[str] = None, mode: str = "hybrid"):
             # Return all metas as results with dummy score
             out = []
             for m in self.metas:
@@ -69,34 +81,126 @@ def make_client(tmp_path: Path):
                 })
             return out
 
+        def ocr_payload(self, image_id: str):
+            path = self.ocr_dir / f"{image_id}.json"
+            return path.read_bytes() if path.exists() else None
+
+        dim = 4
+
+        def count(self) -> int:
+            return len(self.metas)
+
+        def page(self, cursor: int, limit: Optional[int]):
+            stop = len(self.metas) if limit is None else min(len(self.metas), cursor + limit)
+            return cursor, stop, stop if stop < len(self.metas) else None
+
+        def iter_metas(self, start: int = 0, stop: Optional[int] = None):
+            return iter(self.metas[start:stop])
+
+        def iter_vectors(self, start: int = 0, stop: Optional[int] = None):
+            import numpy as np
+            stop = len(self.metas) if stop is None else stop
+            yield np.arange(start * self.dim, stop * self.dim, dtype="float32").reshape(-1, self.dim)
+
         def get_meta(self, image_id: str):
             for m in self.metas:
                 if m.id == image_id:
                     return m
             return None
 
-    # Patch the global indexer
+        def delete(self, image_ids):
+            deleted = [m.id for m in self.metas if m.id in image_ids]
+            self.metas = [m for m in self.metas if m.id not in deleted]
+            return deleted
+
+        def update(self, image_id: str, **fields):
+            m = self.get_meta(image_id)
+            if m is None:
+                return None
+            if "text" in fields:
+                raise ValueError("fields cannot be edited: text")
+            for k, v in fields.items():
+                setattr(m, k, v)
+            return {"id": m.id, "filename": m.filename, "collection": m.collection}
+
+    # Patch the global indexer and give the ingest queue its own data dir
     app_main.indexer = FakeIndexer(tmp_path)
+    app_main.jobs = JobQueue(tmp_path, process=app_main._index_batch)
+    app_main.albums = AlbumStore(tmp_path)
+    app_main.album_results = AlbumResults(tmp_path)
+    app_main._ocr_cache.clear()
+    app_main.previews = PreviewStore(tmp_path)
 
     return TestClient(app_main.app)
 
 
+def index_and_wait(client: TestClient, files) -> Dict:
+    r = client.post("/index", files=files)
+    assert r.status_code == 202
+    job_id = r.json()["job_id"]
+    for _ in range(200):
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] == "completed":
+            return job
+        time.sleep(0.02)
+    raise AssertionError("indexing job did not complete")
+
+
 def test_health(tmp_path: Path):
     client = make_client(tmp_path)
     r = client.get("/health")
     assert r.status_code == 200 and r.json()["status"] == "ok"
 
 
+def test_ready_is_separate_from_health(tmp_path: Path):
+    from app import main as app_main
+
+    client = make_client(tmp_path)
+    assert client.get("/ready").json()["status"] == "ready"
+    app_main.indexer = None  # still loading
+    assert client.get("/health").status_code == 200
+    r = client.get("/ready")
+    assert r.status_code == 503 and r.headers["retry-after"]
+    assert client.get("/search", params={"q": "x"}).status_code == 503
+    # Uploads are still accepted and wait in the queue
+    assert client.post("/index", files={"files": ("a.jpg", b"x", "image/jpeg")}).status_code == 202
+
+
+def test_index_answers_429_when_the_queue_is_full(tmp_path: Path):
+    from app import main as app_main
+
+    client = make_client(tmp_path)
+    app_main.jobs = JobQueue(tmp_path, process=app_main._index_batch, autostart=False, max_pending=2)
+    files = [("files", ("a.jpg", b"a" * 10000, "image/jpeg")), ("files", ("b.jpg", b"b", "image/jpeg"))]
+    r = client.post("/index", files=files)
+    assert r.status_code == 202 and r.json()["files"] == 2
+    job_id = r.json()["job_id"]
+    assert (tmp_path / "spool" / job_id / "0").read_bytes() == b"a" * 10000
+    r = client.post("/index", files={"files": ("c.jpg", b"c", "image/jpeg")})
+    assert r.status_code == 429 and r.headers["retry-after"]
+
+
+def test_import_does_not_load_models(tmp_path: Path):
+    code = (
+        "import sys, app.main; "
+        "print(','.join(m for m in ('torch', 'faiss', 'sentence_transformers', 'pytesseract') if m in sys.modules))"
+    )
+    env = dict(os.environ, QUARRY_DATA_DIR=str(tmp_path))
+    out = subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).resolve().parents[1], env=env,
+                         capture_output=True, text=True, timeout=60, check=True)
+    assert out.stdout.strip() == ""
+
+
 def test_index_and_search_and_export(tmp_path: Path):
     client = make_client(tmp_path)
     # Upload a tiny file
     files = {"files": ("a.jpg", b"fakejpegbytes", "image/jpeg")}
-    r = client.post("/index", files=files)
-    assert r.status_code == 200
-    rid = r.json()["indexed"][0]["id"]
+    job = index_and_wait(client, files)
+    assert job["done"] == 1 and job["failed"] == 0
+    rid = job["files"][0]["image_id"]
 
     r2 = client.get("/search", params={"q": "abc"})
-    assert r2.status_code == 200
+    assert r2.status_code == 200 and r2.json()["mode"] == "hybrid"
     assert any(x["id"] == rid for x in r2.json()["results"])
 
     r3 = client.get("/export.json")
@@ -116,6 +220,13 @@ def test_albums_crud_and_use(tmp_path: Path):
     # Rename
     r3 = client.post(f"/albums/{alb['id']}/rename", data={"name": "Renamed"})
     assert r3.status_code == 200 and r3.json()["album"]["name"] == "Renamed"
+    # Change rule
+    r5 = client.post(f"/albums/{alb['id']}/rule", data={"rule": '{"q":"bye"}'})
+    assert r5.status_code == 200 and r5.json()["album"]["rule"] == {"q": "bye"}
+    assert client.post("/albums/missing/rule", data={"rule": "{}"}).status_code == 404
+    # Past the materialized results an album is searched, with the same ranking
+    r6 = client.get("/search", params={"album_id": alb["id"], "k": 500})
+    assert r6.status_code == 200 and r6.json()["mode"] == "semantic"
     # Delete
     r4 = client.delete(f"/albums/{alb['id']}")
     assert r4.status_code == 200 and r4.json()["deleted"] is True
@@ -124,10 +235,115 @@ def test_albums_crud_and_use(tmp_path: Path):
 def test_ocr_endpoint(tmp_path: Path):
     client = make_client(tmp_path)
     files = {"files": ("a.jpg", b"fakejpegbytes", "image/jpeg")}
-    r = client.post("/index", files=files)
-    rid = r.json()["indexed"][0]["id"]
+    rid = index_and_wait(client, files)["files"][0]["image_id"]
     r2 = client.get(f"/image/{rid}/ocr")
     assert r2.status_code == 200
     data = r2.json()
     assert "blocks" in data
+    assert client.get("/image/99999999/ocr").status_code == 404
+
+
+
+def test_unknown_job_is_404(tmp_path: Path):
+    client = make_client(tmp_path)
+    assert client.get("/jobs/job_missing").status_code == 404
+
+
+def test_export_ndjson_pages_and_vectors(tmp_path: Path):
+    import json
+    import numpy as np
+    client = make_client(tmp_path)
+    files = [("files", (f"{i}.jpg", f"img{i}".encode(), "image/jpeg")) for i in range(3)]
+    index_and_wait(client, files)
+
+    r = client.get("/export.ndjson", params={"limit": 2, "fields": "id,filename"})
+    assert r.status_code == 200 and r.headers["x-next-cursor"] == "2"
+    rows = [json.loads(line) for line in r.text.splitlines()]
+    assert rows == [{"id": "00000000", "filename": "0.jpg"}, {"id": "00000001", "filename": "1.jpg"}]
+
+    r2 = client.get("/export.ndjson", params={"cursor": 2, "limit": 2})
+    assert "x-next-cursor" not in r2.headers
+    assert [json.loads(line)["id"] for line in r2.text.splitlines()] == ["00000002"]
+
+    r3 = client.get("/export.vectors", params={"cursor": 1, "limit": 2})
+    vecs = np.frombuffer(r3.content, dtype="<f4").reshape(-1, int(r3.headers["x-vector-dim"]))
+    assert vecs.shape == (2, 4) and vecs[0, 0] == 4
+
+    assert client.get("/export.ndjson", params={"fields": "id,secret"}).status_code == 400
+
+
+def test_previews_are_rendered_lazily_and_cacheable(tmp_path: Path):
+    import io
+    from PIL import Image, features
+    client = make_client(tmp_path)
+    buf = io.BytesIO()
+    Image.new("RGB", (1170, 2532), color="white").save(buf, format="PNG")
+    rid = index_and_wait(client, {"files": ("tall.png", buf.getvalue(), "image/png")})["files"][0]["image_id"]
+
+    r = client.get(f"/preview/{rid}", params={"size": "small"}, headers={"accept": "image/jpeg"})
+    assert r.status_code == 200 and r.headers["content-type"] == "image/jpeg"
+    assert r.headers["cache-control"].startswith("public, max-age=")
+    assert max(Image.open(io.BytesIO(r.content)).size) == 256
+    assert len(r.content) < len(buf.getvalue())
+
+    again = client.get(f"/preview/{rid}", params={"size": "small"}, headers={"accept": "image/jpeg", "if-none-match": r.headers["etag"]})
+    assert again.status_code == 304
+
+    if features.check("webp"):
+        webp = client.get(f"/preview/{rid}", params={"size": "medium"}, headers={"accept": "image/webp,*/*"})
+        assert webp.headers["content-type"] == "image/webp"
+
+    assert client.get(f"/preview/{rid}", params={"size": "huge"}).status_code == 400
+    assert client.get("/preview/99999999").status_code == 404
+    # Ids are validated before any file is looked up
+    from app import main as app_main
+    (app_main.previews.dir / "leak.jpg").write_bytes(b"x")
+    assert app_main.previews.path("../leak", "small") is None
+
+    results = client.get("/search", params={"q": "abc", "preview": "small"}).json()["results"]
+    assert results[0]["preview_path"] == f"preview/{rid}?size=small"
+
+
+def test_delete_and_patch_image(tmp_path: Path):
+    client = make_client(tmp_path)
+    job = index_and_wait(client, [("files", ("a.jpg", b"aaa", "image/jpeg")), ("files", ("b.jpg", b"bbb", "image/jpeg"))])
+    a, b = (f["image_id"] for f in job["files"])
+    client.get(f"/image/{a}/ocr")
+
+    r = client.patch(f"/image/{b}", json={"collection": "work"})
+    assert r.status_code == 200 and r.json()["image"]["collection"] == "work"
+    assert client.patch(f"/image/{b}", json={"text": "x"}).status_code == 400
+    assert client.patch("/image/99999999", json={"collection": "x"}).status_code == 404
+
+    r = client.delete(f"/image/{a}")
+    assert r.status_code == 200 and r.json()["deleted"] == [a]
+    assert client.delete(f"/image/{a}").status_code == 404
+    assert [x["id"] for x in client.get("/search", params={"q": "abc"}).json()["results"]] == [b]
+
+    r = client.post("/delete", json={"ids": [b, "nope"]})
+    assert r.json()["deleted"] == [b]
+
+
+def test_replica_refuses_deletes_and_edits(tmp_path: Path):
+    client = make_client(tmp_path)
+    job = index_and_wait(client, [("files", ("a.jpg", b"aaa", "image/jpeg"))])
+    image_id = job["files"][0]["image_id"]
+    from app import main as app_main
+    app_main.indexer.readonly = True
+
+    assert client.delete(f"/image/{image_id}").status_code == 409
+    assert client.post("/delete", json={"ids": [image_id]}).status_code == 409
+    assert client.patch(f"/image/{image_id}", json={"collection": "x"}).status_code == 409
+    assert client.get("/ready").json()["role"] == "reader"
 
+    # Album changes go to the writer too; the replica sees them once albums.jsonl changes
+    assert client.post("/albums", data={"name": "A", "rule": "{}"}).status_code == 409
+    writer = AlbumStore(tmp_path)
+    album = writer.create(name="Work", rule={"collection": "work"})
+    assert [a["id"] for a in client.get("/albums").json()["albums"]] == [album.id]
+    assert client.post(f"/albums/{album.id}/rename", data={"name": "B"}).status_code == 409
+    assert client.post(f"/albums/{album.id}/rule", data={"rule": "{}"}).status_code == 409
+    assert client.delete(f"/albums/{album.id}").status_code == 409
+    writer.delete(album.id)
+    app_main._on_snapshot()
+    assert app_main.albums.list() == []
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from app.embeddings import Encoder, consistency
+from app.storage import FlatVectorIndex, VectorLog, decode_vectors, encode_vectors
+
+
+MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def test_int8_backend_matches_reference():
+    reference = Encoder(MODEL)
+    quantized = Encoder(MODEL, "int8")
+    assert quantized.dim == reference.dim
+    assert quantized.cache_key != reference.cache_key
+    assert consistency(quantized, reference) > 0.95
+    rows = quantized.encode(["hello", "world"])
+    assert rows.dtype == np.float32 and np.allclose(np.linalg.norm(rows, axis=1), 1, atol=1e-3)
+    with pytest.raises(ValueError):
+        Encoder(MODEL, "tpu")
+
+
+@pytest.mark.parametrize("dtype,itemsize,tol", [("float16", 2, 1e-3), ("int8", 1, 1e-2)])
+def test_compact_vector_dtypes_round_trip(tmp_path, dtype, itemsize, tol):
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(5, 8)).astype("float32")
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    assert np.abs(decode_vectors(encode_vectors(x, dtype), dtype) - x).max() < tol
+
+    log = VectorLog(tmp_path / "v.bin", 8, dtype)
+    log.append(x)
+    assert (tmp_path / "v.bin").stat().st_size == 5 * 8 * itemsize
+    assert np.abs(log.read(1, 3) - x[1:3]).max() < tol
+
+
+def test_dense_subsets_are_masked_not_gathered(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(40, 8)).astype("float32")
+    log = VectorLog(tmp_path / "v.bin", 8)
+    log.append(x[:36])
+    index = FlatVectorIndex(log)
+    index.add(x[36:])  # unsaved tail rows
+    q = rng.normal(size=(1, 8)).astype("float32")
+
+    gathered = []
+    score = FlatVectorIndex._base_scores
+    monkeypatch.setattr(FlatVectorIndex, "_base_scores", lambda self, q, rows: (gathered.append(rows is not None), score(self, q, rows))[1])
+    for subset in (np.delete(np.arange(40), [3, 17, 38]), np.array([2, 5, 30, 39])):
+        gathered.clear()
+        scores, ids = index.search(q, 5, subset=subset)
+        expected = subset[np.argsort(-(x[subset] @ q[0]), kind="stable")][:5]
+        assert ids[0][ids[0] >= 0].tolist() == expected.tolist()
+        assert gathered == [len(subset) < 10]
@@ -0,0 +1,23 @@
+from app.highlights import entity_block_map
+
+
+def _block(text, x):
+    return {"text": text, "conf": 90, "bbox": {"x": x, "y": 10, "w": 20, "h": 8}}
+
+
+def test_single_and_multi_block_entities():
+    blocks = [_block("Total:", 0), _block("$42.00", 30), _block("call", 60), _block("+1", 90), _block("555", 120), _block("0100", 150)]
+    out = entity_block_map(blocks, {"amount": ["$42.00"], "phone": ["+1 555 0100"], "email": []})
+
+    assert out["entity_block_idxs"] == {"amount": [1], "phone": [3, 4, 5]}
+    phone = [s for s in out["entity_spans"] if s["type"] == "phone"][0]
+    assert phone["blocks"] == [3, 4, 5]
+    assert phone["bbox"] == {"x": 90, "y": 10, "w": 80, "h": 8}
+
+
+def test_substring_and_repeated_matches():
+    blocks = [_block("Ref:ABC123", 0), _block("again", 30), _block("abc123", 60)]
+    out = entity_block_map(blocks, {"code": ["ABC123"]})
+    assert out["entity_block_idxs"] == {"code": [0, 2]}
+    assert [s["blocks"] for s in out["entity_spans"]] == [[0], [2]]
+    assert entity_block_map([], {"code": ["x"]}) == {"entity_block_idxs": {}, "entity_spans": []}
@@ -1,27 +1,6 @@
 from pathlib import Path
-from app.indexer import ScreenshotIndexer
 
-
-class DummyIndexer(ScreenshotIndexer):
-    def _ocr(self, image):  # type: ignore
-        return "Your booking reference is ABC123 and total $42.00"
-
-    def _ocr_with_blocks(self, image):  # type: ignore
-        # Minimal block list for highlight semantics
-        blocks = [
-            {"text": "Your", "conf": 90, "bbox": {"x": 0, "y": 0, "w": 10, "h": 10}},
-            {"text": "booking", "conf": 90, "bbox": {"x": 10, "y": 0, "w": 10, "h": 10}},
-            {"text": "reference", "conf": 90, "bbox": {"x": 20, "y": 0, "w": 10, "h": 10}},
-            {"text": "ABC123", "conf": 90, "bbox": {"x": 30, "y": 0, "w": 10, "h": 10}},
-        ]
-        return ("Your booking reference is ABC123 and total $42.00", blocks)
-
-    def _embed(self, text: str):  # type: ignore
-        # Deterministic small vector of correct dim
-        import numpy as np
-        v = np.zeros(self.dim, dtype="float32")
-        v[0] = 1.0
-        return v.tolist()
+from conftest import DummyIndexer, make_png
 
 
 def test_index_and_search(tmp_path: Path):
@@ -45,3 +24,503 @@ def test_index_and_search(tmp_path: Path):
     assert res2 == []
 
 
+
+
+def test_filtered_search_is_not_starved_by_top_k(tmp_path: Path):
+    idx = DummyIndexer(data_dir=tmp_path)
+
+    for i in range(20):
+        idx.index_image_bytes(make_png(), filename=f'{i}.png', collection='rare' if i == 19 else 'bulk')
+
+    res = idx.search('booking', k=3, collection='rare')
+    assert [r['id'] for r in res] == ['00000019']
+    assert len(idx.search('booking', k=3, collection='bulk', entity_type='code', start_date='2000-01-01')) == 3
+    assert idx.search('booking', k=3, type_label='receipt') == []
+    assert idx.search('booking', k=3, collection='missing') == []
+
+
+def test_bulk_ingest_batches_and_persists(tmp_path: Path):
+    idx = DummyIndexer(data_dir=tmp_path, batch_size=2)
+
+    metas = idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(5)], collection='bulk')
+    assert [m['id'] for m in metas] == [f'{i:08d}' for i in range(5)]
+    assert idx.index.ntotal == 5
+    assert (tmp_path / 'images' / '00000004.jpg').exists()
+
+    reloaded = DummyIndexer(data_dir=tmp_path)
+    assert len(reloaded.metas) == 5
+    assert len(reloaded.search('booking', collection='bulk')) == 5
+
+
+def test_save_appends_only_new_rows(tmp_path: Path):
+    idx = DummyIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), 'a.png'), (make_png(), 'b.png')])
+    assert len((tmp_path / 'meta.jsonl').read_text().splitlines()) == 2
+
+    idx.index_images_bytes([(make_png(), 'c.png')])
+    assert len((tmp_path / 'meta.jsonl').read_text().splitlines()) == 3
+    assert (tmp_path / 'vectors.f32').stat().st_size == 3 * idx.dim * 4
+
+    reloaded = DummyIndexer(data_dir=tmp_path)
+    assert reloaded.index.ntotal == 3 and len(reloaded.metas) == 3
+
+
+def test_load_recovers_from_torn_writes(tmp_path: Path):
+    idx = DummyIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), 'a.png'), (make_png(), 'b.png')])
+    # Crash mid-save: an orphan vector plus half a meta line
+    with (tmp_path / 'vectors.f32').open('ab') as f:
+        f.write(b'\0' * (idx.dim * 4 + 7))
+    with (tmp_path / 'meta.jsonl').open('a') as f:
+        f.write('{"id": "000000')
+
+    reloaded = DummyIndexer(data_dir=tmp_path)
+    assert len(reloaded.metas) == 2 and reloaded.index.ntotal == 2
+    assert (tmp_path / 'vectors.f32').stat().st_size == 2 * idx.dim * 4
+    reloaded.index_images_bytes([(make_png(), 'c.png')])
+    assert [m.id for m in DummyIndexer(data_dir=tmp_path).metas] == ['00000000', '00000001', '00000002']
+
+
+def test_load_migrates_faiss_only_layout(tmp_path: Path):
+    import faiss
+    import numpy as np
+    from app.metastore import ImageMeta
+    from dataclasses import asdict
+    import json
+
+    legacy = faiss.IndexFlatIP(384)
+    legacy.add(np.eye(2, 384, dtype='float32'))
+    faiss.write_index(legacy, str(tmp_path / 'index.faiss'))
+    with (tmp_path / 'meta.jsonl').open('w') as f:
+        for i in range(2):
+            f.write(json.dumps(asdict(ImageMeta(id=f'{i:08d}', filename='a.png', text='x', width=1, height=1, collection='c'))) + '\n')
+
+    reloaded = DummyIndexer(data_dir=tmp_path)
+    assert reloaded.index.ntotal == 2
+    assert (tmp_path / 'vectors.f32').stat().st_size == 2 * 384 * 4
+    assert not (tmp_path / 'index.faiss').exists()
+    assert reloaded.get_meta('00000001').collection == 'c'
+    assert reloaded._filter_offsets(collection='c').tolist() == [0, 1]
+
+
+def test_metadata_columns_survive_reload(tmp_path: Path):
+    idx = DummyIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), 'a.png')], collection='trips')
+    idx.index_images_bytes([(make_png(), 'b.png')], collection='bills')
+
+    # Lose the derived columns for the last row; they are re-derived from meta.jsonl
+    with (tmp_path / 'meta.cols' / 'offset.bin').open('rb+') as f:
+        f.truncate(8)
+
+    reloaded = DummyIndexer(data_dir=tmp_path)
+    assert reloaded._filter_offsets(collection='trips').tolist() == [0]
+    assert reloaded._filter_offsets(collection='bills').tolist() == [1]
+    assert [r['id'] for r in reloaded.search('booking', collection='bills')] == ['00000001']
+    assert reloaded.get_meta('00000001').filename == 'b.png'
+    assert reloaded.get_meta('nope') is None
+
+
+class RandomVectorIndexer(DummyIndexer):
+    def _embed_batch(self, texts):  # type: ignore
+        import numpy as np
+        v = np.random.default_rng(len(self.metas)).standard_normal((len(texts), self.dim)).astype('float32')
+        return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def test_ann_index_trains_past_threshold_and_reloads(tmp_path: Path):
+    from app.ann import AnnConfig
+    config = AnnConfig(kind='ivf_flat', train_threshold=60, nlist=2, nprobe=2, exact_subset_limit=0)
+    idx = RandomVectorIndexer(data_dir=tmp_path, batch_size=20, index_config=config)
+    idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(40)], collection='a')
+    assert idx.ann_index is None
+    idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(40)], collection='b')
+    assert idx.ann_index is not None and idx.ann_index.ntotal == 80
+    assert (tmp_path / 'index.faiss').exists()
+
+    idx.index_images_bytes([(make_png(), 'late.png')], collection='c')
+    reloaded = RandomVectorIndexer(data_dir=tmp_path, index_config=config)
+    assert reloaded.ann_index is not None and reloaded.ann_index.ntotal == 81
+    assert len(reloaded.search('booking', k=10)) == 10
+    res = reloaded.search('booking', k=50, collection='b')
+    assert len(res) == 40 and {r['collection'] for r in res} == {'b'}
+    assert [r['id'] for r in reloaded.search('booking', k=5, collection='c')] == ['00000080']
+
+
+def test_index_type_switch_rebuilds(tmp_path: Path):
+    from app.ann import AnnConfig, index_kind
+    idx = RandomVectorIndexer(data_dir=tmp_path, index_config=AnnConfig(kind='ivf_flat', train_threshold=10, nlist=1))
+    idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(12)])
+    assert index_kind(idx.ann_index) == 'ivf_flat'
+
+    hnsw = RandomVectorIndexer(data_dir=tmp_path, index_config=AnnConfig(kind='hnsw', train_threshold=10))
+    assert index_kind(hnsw.ann_index) == 'hnsw' and hnsw.ann_index.ntotal == 12
+    flat = RandomVectorIndexer(data_dir=tmp_path, index_config=AnnConfig(kind='flat'))
+    assert flat.ann_index is None and len(flat.search('booking', k=3)) == 3
+
+
+class ScriptedOcrIndexer(RandomVectorIndexer):
+    texts: list = []
+
+    def _ocr_with_blocks(self, image):  # type: ignore
+        return (self.texts.pop(0), [])
+
+
+def test_hybrid_search_finds_exact_code(tmp_path: Path):
+    ScriptedOcrIndexer.texts = [f"Chat message number {i} about lunch" for i in range(30)]
+    ScriptedOcrIndexer.texts[17] = "Booking confirmed PNR X7K9Q seat 14C"
+    idx = ScriptedOcrIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(30)])
+
+    assert idx.search('X7K9Q', k=3)[0]['id'] == '00000017'
+    assert [r['id'] for r in idx.search('X7K9Q', k=3, mode='lexical')] == ['00000017']
+    assert len(idx.search('X7K9Q', k=3, mode='semantic')) == 3
+
+    # Rebuilt from the meta log when no lexical checkpoint exists yet
+    ScriptedOcrIndexer.texts = []
+    reloaded = ScriptedOcrIndexer(data_dir=tmp_path)
+    assert [r['id'] for r in reloaded.search('x7k9q', k=3, mode='lexical')] == ['00000017']
+
+
+def test_duplicate_uploads_link_to_existing_image(tmp_path: Path):
+    class CountingIndexer(DummyIndexer):
+        ocr_calls = 0
+        embedded = 0
+
+        def _ocr_with_blocks(self, image):  # type: ignore
+            CountingIndexer.ocr_calls += 1
+            return super()._ocr_with_blocks(image)
+
+        def _embed_batch(self, texts):  # type: ignore
+            CountingIndexer.embedded += len(texts)
+            return super()._embed_batch(texts)
+
+    a, b = make_png(), make_png()
+    idx = CountingIndexer(data_dir=tmp_path, batch_size=4)
+    metas = idx.index_images_bytes([(a, 'a.png'), (b, 'b.png'), (a, 'a copy.png')])
+    assert [(m['id'], m['duplicate']) for m in metas] == [('00000000', False), ('00000001', False), ('00000000', True)]
+    assert idx.index_image_bytes(b, 'b again.png')['id'] == '00000001'
+    assert len(idx.metas) == 2 and CountingIndexer.ocr_calls == 2 and CountingIndexer.embedded == 2
+
+    # With dedup off, repeats are new entries but reuse the cached OCR and vectors
+    reloaded = CountingIndexer(data_dir=tmp_path)
+    reloaded.dedup = False
+    assert reloaded.index_image_bytes(a, 'a.png')['id'] == '00000002'
+    assert CountingIndexer.ocr_calls == 2 and CountingIndexer.embedded == 2
+    assert reloaded.metas[2].content_hash == reloaded.metas[0].content_hash
+
+
+def test_perceptual_hash_catches_reencoded_copies(tmp_path: Path):
+    import io
+    from PIL import Image
+    idx = DummyIndexer(data_dir=tmp_path)
+    idx.phash_distance = 4
+    image = Image.linear_gradient('L').rotate(90).convert('RGB')
+    png, jpg = io.BytesIO(), io.BytesIO()
+    image.save(png, format='PNG')
+    image.save(jpg, format='JPEG', quality=70)
+
+    first = idx.index_image_bytes(png.getvalue(), 'shot.png')
+    copy = idx.index_image_bytes(jpg.getvalue(), 'shot.jpg')
+    assert copy['id'] == first['id'] and copy['duplicate']
+    assert not idx.index_image_bytes(make_png(), 'other.png')['duplicate']
+
+    # The nearest copy was deleted: the next live one within the distance is linked instead
+    idx.delete([first['id']])
+    kept = idx.index_image_bytes(jpg.getvalue(), 'shot.jpg')
+    assert not kept['duplicate']
+    again = idx.index_image_bytes(png.getvalue(), 'shot.png')
+    assert again['id'] == kept['id'] and again['duplicate']
+
+
+def test_perceptual_hashes_are_appended_not_reloaded(tmp_path: Path):
+    from app.content_cache import ContentCache
+    cache = ContentCache(tmp_path / 'content.sqlite3', 'model')
+    entry = {'text': '', 'blocks': [], 'width': 1, 'height': 1}
+    cache.put([dict(entry, sha256='a', phash=0b1111), dict(entry, sha256='b', phash=0b0001)])
+    assert cache.similar(0, 4) == ['b', 'a'] and cache.similar(0, 2) == ['b']
+
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+    cache.put([dict(entry, sha256='c', phash=0)])
+    assert cache.similar(0, 4) == ['c', 'b', 'a']
+    assert not [sql for sql in statements if 'SELECT' in sql]
+
+
+def test_filters_are_vectorized_over_columns(tmp_path: Path):
+    import numpy as np
+    idx = DummyIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(4)], collection='a')
+    idx.index_images_bytes([(make_png(), 'b.png')], collection='b')
+    # Pin import times: two days in 2024 plus one unparseable timestamp
+    metas = list(idx.metas)
+    for meta, ts in zip(metas, ['2024-03-01T23:59:59+00:00', '2024-03-02T00:00:00Z', 'garbage']):
+        meta.imported_at = ts
+    idx.metas.rewrite(metas)
+
+    cols = idx.metas.columns()
+    assert cols['imported_at'].dtype == np.int64 and cols['imported_at'][1] == 1709337600
+
+    assert idx._filter_offsets(start_date='2024-03-02', end_date='2024-03-02').tolist() == [1, 2]
+    assert idx._filter_offsets(end_date='2024-03-01').tolist() == [0, 2]
+    assert idx._filter_offsets(collection='b', entity_type='code').tolist() == [4]
+    assert idx._filter_offsets(entity_type='nope').tolist() == []
+    assert idx._filter_offsets(start_date='not a date') is None
+    assert idx.matches_filters(4, collection='b') and not idx.matches_filters(3, collection='b')
+
+
+def test_meta_rows_are_compact(tmp_path: Path):
+    idx = DummyIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), 'a.png'), (make_png(), 'b.png')], collection='holiday ' + 'photos')
+    reloaded = DummyIndexer(data_dir=tmp_path)
+    a, b = reloaded.metas[0], reloaded.metas[1]
+    assert not hasattr(a, '__dict__')
+    assert a.collection is b.collection
+    assert next(iter(a.entities)) is next(iter(b.entities))
+
+
+def test_export_iterators_stream_from_offset(tmp_path: Path):
+    import numpy as np
+    idx = DummyIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(3)])
+    idx.index_image_bytes(make_png(), 'pending.png')  # not saved yet
+
+    assert [m.filename for m in idx.iter_metas(1)] == ['1.png', '2.png', 'pending.png']
+    blocks = list(idx.iter_vectors(1, chunk=2))
+    assert [len(b) for b in blocks] == [2, 1]
+    assert np.array_equal(np.concatenate(blocks), idx.index.reconstruct_n(1, 3))
+
+
+def test_ocr_payload_has_precomputed_highlights(tmp_path: Path):
+    import json
+    idx = DummyIndexer(data_dir=tmp_path)
+    meta = idx.index_image_bytes(make_png(), 'a.png')
+    payload = json.loads(idx.ocr_payload(meta['id']))
+    assert payload['entity_block_idxs'] == {'code': [3]}
+
+    assert idx.ocr_payload('nope') is None
+
+
+def test_legacy_ocr_dir_is_packed_on_load(tmp_path: Path):
+    import json
+    idx = DummyIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), 'a.png'), (make_png(), 'b.png')])
+    blocks = json.loads(idx.ocr_payload('00000000'))['blocks']
+    idx.close()
+
+    # One JSON file per image, without precomputed highlights (and one missing)
+    (tmp_path / 'ocr.seg').unlink()
+    (tmp_path / 'ocr.seg.idx').unlink()
+    (tmp_path / 'ocr').mkdir()
+    (tmp_path / 'ocr' / '00000000.json').write_text(json.dumps({'blocks': blocks}))
+
+    reloaded = DummyIndexer(data_dir=tmp_path)
+    assert json.loads(reloaded.ocr_payload('00000000'))['entity_block_idxs'] == {'code': [3]}
+    assert json.loads(reloaded.ocr_payload('00000001'))['blocks'] == []
+    reloaded.index_images_bytes([(make_png(), 'c.png')])
+    assert json.loads(DummyIndexer(data_dir=tmp_path).ocr_payload('00000002'))['blocks'] == blocks
+
+
+def test_blob_log_drops_torn_records(tmp_path: Path):
+    from app.storage import BlobLog
+    log = BlobLog(tmp_path / 'blobs.seg')
+    log.append(b'one')
+    log.append(b'two!')
+    log.flush()
+    log.append(b'pending')
+    assert [log.get(i) for i in range(3)] == [b'one', b'two!', b'pending']
+
+    # Crash after the segment write but before the index entry
+    with (tmp_path / 'blobs.seg').open('ab') as f:
+        f.write(b'orphan')
+    with (tmp_path / 'blobs.seg.idx').open('ab') as f:
+        f.write(b'\0' * 5)
+    reopened = BlobLog(tmp_path / 'blobs.seg')
+    assert len(reopened) == 2 and reopened.get(1) == b'two!'
+    assert (tmp_path / 'blobs.seg').stat().st_size == 7
+    reopened.truncate(1)
+    assert len(BlobLog(tmp_path / 'blobs.seg')) == 1
+
+
+def test_vectors_stored_as_float16_and_converted(tmp_path: Path, monkeypatch):
+    idx = RandomVectorIndexer(data_dir=tmp_path)
+    idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(6)])
+    expected = [r['id'] for r in idx.search('booking', k=3, mode='semantic')]
+    idx.close()
+
+    monkeypatch.setenv('QUARRY_VECTOR_DTYPE', 'float16')
+    half = RandomVectorIndexer(data_dir=tmp_path)
+    assert not (tmp_path / 'vectors.f32').exists()
+    assert (tmp_path / 'vectors.f16').stat().st_size == 6 * half.dim * 2
+    assert [r['id'] for r in half.search('booking', k=3, mode='semantic')] == expected
+    half.index_images_bytes([(make_png(), 'late.png')])
+    assert half.stats()['vectors']['dtype'] == 'float16' and half.index.ntotal == 7
+
+
+def test_delete_hides_rows_until_compaction_reclaims_them(tmp_path: Path, monkeypatch):
+    import json
+    idx = DummyIndexer(data_dir=tmp_path)
+    metas = idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(5)], collection='bulk')
+    ids = [m['id'] for m in metas]
+
+    assert idx.delete([ids[1], ids[4], 'missing']) == [ids[1], ids[4]]
+    assert idx.delete([ids[1]]) == []
+    assert not (tmp_path / 'images' / f'{ids[1]}.jpg').exists()
+    assert idx.get_meta(ids[1]) is None and idx.ocr_payload(ids[4]) is None
+    assert [r['id'] for r in idx.search('booking', k=10, collection='bulk')] == [ids[0], ids[2], ids[3]]
+    assert [r['id'] for r in idx.search('ABC123', k=10, mode='lexical')] == [ids[0], ids[2], ids[3]]
+    assert [m.id for m in idx.iter_metas()] == [ids[0], ids[2], ids[3]]
+    assert idx.page(0, 2) == (0, 3, 3)
+    assert idx.stats()['images'] == 3
+    idx.close()
+
+    # Tombstones survive a restart; compaction then drops the rows but keeps ids stable
+    reopened = DummyIndexer(data_dir=tmp_path)
+    assert reopened.get_meta(ids[1]) is None and reopened.count() == 3
+    reopened.update(ids[3], collection='moved')
+    # The new generation is loaded while searches go on; only the swap holds the write lock
+    load = DummyIndexer._load
+    held = []
+    monkeypatch.setattr(DummyIndexer, '_load', lambda self: (held.append(self._rw._writer), load(self))[1])
+    reopened.compact()
+    assert held == [None]
+    assert len(reopened.metas) == 3 and reopened.index.ntotal == 3 and len(reopened.ocr_log) == 3
+    assert not (tmp_path / 'compact.json').exists() and not list(tmp_path.glob('*.compact*'))
+    assert reopened.get_meta(ids[3]).collection == 'moved'
+    assert json.loads(reopened.ocr_payload(ids[3]))['entity_block_idxs'] == {'code': [3]}
+    assert [r['id'] for r in reopened.search('booking', k=10, collection='bulk')] == [ids[0], ids[2]]
+    # The deleted last id is not handed out again
+    assert reopened.index_image_bytes(make_png(), 'new.png')['id'] == '00000005'
+    reopened.save()
+    assert DummyIndexer(data_dir=tmp_path).get_meta('00000005').filename == 'new.png'
+
+
+def test_update_is_a_patch_not_a_rewrite(tmp_path: Path):
+    import pytest
+    idx = DummyIndexer(data_dir=tmp_path)
+    metas = idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(3)], collection='inbox')
+    size = (tmp_path / 'meta.jsonl').stat().st_size
+
+    assert idx.update(metas[0]['id'], collection='work', filename='renamed.png')['collection'] == 'work'
+    assert (tmp_path / 'meta.jsonl').stat().st_size == size
+    assert [r['id'] for r in idx.search('booking', collection='work')] == [metas[0]['id']]
+    with pytest.raises(ValueError):
+        idx.update(metas[1]['id'], text='edited')
+    assert idx.update('99999999', collection='x') is None
+
+    reopened = DummyIndexer(data_dir=tmp_path)
+    assert reopened.get_meta(metas[0]['id']).filename == 'renamed.png'
+    assert len(reopened.search('booking', collection='inbox')) == 2
+
+
+def test_interrupted_compaction_is_finished_or_discarded(tmp_path: Path):
+    idx = DummyIndexer(data_dir=tmp_path)
+    ids = [m['id'] for m in idx.index_images_bytes([(make_png(), f'{i}.png') for i in range(3)])]
+    idx.delete([ids[0]])
+    idx.close()
+
+    # Staged copies without the commit marker are ignored
+    (tmp_path / 'meta.jsonl.compact').write_text('garbage\n')
+    reopened = DummyIndexer(data_dir=tmp_path)
+    assert not (tmp_path / 'meta.jsonl.compact').exists() and len(reopened.metas) == 3
+
+    reopened.compact()
+    assert [m.id for m in DummyIndexer(data_dir=tmp_path).iter_metas()] == ids[1:]
+
+
+def test_concurrent_ingest_and_search(tmp_path: Path):
+    import threading
+    idx = DummyIndexer(data_dir=tmp_path, batch_size=4)
+    items = [[(make_png(), f'{w}-{i}.png') for i in range(12)] for w in range(3)]
+    errors = []
+    done = threading.Event()
+
+    def ingest(batch):
+        try:
+            idx.index_images_bytes(batch)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    def search():
+        while not done.is_set():
+            try:
+                for r in idx.search('booking', k=5):
+                    assert idx.get_meta(r['id']) is not None
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+    writers = [threading.Thread(target=ingest, args=(batch,)) for batch in items]
+    readers = [threading.Thread(target=search) for _ in range(2)]
+    for t in readers + writers:
+        t.start()
+    for t in writers:
+        t.join()
+    done.set()
+    for t in readers:
+        t.join()
+
+    assert errors == []
+    ids = [m.id for m in idx.iter_metas()]
+    assert len(ids) == len(set(ids)) == 36
+    assert len(idx.metas) == idx.index.ntotal == len(idx.ocr_log) == len(idx.lexical) == 36
+    # Identical content uploaded by two workers at once is still stored once
+    twice = [(make_png(), 'same.png')]
+    threads = [threading.Thread(target=ingest, args=(list(twice),)) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert idx.count() == 37
+
+
+def test_replica_follows_published_snapshots(tmp_path: Path):
+    import json
+    import pytest
+
+    writer = DummyIndexer(data_dir=tmp_path)
+    writer.compact_min = 1
+    writer.compact_ratio = 1.0  # compacted explicitly below
+    writer.index_images_bytes([(make_png(), f'{i}.png') for i in range(3)], collection='a')
+    reader = DummyIndexer(data_dir=tmp_path, readonly=True)
+    assert reader.count() == 3 and reader.refresh() is False
+    with pytest.raises(RuntimeError):
+        reader.index_image_bytes(make_png(), 'x.png')
+
+    # Appends, edits and deletes show up only once the replica moves to the next snapshot
+    writer.index_images_bytes([(make_png(), f'{i}.png') for i in range(3, 5)], collection='a')
+    writer.update('00000000', collection='b')
+    writer.delete(['00000001'])
+    assert reader.count() == 3 and reader.get_meta('00000004') is None
+    assert reader.refresh() is True
+    assert reader.count() == 4 and reader.get_meta('00000001') is None
+    assert [r['id'] for r in reader.search('booking', collection='b')] == ['00000000']
+    assert json.loads(reader.ocr_payload('00000004'))['blocks'][0]['text'] == 'Your'
+    assert len(reader.lexical) == reader.index.ntotal == 5
+
+    # Compaction replaces the files: the replica keeps serving the old ones until it reopens
+    before = reader.snapshot['generation']
+    writer.compact()
+    assert [m.id for m in reader.iter_metas()] == ['00000000', '00000002', '00000003', '00000004']
+    assert reader.refresh() is True and reader.snapshot['generation'] == before + 1
+    assert len(reader.metas) == 4 and reader.get_meta('00000002').filename == '2.png'
+    assert [r['id'] for r in reader.search('booking', collection='b')] == ['00000000']
+
+
+def test_second_writer_process_is_refused(tmp_path: Path):
+    import subprocess
+    import sys
+    from app.snapshots import acquire_writer_lock
+
+    acquire_writer_lock(tmp_path)
+    probe = "import sys; from pathlib import Path; from app.snapshots import WriterLockHeld, acquire_writer_lock\n" \
+        "try:\n    acquire_writer_lock(Path(sys.argv[1]))\nexcept WriterLockHeld:\n    sys.exit(3)\n"
+    result = subprocess.run([sys.executable, "-c", probe, str(tmp_path)], cwd=Path(__file__).resolve().parents[1])
+    assert result.returncode == 3
+
+
+def test_ocr_pool_processes_split_the_cores_between_bands(tmp_path: Path, monkeypatch):
+    import os
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    idx = DummyIndexer(data_dir=tmp_path, ocr_workers=8)
+    assert idx._pool_ocr_config().tile_workers == 1
+    idx.ocr_workers = 2
+    assert idx._pool_ocr_config().tile_workers == 4 and idx.ocr_config.tile_workers == 4
@@ -0,0 +1,98 @@
+from pathlib import Path
+import time
+
+from app.jobs import JobQueue
+
+
+def wait_for(queue: JobQueue, job_id: str):
+    for _ in range(200):
+        job = queue.get(job_id)
+        if job and job["status"] == "completed":
+            return job
+        time.sleep(0.02)
+    raise AssertionError("job did not complete")
+
+
+def test_failed_file_does_not_fail_batch(tmp_path: Path):
+    def process(items, collection):
+        out = []
+        for content, filename in items:
+            if content == b"bad":
+                raise ValueError("cannot decode")
+            out.append({"id": filename.upper()})
+        return out
+
+    queue = JobQueue(tmp_path, process=process)
+    job_id = queue.submit([(b"ok", "a"), (b"bad", "b"), (b"ok", "c")], collection="x")
+    job = wait_for(queue, job_id)
+
+    assert (job["done"], job["failed"], job["total"]) == (2, 1, 3)
+    assert [f["image_id"] for f in job["files"]] == ["A", None, "C"]
+    assert job["files"][1]["error"] == "cannot decode"
+    assert job["throughput_per_sec"] is not None
+    # The spool is removed just after the final statuses commit
+    for _ in range(200):
+        if not (tmp_path / "spool" / job_id).exists():
+            break
+        time.sleep(0.01)
+    assert not (tmp_path / "spool" / job_id).exists()
+
+
+def test_interrupted_work_is_resumed(tmp_path: Path):
+    seen = []
+
+    def process(items, collection):
+        seen.extend(filename for _, filename in items)
+        return [{"id": filename} for _, filename in items]
+
+    # Journal a job and simulate a crash after a worker claimed it
+    first = JobQueue(tmp_path, process=process)
+    first.start = lambda: None  # type: ignore
+    job_id = first.submit([(b"1", "a"), (b"2", "b")])
+    assert first._claim() is not None
+    assert first.get(job_id)["running"] == 2
+
+    second = JobQueue(tmp_path, process=process)
+    second.start()
+    job = wait_for(second, job_id)
+    assert job["done"] == 2
+    assert sorted(seen) == ["a", "b"]
+
+
+def test_uploads_stream_to_spool_and_backlog_is_bounded(tmp_path: Path):
+    import io
+    import pytest
+    from app.jobs import QueueFull
+
+    seen = []
+
+    def process(items, collection):
+        seen.extend(content for content, _ in items)
+        return [{"id": filename} for _, filename in items]
+
+    queue = JobQueue(tmp_path, process=process, autostart=False, max_pending=2)
+    first = queue.submit([(io.BytesIO(b"streamed" * 1000), "a")])
+    queue.submit([(b"2", "b")])
+    assert queue.backlog() == 2
+    with pytest.raises(QueueFull):
+        queue.submit([(b"3", "c")])
+
+    queue.start()
+    assert wait_for(queue, first)["done"] == 1
+    assert seen[0] == b"streamed" * 1000
+
+
+
+def test_spool_of_finished_jobs_is_swept_on_start(tmp_path: Path):
+    queue = JobQueue(tmp_path, process=lambda items, collection: [{"id": f} for _, f in items], autostart=False)
+    job_id = queue.submit([(b"1", "a")])
+    queue._process(*queue._claim())
+    assert queue.get(job_id)["status"] == "completed"
+
+    # A crash after the statuses committed leaves the spool behind
+    (tmp_path / "spool" / job_id).mkdir()
+    (tmp_path / "spool" / job_id / "0").write_bytes(b"1")
+    queued = queue.submit([(b"2", "b")])
+    JobQueue(tmp_path, process=lambda items, collection: [{"id": f} for _, f in items], autostart=False).start()
+    assert not (tmp_path / "spool" / job_id).exists()
+    wait_for(queue, queued)
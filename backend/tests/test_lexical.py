@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import numpy as np
+
+from app.lexical import LexicalIndex, query_terms, reciprocal_rank_fusion
+
+
+def test_bm25_ranks_exact_codes_and_entities(tmp_path: Path):
+    lex = LexicalIndex(tmp_path)
+    lex.add(0, "Chat with Alice about lunch")
+    lex.add(1, "Booking PNR X7K9Q for flight 220", {"code": ["X7K9Q"]})
+    lex.add(2, "Receipt total $42.00 paid", {"amount": ["$42.00"]})
+
+    assert [d for d, _ in lex.search("X7K9Q", 3)] == [1]
+    assert [d for d, _ in lex.search("total $42.00", 3)] == [2]
+    assert "$42.00" in query_terms("paid $42.00?")
+    assert lex.search("X7K9Q", 3, allowed=np.array([0, 2])) == []
+
+
+def test_checkpoint_reload_and_delta(tmp_path: Path):
+    lex = LexicalIndex(tmp_path)
+    lex.add(0, "alpha beta")
+    lex.add(1, "beta gamma")
+    lex.checkpoint()
+    lex.add(2, "gamma delta")
+
+    reloaded = LexicalIndex(tmp_path)
+    assert len(reloaded) == 2 and reloaded.pending == 0
+    reloaded.add(2, "gamma delta")
+    assert {d for d, _ in reloaded.search("gamma", 5)} == {1, 2}
+    reloaded.checkpoint()
+    assert sorted(p.name for p in tmp_path.glob("*.docs.npy")) == ["0000000003.docs.npy"]
+
+
+def test_reciprocal_rank_fusion_prefers_agreement():
+    fused = reciprocal_rank_fusion([(1, 0.9), (2, 0.8)], [(2, 5.0), (3, 4.0)])
+    assert [d for d, _ in fused] == [2, 1, 3]
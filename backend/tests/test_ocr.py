@@ -0,0 +1,106 @@
+import numpy as np
+from PIL import Image
+
+from app import ocr
+from app.ocr import OcrConfig, ocr_image, otsu_threshold, preprocess, text_tiles
+
+
+def _screenshot(width=1170, height=2532):
+    # White page with dark "text" bars every 200 px and a mid-grey photo band at 1000-1400
+    arr = np.full((height, width), 250, dtype="uint8")
+    for y in range(100, height, 200):
+        arr[y:y + 20, 50:600] = 20
+    arr[1000:1400] = (np.indices((400, width)).sum(axis=0) % 96 + 80).astype("uint8")
+    return Image.fromarray(arr).convert("RGB")
+
+
+def test_preprocess_downscales_and_binarizes():
+    gray, prepared, scale = preprocess(_screenshot(), OcrConfig(max_width=585))
+    assert gray.shape == (1266, 585) and scale == 0.5
+    assert set(np.unique(prepared).tolist()) <= {0, 255}
+    assert 20 <= otsu_threshold(np.array([[20, 20, 250, 250]], dtype="uint8")) < 250
+    assert preprocess(Image.new("RGB", (100, 50)), OcrConfig())[2] == 1.0
+
+
+def test_text_tiles_skip_blank_and_photo_bands():
+    gray = np.full((900, 100), 255, dtype="uint8")
+    gray[50:60] = 0  # text in the first band
+    gray[600:900] = np.random.default_rng(0).integers(0, 256, (300, 100))  # photo-like band
+    assert text_tiles(gray, OcrConfig(tile_height=300, tile_overlap=10)) == [(0, 310, 0, 300), (590, 900, 600, 900)]
+    tiles = text_tiles(gray, OcrConfig(tile_height=300, tile_overlap=10, skip_photos=True))
+    assert tiles == [(0, 310, 0, 300)]
+
+
+def test_coloured_and_dark_backgrounds_are_not_photos():
+    for background, ink in (((0x42, 0x42, 0x42), 235), ((0x18, 0x77, 0xF2), 255)):
+        arr = np.empty((2532, 1170, 3), dtype="uint8")
+        arr[:] = background
+        for y in range(100, 2532, 120):
+            arr[y:y + 24, 60:900] = ink  # text lines
+        gray, _, _ = preprocess(Image.fromarray(arr), OcrConfig())
+        for config in (OcrConfig(), OcrConfig(skip_photos=True)):
+            assert len(text_tiles(gray, config)) == 2
+
+
+def test_tiles_map_blocks_back_to_original_pixels(monkeypatch):
+    calls = []
+
+    def fake_tesseract(band, config):
+        calls.append(band.shape)
+        # One word near the top of every band, plus one inside the overlap at the bottom
+        h = band.shape[0]
+        return {"text": ["word", "dup"], "conf": ["90", "80"], "left": [10, 10], "top": [30, h - 20], "width": [40, 40], "height": [10, 10]}
+
+    monkeypatch.setattr(ocr, "_tesseract", fake_tesseract)
+    config = OcrConfig(max_width=585, tile_height=400, tile_overlap=32, skip_photos=False)
+    text, blocks, timings = ocr_image(_screenshot(), config)
+
+    assert len(calls) == 4  # ceil(1266 / 400) bands
+    assert set(timings) == {"preprocess", "regions", "tesseract"}
+    ys = [b["bbox"]["y"] for b in blocks]
+    assert ys == sorted(ys) and len(ys) == len(set(ys))  # overlap reads are kept once
+    assert blocks[0]["bbox"] == {"x": 20, "y": 60, "w": 80, "h": 20}  # scaled back up 2x
+    assert text.startswith("word")
+
+
+def test_engines_are_shared_per_process_and_fall_back():
+    from importlib.util import find_spec
+    from app.ocr import PytesseractEngine, get_engine
+    import pytest
+
+    engine = get_engine("auto")
+    assert engine is get_engine("auto")
+    if find_spec("tesserocr") is None:
+        assert isinstance(engine, PytesseractEngine)
+    assert isinstance(get_engine("pytesseract"), PytesseractEngine)
+    with pytest.raises(ValueError):
+        get_engine("easyocr")
+
+
+def test_tesserocr_apis_are_reused_across_tall_images(monkeypatch):
+    import sys
+    import types
+
+    created = []
+
+    class FakeApi:
+        def __init__(self, **settings):
+            created.append(settings)
+
+        def SetImage(self, image):
+            pass
+
+        def Recognize(self):
+            pass
+
+        def GetIterator(self):
+            return None
+
+    monkeypatch.setitem(sys.modules, "tesserocr", types.SimpleNamespace(PyTessBaseAPI=FakeApi))
+    monkeypatch.setattr(ocr, "_engines", {})
+    config = OcrConfig(engine="tesserocr")
+    ocr.warm_engine(config)
+    assert len(created) == 1
+    for _ in range(5):
+        ocr_image(_screenshot(), config)  # two bands each
+    assert len(created) <= 2
@@ -0,0 +1,57 @@
+import threading
+import time
+
+import numpy as np
+
+from app.query_encoder import QueryEncoder
+
+
+def fake_encode(calls):
+    def encode(texts):
+        calls.append(list(texts))
+        return np.array([[float(len(t)), 1.0] for t in texts], dtype="float32")
+    return encode
+
+
+def test_cache_hits_and_normalization():
+    calls = []
+    enc = QueryEncoder(fake_encode(calls), "m", batch_window=0)
+    a = enc.encode("hello  world")
+    b = enc.encode(" hello world ")
+    assert calls == [["hello world"]]
+    assert np.array_equal(a, b) and a.shape == (1, 2)
+    stats = enc.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["hit_rate"] == 0.5
+
+
+def test_ttl_and_lru_eviction():
+    calls = []
+    enc = QueryEncoder(fake_encode(calls), "m", cache_size=1, ttl=0.05, batch_window=0)
+    enc.encode("a")
+    enc.encode("bb")  # evicts "a"
+    enc.encode("a")
+    assert enc.stats()["evictions"] == 2
+    time.sleep(0.06)
+    enc.encode("a")
+    assert enc.stats()["expired"] == 1
+    assert len(calls) == 4
+
+
+def test_concurrent_queries_are_micro_batched():
+    calls = []
+    enc = QueryEncoder(fake_encode(calls), "m", batch_window=0.05)
+    results = {}
+
+    def run(q):
+        results[q] = enc.encode(q)
+
+    threads = [threading.Thread(target=run, args=(q,)) for q in ["x", "yy", "zzz", "x"]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1 and sorted(calls[0]) == ["x", "yy", "zzz"]
+    assert results["zzz"][0, 0] == 3.0
+    stats = enc.stats()
+    assert stats["batches"] == 1 and stats["mean_batch_size"] == 3 and stats["coalesced"] == 1
@@ -0,0 +1,73 @@
+import threading
+import time
+
+from app.rwlock import RWLock
+
+
+def test_readers_share_and_writer_excludes():
+    lock = RWLock()
+    inside = []
+    both_read = threading.Barrier(2, timeout=2)
+
+    def reader():
+        with lock.read():
+            both_read.wait()  # only passes if two readers hold the lock at once
+            inside.append("r")
+
+    readers = [threading.Thread(target=reader) for _ in range(2)]
+    for t in readers:
+        t.start()
+    for t in readers:
+        t.join()
+    assert inside == ["r", "r"]
+
+    order = []
+    with lock.write():
+        t = threading.Thread(target=lambda: lock.read().__enter__() or order.append("read"))
+        t.start()
+        time.sleep(0.05)
+        order.append("write done")
+    t.join(timeout=2)
+    assert order == ["write done", "read"]
+
+
+def test_reentrant_and_writer_may_read():
+    lock = RWLock()
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                pass
+    with lock.read():
+        with lock.read():
+            pass
+    # Fully released: another thread can write
+    t = threading.Thread(target=lambda: lock.write().__enter__())
+    t.start()
+    t.join(timeout=2)
+    assert not t.is_alive()
+
+
+def test_waiting_writer_is_not_starved_by_new_readers():
+    lock = RWLock()
+    order = []
+    first = lock.read()
+    first.__enter__()
+
+    def writer():
+        with lock.write():
+            order.append("write")
+
+    def late_reader():
+        with lock.read():
+            order.append("read")
+
+    w = threading.Thread(target=writer)
+    w.start()
+    time.sleep(0.05)
+    r = threading.Thread(target=late_reader)
+    r.start()
+    time.sleep(0.05)
+    first.__exit__(None, None, None)
+    w.join(timeout=2)
+    r.join(timeout=2)
+    assert order == ["write", "read"]
@@ -0,0 +1,90 @@
+from pathlib import Path
+
+from app.shards import ShardedIndexer, read_layout, reshard
+from conftest import DummyIndexer, make_png
+
+
+def test_collection_shards_scatter_gather(tmp_path: Path):
+    ix = ShardedIndexer(tmp_path, by="collection", indexer_class=DummyIndexer)
+    seen = []
+    ix.add_ingest_listener(lambda part, offsets, vectors: seen.append((part.shard, offsets)))
+    uploads = [make_png() for _ in range(3)]
+    work = ix.index_images_bytes([(content, f"w{i}.png") for i, content in enumerate(uploads)], collection="work")
+    ix.index_images_bytes([(make_png(), f"h{i}.png") for i in range(2)], collection="home")
+    ix.index_image_bytes(make_png(), "loose.png")
+    assert sorted(p.name for p in (tmp_path / "shards").iterdir() if p.is_dir()) == ["_unfiled", "home", "work"]
+    assert [m["id"] for m in work] == ["00000000", "00000001", "00000002"]
+    assert seen == [("work", [0, 1, 2]), ("home", [0, 1]), ("_unfiled", [0])]
+    assert (tmp_path / "images" / "00000005.jpg").exists()
+
+    # A collection-scoped query only visits that collection's shard
+    assert [p.shard for p in ix._relevant("work")] == ["work"]
+    assert [r["id"] for r in ix.search("booking", k=10, collection="work")] == ["00000000", "00000001", "00000002"]
+    assert len(ix.search("ABC123", k=10, mode="lexical")) == 6
+    assert len(ix.search("booking", k=4)) == 4
+    assert ix.search("booking", collection="missing") == []
+
+    # Known content links to the existing screenshot, whatever shard it is in
+    dup = ix.index_image_bytes(uploads[0], "again.png", collection="home")
+    assert dup["duplicate"] is True and dup["id"] == "00000000"
+
+    # Edits stay in place; the shard's dictionary makes it relevant to the new collection
+    ix.update("00000001", collection="home")
+    assert [r["id"] for r in ix.search("booking", k=10, collection="home", mode="semantic")] == ["00000001", "00000003", "00000004"]
+    assert ix.delete(["00000003", "missing"]) == ["00000003"]
+    assert ix.count() == 5
+
+    # Exports merge the shards in id order
+    assert [m.id for m in ix.iter_metas()] == ["00000000", "00000001", "00000002", "00000004", "00000005"]
+    start, stop, cursor = ix.page(0, 2)
+    assert cursor == 2 and [m.id for m in ix.iter_metas(start, stop)] == ["00000000", "00000001"]
+    assert sum(len(block) for block in ix.iter_vectors(2)) == 3
+    ix.close()
+
+    reopened = ShardedIndexer(tmp_path, indexer_class=DummyIndexer)
+    assert reopened.layout == {"by": "collection", "routes": {}} and reopened.count() == 5
+    assert reopened.index_image_bytes(make_png(), "new.png", collection="work")["id"] == "00000006"
+
+
+def test_reshard_splits_and_merges_without_changing_ids(tmp_path: Path):
+    flat = DummyIndexer(data_dir=tmp_path)
+    flat.index_images_bytes([(make_png(), f"a{i}.png") for i in range(3)], collection="a")
+    flat.index_images_bytes([(make_png(), f"b{i}.png") for i in range(2)], collection="b")
+    flat.delete(["00000001"])
+    flat.close()
+
+    # An unsharded data dir is split by collection; the root is emptied and compacted
+    assert reshard(tmp_path, "collection", indexer_class=DummyIndexer) == {"(root)": 0, "a": 2, "b": 2}
+    ix = ShardedIndexer(tmp_path, indexer_class=DummyIndexer)
+    assert len(ix.root.metas) == 0
+    assert [r["id"] for r in ix.search("booking", k=10, collection="b")] == ["00000003", "00000004"]
+    assert ix.get_meta("00000002").filename == "a2.png" and ix.get_meta("00000001") is None
+    assert (tmp_path / "images" / "00000000.jpg").exists()
+    ix.close()
+
+    # Two collections merged into one shard, then everything rehashed over two shards
+    assert reshard(tmp_path, "collection", routes={"a": "ab", "b": "ab"}, indexer_class=DummyIndexer) == {"(root)": 0, "ab": 4}
+    assert read_layout(tmp_path)["routes"] == {"a": "ab", "b": "ab"}
+    counts = reshard(tmp_path, "hash", count=2, indexer_class=DummyIndexer)
+    assert sum(counts.values()) == 4 and set(counts) <= {"(root)", "h000", "h001"}
+    ix = ShardedIndexer(tmp_path, indexer_class=DummyIndexer)
+    assert [m.id for m in ix.iter_metas()] == ["00000000", "00000002", "00000003", "00000004"]
+    assert ix.index_image_bytes(make_png(), "c.png", collection="c")["id"] == "00000005"
+    ix.close()
+
+    # A build interrupted before its marker is dropped on the next open
+    (tmp_path / "shards.new" / "x").mkdir(parents=True)
+    ix = ShardedIndexer(tmp_path, indexer_class=DummyIndexer)
+    assert not (tmp_path / "shards.new").exists() and ix.count() == 5
+
+
+def test_replica_opens_shards_the_writer_creates(tmp_path: Path):
+    writer = ShardedIndexer(tmp_path, by="hash", count=4, indexer_class=DummyIndexer)
+    writer.index_images_bytes([(make_png(), "a.png")])
+    reader = ShardedIndexer(tmp_path, readonly=True, indexer_class=DummyIndexer)
+    assert reader.count() == 1 and reader.layout == {"by": "hash", "count": 4}
+
+    writer.index_images_bytes([(make_png(), f"{i}.png") for i in range(8)])
+    assert reader.refresh() is True
+    assert reader.count() == 9 and len(reader.search("booking", k=20)) == 9
+    assert set(reader.shards) == set(writer.shards)